@@ -8,7 +8,12 @@ except ImportError:
 
 from ansible.module_utils.basic import *
 
+# One keep-alive connection pool for every API call in the task
+SESSION = requests.Session()
+
 API_BASE = '/api/v1/boot_config/'
+BULK_API = '/api/v1/bulk/boot_config/'
+EXPORT_API = '/api/v1/export/'
 BOOT_CONFIG_KEYS = [
     'title',
     'config'
@@ -17,7 +22,7 @@ BOOT_CONFIG_KEYS = [
 
 def _get_boot_configs(uri):
     api_url = urljoin(uri, API_BASE)
-    bcr = requests.get(api_url)
+    bcr = SESSION.get(api_url)
     bcr.raise_for_status()
     return bcr.json()
 
@@ -25,7 +30,7 @@ def _get_boot_configs(uri):
 def _get(data):
     api_url = urljoin(data['sbm_uri'], API_BASE)
     api_url = urljoin(api_url, data['title'] + '/')
-    bcr = requests.get(api_url)
+    bcr = SESSION.get(api_url)
     bcr.raise_for_status()
     return bcr.json()
 
@@ -34,7 +39,7 @@ def _remove(data):
     retval = {'failed': True, 'changed': False}
     api_url = urljoin(data['sbm_uri'], API_BASE)
     api_url = urljoin(api_url, data['title'] + '/')
-    dr = requests.delete(api_url)
+    dr = SESSION.delete(api_url)
     try:
         resp = dr.json()
         if 'status' not in resp.keys() or resp['status'] != 'ok':
@@ -73,7 +78,7 @@ def _update(data, check):
         retval['msg'] = 'Successfully updated boot_config'
         retval['changed'] = True
         if not check:
-            resp = requests.post(api_url, json=new_bc)
+            resp = SESSION.post(api_url, json=new_bc)
             if resp.status_code != 200:
                 retval['msg'] = 'API Error on post'
                 retval['failed'] = True
@@ -90,7 +95,7 @@ def _add(data):
     bc = {}
     for key in BOOT_CONFIG_KEYS:
         bc[key] = data[key]
-    resp = requests.put(api_url, json=bc)
+    resp = SESSION.put(api_url, json=bc)
     if resp.status_code != 200:
         retval['msg'] = 'API Error on put'
         retval['failed'] = True
@@ -148,10 +153,104 @@ def _absent(data, check):
     return retval
 
 
+def _get_all(uri):
+    api_url = urljoin(uri, EXPORT_API)
+    er = SESSION.get(api_url)
+    er.raise_for_status()
+    return dict((item['title'], item) for item in er.json().get('boot_configs', []))
+
+
+def _desired(data):
+    desired = []
+    for item in data['boot_configs']:
+        if not isinstance(item, dict):
+            item = {'title': item}
+        desired.append(dict(item))
+    return desired
+
+
+def _bulk_write(data, method, items):
+    # Atomic, so on any error the server has changed nothing
+    retval = {'failed': True, 'changed': False}
+    api_url = urljoin(data['sbm_uri'], BULK_API) + '?atomic=1'
+    try:
+        resp = method(api_url, json=items)
+    except (ConnectionError, Timeout):
+        retval['msg'] = 'API Failure, is SBM running at the specified URI?'
+        return retval
+    try:
+        body = resp.json()
+    except ValueError:
+        body = {}
+    if resp.status_code != 200 or not body.get('committed'):
+        errors = [r for r in body.get('results', [])
+                  if r.get('status') == 'error']
+        if not errors and 'err' in body:
+            errors = [{'status': 'error', 'err': body['err']}]
+        retval['errors'] = errors
+        retval['msg'] = 'API Error on bulk write: {}'.format('; '.join(
+            '{}: {}'.format(r.get('title'), r.get('err')) for r in errors)
+            or 'HTTP {}'.format(resp.status_code))
+        return retval
+    retval['failed'] = False
+    retval['changed'] = True
+    return retval
+
+
+def _bulk_present(data, check):
+    retval = {'failed': True, 'changed': False}
+    try:
+        current = _get_all(data['sbm_uri'])
+    except (HTTPError, ConnectionError):
+        retval['msg'] = 'API Failure, is SBM running at the specified URI?'
+        return retval
+    changes = []
+    retval['created'] = []
+    retval['updated'] = []
+    for item in _desired(data):
+        new_item = {}
+        for k in BOOT_CONFIG_KEYS:
+            new_item[k] = item.get(k)
+        if new_item['title'] not in current:
+            retval['created'].append(new_item['title'])
+            changes.append(new_item)
+        elif not _compare(current[new_item['title']], new_item):
+            retval['updated'].append(new_item['title'])
+            changes.append(new_item)
+    retval['failed'] = False
+    retval['changed'] = bool(changes)
+    retval['msg'] = 'Successfully confirmed boot_configs'
+    if changes:
+        retval['msg'] = 'Added {} and updated {} boot_configs'.format(
+            len(retval['created']), len(retval['updated']))
+        if not check:
+            retval.update(_bulk_write(data, SESSION.put, changes))
+    return retval
+
+
+def _bulk_absent(data, check):
+    retval = {'failed': True, 'changed': False}
+    try:
+        current = _get_all(data['sbm_uri'])
+    except (HTTPError, ConnectionError):
+        retval['msg'] = 'API Failure, is SBM running at the specified URI?'
+        return retval
+    removed = [item['title'] for item in _desired(data)
+               if item['title'] in current]
+    retval['removed'] = removed
+    retval['failed'] = False
+    retval['changed'] = bool(removed)
+    retval['msg'] = 'Removed {} boot_configs'.format(len(removed))
+    if removed and not check:
+        retval.update(_bulk_write(data, SESSION.delete, removed))
+    return retval
+
+
 def main():
     fields = {
         'sbm_uri': {'required': True, "type": 'str'},
-        'title': {'required': True, 'type': 'str'},
+        'title': {'type': 'str'},
+        'boot_configs': {'type': 'list'},
         'config': {'type': 'str'},
         'state': {
             'required': True,
@@ -160,8 +259,18 @@ def main():
         }
     }
 
-    module = AnsibleModule(argument_spec=fields, supports_check_mode=True)
-    if module.params['state'] == 'present':
+    module = AnsibleModule(
+        argument_spec=fields,
+        supports_check_mode=True,
+        required_one_of=[['title', 'boot_configs']],
+        mutually_exclusive=[['title', 'boot_configs']]
+    )
+    if module.params['boot_configs'] is not None:
+        if module.params['state'] == 'present':
+            response = _bulk_present(module.params, module.check_mode)
+        else:
+            response = _bulk_absent(module.params, module.check_mode)
+    elif module.params['state'] == 'present':
         response = _present(module.params, module.check_mode)
     else:
         response = _absent(module.params, module.check_mode)
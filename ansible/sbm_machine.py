@@ -8,7 +8,12 @@ except ImportError:
 
 from ansible.module_utils.basic import *
 
+# One keep-alive connection pool for every API call in the task
+SESSION = requests.Session()
+
 API_BASE = '/api/v1/machine/'
+BULK_API = '/api/v1/bulk/machine/'
+EXPORT_API = '/api/v1/export/'
 MACHINE_KEYS = [
     'hostname',
     'default_boot',
@@ -20,7 +25,7 @@ MACHINE_KEYS = [
 
 def _get_machines(uri):
     api_url = urljoin(uri, API_BASE)
-    mr = requests.get(api_url)
+    mr = SESSION.get(api_url)
     mr.raise_for_status()
     return mr.json()
 
@@ -28,7 +33,7 @@ def _get_machines(uri):
 def _get(data):
     api_url = urljoin(data['sbm_uri'], API_BASE)
     api_url = urljoin(api_url, data['hostname'] + '/')
-    mr = requests.get(api_url)
+    mr = SESSION.get(api_url)
     mr.raise_for_status()
     return mr.json()
 
@@ -37,7 +42,7 @@ def _remove(data):
     retval = {'failed': True, 'changed': False}
     api_url = urljoin(data['sbm_uri'], API_BASE)
     api_url = urljoin(api_url, data['hostname'] + '/')
-    dr = requests.delete(api_url)
+    dr = SESSION.delete(api_url)
     try:
         resp = dr.json()
         if 'status' not in resp.keys() or resp['status'] != 'ok':
@@ -76,7 +81,7 @@ def _update(data, check):
         retval['msg'] = 'Successfully updated Host'
         retval['changed'] = True
         if not check:
-            resp = requests.post(api_url, json=new_mach)
+            resp = SESSION.post(api_url, json=new_mach)
             if resp.status_code != 200:
                 retval['msg'] = 'API Error on post'
                 retval['failed'] = True
@@ -93,7 +98,7 @@ def _add(data):
     mach = {}
     for key in MACHINE_KEYS:
         mach[key] = data[key]
-    resp = requests.put(api_url, json=mach)
+    resp = SESSION.put(api_url, json=mach)
     if resp.status_code != 200:
         retval['msg'] = 'API Error on put'
         retval['failed'] = True
@@ -150,10 +155,107 @@ def _absent(data, check):
     return retval
 
 
+def _get_all(uri):
+    api_url = urljoin(uri, EXPORT_API)
+    er = SESSION.get(api_url)
+    er.raise_for_status()
+    return dict((item['hostname'], item) for item in er.json().get('machines', []))
+
+
+def _desired(data):
+    desired = []
+    for item in data['machines']:
+        if not isinstance(item, dict):
+            item = {'hostname': item}
+        new_item = {'switch_type': 'switched', 'time_between': 600}
+        new_item.update(item)
+        new_item['time_between'] = int(new_item['time_between'])
+        desired.append(new_item)
+    return desired
+
+
+def _bulk_write(data, method, items):
+    # Atomic, so on any error the server has changed nothing
+    retval = {'failed': True, 'changed': False}
+    api_url = urljoin(data['sbm_uri'], BULK_API) + '?atomic=1'
+    try:
+        resp = method(api_url, json=items)
+    except (ConnectionError, Timeout):
+        retval['msg'] = 'API Failure, is SBM running at the specified URI?'
+        return retval
+    try:
+        body = resp.json()
+    except ValueError:
+        body = {}
+    if resp.status_code != 200 or not body.get('committed'):
+        errors = [r for r in body.get('results', [])
+                  if r.get('status') == 'error']
+        if not errors and 'err' in body:
+            errors = [{'status': 'error', 'err': body['err']}]
+        retval['errors'] = errors
+        retval['msg'] = 'API Error on bulk write: {}'.format('; '.join(
+            '{}: {}'.format(r.get('hostname'), r.get('err')) for r in errors)
+            or 'HTTP {}'.format(resp.status_code))
+        return retval
+    retval['failed'] = False
+    retval['changed'] = True
+    return retval
+
+
+def _bulk_present(data, check):
+    retval = {'failed': True, 'changed': False}
+    try:
+        current = _get_all(data['sbm_uri'])
+    except (HTTPError, ConnectionError):
+        retval['msg'] = 'API Failure, is SBM running at the specified URI?'
+        return retval
+    changes = []
+    retval['created'] = []
+    retval['updated'] = []
+    for item in _desired(data):
+        new_item = {}
+        for k in MACHINE_KEYS:
+            new_item[k] = item.get(k)
+        if new_item['hostname'] not in current:
+            retval['created'].append(new_item['hostname'])
+            changes.append(new_item)
+        elif not _compare(current[new_item['hostname']], new_item):
+            retval['updated'].append(new_item['hostname'])
+            changes.append(new_item)
+    retval['failed'] = False
+    retval['changed'] = bool(changes)
+    retval['msg'] = 'Successfully confirmed hosts'
+    if changes:
+        retval['msg'] = 'Added {} and updated {} hosts'.format(
+            len(retval['created']), len(retval['updated']))
+        if not check:
+            retval.update(_bulk_write(data, SESSION.put, changes))
+    return retval
+
+
+def _bulk_absent(data, check):
+    retval = {'failed': True, 'changed': False}
+    try:
+        current = _get_all(data['sbm_uri'])
+    except (HTTPError, ConnectionError):
+        retval['msg'] = 'API Failure, is SBM running at the specified URI?'
+        return retval
+    removed = [item['hostname'] for item in _desired(data)
+               if item['hostname'] in current]
+    retval['removed'] = removed
+    retval['failed'] = False
+    retval['changed'] = bool(removed)
+    retval['msg'] = 'Removed {} hosts'.format(len(removed))
+    if removed and not check:
+        retval.update(_bulk_write(data, SESSION.delete, removed))
+    return retval
+
+
 def main():
     fields = {
         'sbm_uri': {'required': True, "type": 'str'},
-        'hostname': {'required': True, 'type': 'str'},
+        'hostname': {'type': 'str'},
+        'machines': {'type': 'list'},
         'default_boot': {'type': 'str'},
         'alternate_boot': {'type': 'str'},
         'switch_type': {
@@ -172,8 +274,18 @@ def main():
         }
     }
 
-    module = AnsibleModule(argument_spec=fields, supports_check_mode=True)
-    if module.params['state'] == 'present':
+    module = AnsibleModule(
+        argument_spec=fields,
+        supports_check_mode=True,
+        required_one_of=[['hostname', 'machines']],
+        mutually_exclusive=[['hostname', 'machines']]
+    )
+    if module.params['machines'] is not None:
+        if module.params['state'] == 'present':
+            response = _bulk_present(module.params, module.check_mode)
+        else:
+            response = _bulk_absent(module.params, module.check_mode)
+    elif module.params['state'] == 'present':
         response = _present(module.params, module.check_mode)
     else:
         response = _absent(module.params, module.check_mode)
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sqlalchemy
+from sbm import sbm
+
+SWITCH_TYPES = ['switched', 'alternating', 'timed']
+STORAGE_MODES = {
+    # The settings SBM shipped with before the storage engine was tunable
+    'legacy': {
+        'SBM_SQLITE_JOURNAL_MODE': None,
+        'SBM_SQLITE_SYNCHRONOUS': None,
+        'SBM_SQLITE_BUSY_TIMEOUT': None,
+        'SBM_SQLITE_MMAP_SIZE': None,
+        'SBM_DB_POOL_SIZE': 0
+    },
+    'tuned': {},
+    'wal-full': {'SBM_SQLITE_SYNCHRONOUS': 'full'},
+    'wal-nopool': {'SBM_DB_POOL_SIZE': 0}
+}
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples, elapsed):
+    return {
+        'requests': len(samples),
+        'throughput': len(samples) / elapsed if elapsed else None,
+        'p50_ms': percentile(samples, 50),
+        'p95_ms': percentile(samples, 95),
+        'p99_ms': percentile(samples, 99),
+        'max_ms': max(samples) if samples else None
+    }
+
+
+def address_for(index):
+    return '10.{}.{}.{}'.format(index // 65536 % 256, index // 256 % 256,
+                                index % 256)
+
+
+def setup_database():
+    sbm.db.drop_all()
+    sbm.db.create_all()
+
+
+def seed(machines, boot_configs, variables):
+    hosts = {}
+    for i in range(variables):
+        sbm.db.session.add(sbm.Variable('var{}'.format(i), str(i)))
+    placeholders = ' '.join(
+        '{{var{}}}'.format(i) for i in range(min(variables, 8)))
+    for i in range(boot_configs):
+        sbm.db.session.add(sbm.BootConfig(
+            'config{}'.format(i),
+            '#!ipxe\nkernel http://boot/{} {}\nboot\n'.format(
+                i, placeholders)))
+    sbm.db.session.commit()
+    configs = sbm.BootConfig.query.all()
+    for i in range(machines):
+        hostname = 'node{:05d}'.format(i)
+        machine = sbm.Machine(
+            hostname,
+            configs[i % len(configs)],
+            configs[(i + 1) % len(configs)],
+            SWITCH_TYPES[i % len(SWITCH_TYPES)]
+        )
+        sbm.db.session.add(machine)
+        hosts[address_for(i)] = (hostname + '.cluster',
+                                 SWITCH_TYPES[i % len(SWITCH_TYPES)])
+    sbm.db.session.commit()
+    sbm.variable_snapshot.invalidate()
+    sbm.render_cache.invalidate()
+    sbm.boot_state.invalidate()
+    # Static entries take the place of DNS so the benchmark runs offline
+    sbm.resolver.clear()
+    sbm.resolver.load_static_hosts(
+        {address: host[0] for address, host in hosts.items()})
+    return hosts
+
+
+def run_storm(app, hosts, path, concurrency):
+    local = threading.local()
+    results = {switch_type: [] for switch_type in SWITCH_TYPES}
+    errors = [0]
+    lock = threading.Lock()
+
+    def fire(item):
+        address, (hostname, switch_type) = item
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        start = time.perf_counter()
+        resp = client.get(path, environ_base={'REMOTE_ADDR': address})
+        elapsed = (time.perf_counter() - start) * 1000.0
+        with lock:
+            if resp.status_code != 200:
+                errors[0] += 1
+            results[switch_type].append(elapsed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(fire, hosts.items()))
+    elapsed = time.perf_counter() - start
+    report = {
+        switch_type: summarize(samples, elapsed)
+        for switch_type, samples in results.items()
+    }
+    report['all'] = summarize(sum(results.values(), []), elapsed)
+    report['all']['errors'] = errors[0]
+    return report
+
+
+def time_calls(fn, iterations):
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - start) * 1000.0)
+    report = summarize(samples, sum(samples) / 1000.0)
+    report['mean_ms'] = sum(samples) / len(samples)
+    return report
+
+
+def run_micro(hosts, iterations):
+    hostnames = [host[0].split('.')[0] for host in hosts.values()]
+    report = {}
+    machine = sbm.get_machine_definition(hostnames[0])
+    boot_config = machine.default_boot
+    generation, variables = sbm.variable_snapshot.snapshot()
+    # Resolved once like the boot path does, so only the render is timed
+    render_cache = sbm.get_components().render_cache
+
+    report['machine_lookup'] = time_calls(
+        lambda i: sbm.get_machine_definition(
+            hostnames[i % len(hostnames)]).default_boot.config,
+        iterations)
+    report['variable_load'] = time_calls(
+        lambda i: sbm.load_variables(), iterations)
+    report['variable_snapshot'] = time_calls(
+        lambda i: sbm.variable_snapshot.snapshot(), iterations)
+    report['render_format'] = time_calls(
+        lambda i: boot_config.config.format(**variables), iterations)
+    report['render_cold'] = time_calls(
+        lambda i: (render_cache.invalidate(boot_config.title),
+                   render_cache.render(
+                       boot_config.title, boot_config.config,
+                       variables, generation)),
+        iterations)
+    report['render_cached'] = time_calls(
+        lambda i: render_cache.render(
+            boot_config.title, boot_config.config, variables, generation),
+        iterations)
+
+    def commit(i):
+        # The target the boot path would use: a host record for the
+        # memory engine, which must not be an ORM row the session
+        # autoflushes while the writer holds the database
+        machine, state = sbm.get_machine_state(
+            hostnames[i % len(hostnames)])
+        sbm.set_machine_state(machine, last_boot=datetime.datetime.now())
+
+    # Nothing read above may keep a transaction open during the writes
+    sbm.db.session.commit()
+    report['commit'] = time_calls(commit, iterations)
+    sbm.state_writer.flush()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate a boot storm against the SBM boot endpoints')
+    parser.add_argument('--machines', type=int, default=2000)
+    parser.add_argument('--boot-configs', type=int, default=8)
+    parser.add_argument('--variables', type=int, default=32)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--iterations', type=int, default=500,
+                        help='iterations per micro-benchmark')
+    parser.add_argument('--write-mode', default='immediate',
+                        choices=['immediate', 'group', 'deferred'])
+    parser.add_argument('--engine', default='orm',
+                        choices=['orm', 'memory', 'sql'])
+    parser.add_argument('--storage', default='tuned',
+                        choices=sorted(STORAGE_MODES))
+    parser.add_argument('--database', default=None,
+                        help='SQLAlchemy URI, defaults to a temporary SQLite file')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+    tmpdir = None
+    database = args.database
+    if database is None:
+        tmpdir = tempfile.mkdtemp(prefix='sbm-bench-')
+        database = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+    app = sbm.create_app(dict(
+        STORAGE_MODES[args.storage],
+        SQLALCHEMY_DATABASE_URI=database,
+        SBM_STATE_WRITE_MODE=args.write_mode,
+        SBM_BOOT_ENGINE=args.engine
+    ))
+    # The module's components resolve to this app's from here on
+    app.app_context().push()
+    setup_database()
+    hosts = seed(args.machines, args.boot_configs, args.variables)
+
+    report = {
+        'benchmark': 'boot_storm',
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'parameters': dict(vars(args), database=database.split(':')[0]),
+        'boot': run_storm(app, hosts, '/api/v1/boot/', args.concurrency),
+        'finished': run_storm(app, hosts, '/api/v1/boot/finished/',
+                              args.concurrency),
+        'micro': run_micro(hosts, args.iterations)
+    }
+    sbm.state_writer.flush()
+    report['resolver'] = sbm.resolver.stats()
+    with sbm.db.get_engine().connect() as conn:
+        report['storage'] = {
+            'pool': type(conn.engine.pool).__name__
+        }
+        if conn.engine.dialect.name == 'sqlite':
+            for pragma in ['journal_mode', 'synchronous', 'busy_timeout',
+                           'mmap_size']:
+                report['storage'][pragma] = conn.execute(
+                    'PRAGMA {}'.format(pragma)).scalar()
+    report['state_writer'] = sbm.state_writer.stats()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+    if tmpdir is not None:
+        # Write the queued boot events now, the exit hook would find the
+        # database gone
+        sbm.boot_events.stop()
+        sbm.db.get_engine().dispose()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
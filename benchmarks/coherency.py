@@ -0,0 +1,233 @@
+#!/usr/bin/python
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ENGINES = ['orm', 'sql', 'memory']
+WRITE_MODES = ['immediate', 'group', 'deferred']
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def serve(args):
+    # Runs in a worker process, the parent sets SBM_DATABASE_URI first
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    from werkzeug.serving import make_server
+    from sbm import create_app
+    app = create_app({
+        'SBM_BOOT_ENGINE': args.engine,
+        'SBM_STATE_WRITE_MODE': args.write_mode,
+        'SBM_CACHE_COHERENCY': not args.no_coherency
+    })
+    make_server('127.0.0.1', args.serve, app, threaded=True).serve_forever()
+
+
+def call(port, path, method='GET', data=None):
+    body = None
+    headers = {}
+    if data is not None:
+        body = json.dumps(data).encode('utf8')
+        headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(
+        'http://127.0.0.1:{}{}'.format(port, path), data=body,
+        headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return response.status, response.read().decode('utf8')
+    except urllib.error.HTTPError as ex:
+        return ex.code, ex.read().decode('utf8')
+
+
+def wait_ready(port, deadline):
+    while time.time() < deadline:
+        try:
+            call(port, '/api/v1/variable/')
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    raise RuntimeError('Worker on port {} did not start'.format(port))
+
+
+def seed(port):
+    for title, text in [('a', 'A {x}'), ('b', 'B {x}')]:
+        call(port, '/api/v1/boot_config/', 'PUT',
+             {'title': title, 'config': '#!ipxe\n{}\n'.format(text)})
+    call(port, '/api/v1/variable/', 'PUT', {'key': 'x', 'value': '0'})
+    for i, switch_type in enumerate(['switched', 'alternating']):
+        call(port, '/api/v1/machine/', 'PUT', {
+            'hostname': switch_type,
+            'default_boot': 'a',
+            'alternate_boot': 'b',
+            'switch_type': switch_type,
+            'time_between': 600,
+            'mac': '52:54:00:00:00:{:02x}'.format(i)
+        })
+
+
+def expect_everywhere(ports, path, expected):
+    # The write went to one worker, every worker has to see it straight away
+    seen = [call(port, path)[1].strip() for port in ports]
+    return all(value == expected for value in seen), seen
+
+
+def run_checks(ports, write_mode):
+    results = []
+    writer = ports[0]
+
+    for i in range(1, 4):
+        call(ports[i % len(ports)], '/api/v1/variable/x/', 'POST',
+             {'key': 'x', 'value': str(i)})
+        ok, seen = expect_everywhere(
+            ports, '/api/v1/boot/test/switched/', '#!ipxe\nA {}'.format(i))
+        results.append(('variable update {}'.format(i), ok, seen))
+
+    call(writer, '/api/v1/boot_config/a/', 'POST',
+         {'title': 'a', 'config': '#!ipxe\nA2 {x}\n'})
+    ok, seen = expect_everywhere(
+        ports, '/api/v1/boot/test/switched/', '#!ipxe\nA2 3')
+    results.append(('boot config update', ok, seen))
+
+    call(writer, '/api/v1/machine/switched/', 'POST', {
+        'hostname': 'switched', 'default_boot': 'b', 'alternate_boot': 'a',
+        'switch_type': 'switched', 'time_between': 600,
+        'mac': '52:54:00:00:00:00'})
+    ok, seen = expect_everywhere(
+        ports, '/api/v1/boot/test/switched/', '#!ipxe\nB 3')
+    results.append(('machine update', ok, seen))
+
+    status, body = call(writer, '/api/v1/machine_group/', 'PUT', {
+        'name': 'rack', 'pattern': 'r[1-4]', 'default_boot': 'b',
+        'alternate_boot': 'a', 'switch_type': 'switched',
+        'time_between': 600})
+    ok, seen = expect_everywhere(
+        ports, '/api/v1/boot/test/r2/', '#!ipxe\nB 3')
+    results.append(('machine group added', ok and status == 200, seen))
+
+    # An alternating machine booted round robin across the workers has to
+    # keep alternating, which needs every worker to see the last boot.
+    # Deferred writes only leave the worker when they are flushed
+    served = []
+    for i in range(2 * len(ports)):
+        served.append(call(
+            ports[i % len(ports)],
+            '/api/v1/boot/?mac=52:54:00:00:00:01')[1].split('\n')[1][0])
+        if write_mode == 'deferred':
+            time.sleep(0.5)
+    expected = ['A', 'B'] * len(ports)
+    results.append(('alternating boots', served == expected, served))
+    return results
+
+
+def time_reads(ports, count):
+    start = time.perf_counter()
+    for i in range(count):
+        call(ports[i % len(ports)], '/api/v1/boot/test/switched/')
+    return (time.perf_counter() - start) / count * 1000
+
+
+def run(args, engine, write_mode, directory):
+    uri = 'sqlite:///{}'.format(os.path.join(
+        directory, '{}-{}.db'.format(engine, write_mode)))
+    env = dict(os.environ, SBM_DATABASE_URI=uri)
+    ports = [free_port() for i in range(args.workers)]
+    workers = []
+    try:
+        deadline = time.time() + 30
+        for i, port in enumerate(ports):
+            command = [sys.executable, os.path.abspath(__file__),
+                       '--serve', str(port), '--engine', engine,
+                       '--write-mode', write_mode]
+            if args.no_coherency:
+                command.append('--no-coherency')
+            workers.append(subprocess.Popen(
+                command, env=env, cwd=directory,
+                stderr=subprocess.DEVNULL if not args.verbose else None))
+            if i == 0:
+                # Let the first worker create the tables alone
+                wait_ready(port, deadline)
+        for port in ports:
+            wait_ready(port, deadline)
+        seed(ports[0])
+        results = run_checks(ports, write_mode)
+        read_ms = time_reads(ports, args.reads)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+    return {
+        'engine': engine,
+        'write_mode': write_mode,
+        'passed': all(ok for name, ok, seen in results),
+        'checks': [{'check': name, 'ok': ok, 'seen': seen}
+                   for name, ok, seen in results],
+        'read_ms': read_ms
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that several worker processes sharing one '
+                    'database never serve each other\'s stale caches')
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--engines', nargs='+', default=ENGINES,
+                        choices=ENGINES)
+    parser.add_argument('--write-modes', nargs='+', default=['immediate'],
+                        choices=WRITE_MODES)
+    parser.add_argument('--reads', type=int, default=300,
+                        help='test renders to time after the checks')
+    parser.add_argument('--no-coherency', action='store_true',
+                        help='turn the check off, to see what it prevents')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--engine', default='orm', help=argparse.SUPPRESS)
+    parser.add_argument('--write-mode', default='immediate',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    directory = tempfile.mkdtemp(prefix='sbm-coherency-')
+    try:
+        reports = [run(args, engine, write_mode, directory)
+                   for engine in args.engines
+                   for write_mode in args.write_modes]
+    finally:
+        shutil.rmtree(directory)
+    for report in reports:
+        sys.stderr.write('{:<8} {:<10} {:<6} {:.2f} ms/read\n'.format(
+            report['engine'], report['write_mode'],
+            'ok' if report['passed'] else 'FAILED', report['read_ms']))
+        for check in report['checks']:
+            if not check['ok']:
+                sys.stderr.write('    {}: {}\n'.format(
+                    check['check'],
+                    [seen.splitlines()[-1][:120] if seen else seen
+                     for seen in check['seen']]))
+    output = json.dumps(reports, indent=2)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output)
+    else:
+        print(output)
+    sys.exit(0 if all(report['passed'] for report in reports) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BOOT_PATH = '/api/v1/boot/?mac=52:54:00:00:00:01'
+
+
+def median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2] if samples else None
+
+
+def first_boot(app):
+    client = app.test_client()
+    response = client.get(BOOT_PATH)
+    if response.status_code != 200:
+        raise RuntimeError('Boot failed with {}: {}'.format(
+            response.status_code, response.data))
+
+
+def prepare():
+    # Runs in a child process, the parent sets SBM_DATABASE_URI first
+    sys.path.insert(0, ROOT)
+    from sbm import create_app
+    client = create_app().test_client()
+    client.put('/api/v1/boot_config/', json={
+        'title': 'a', 'config': '#!ipxe\nkernel http://boot/a\n'})
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'a',
+        'switch_type': 'switched', 'time_between': 600,
+        'mac': '52:54:00:00:00:01'})
+
+
+def fresh():
+    # One worker started from nothing, as a process manager spawning it
+    start = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    from sbm import create_app
+    app = create_app()
+    imported = time.perf_counter()
+    first_boot(app)
+    done = time.perf_counter()
+    print(json.dumps({'import_ms': (imported - start) * 1000,
+                      'first_boot_ms': (done - imported) * 1000}))
+
+
+def preload(count):
+    # Import and migrate once, then fork workers the way a preloading
+    # server does
+    sys.path.insert(0, ROOT)
+    from sbm import create_app
+    from sbm.sbm import ensure_schema
+    app = create_app()
+    with app.app_context():
+        ensure_schema()
+    samples = []
+    for i in range(count):
+        read_fd, write_fd = os.pipe()
+        start = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                first_boot(app)
+                os.write(write_fd, b'ok')
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as reader:
+            ok = reader.read() == b'ok'
+        samples.append((time.perf_counter() - start) * 1000)
+        os.waitpid(pid, 0)
+        if not ok:
+            raise RuntimeError('Forked worker failed to boot a machine')
+    print(json.dumps({'fork_to_first_boot_ms': samples}))
+
+
+def run_child(mode, env, *args):
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', mode] +
+        [str(arg) for arg in args], env=env)
+    return json.loads(output.decode('utf8').strip().splitlines()[-1]) \
+        if output.strip() else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure how long a new worker takes to serve its first '
+                    'boot, started from scratch or forked from a preloaded '
+                    'parent')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--child', choices=['prepare', 'fresh', 'preload'],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('count', nargs='?', type=int,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child == 'prepare':
+        return prepare()
+    if args.child == 'fresh':
+        return fresh()
+    if args.child == 'preload':
+        return preload(args.count)
+
+    directory = tempfile.mkdtemp(prefix='sbm-cold-start-')
+    try:
+        env = dict(os.environ, SBM_DATABASE_URI='sqlite:///{}'.format(
+            os.path.join(directory, 'sbm.db')))
+        run_child('prepare', env)
+        spawned = []
+        imports = []
+        first_boots = []
+        for i in range(args.runs):
+            start = time.perf_counter()
+            result = run_child('fresh', env)
+            spawned.append((time.perf_counter() - start) * 1000)
+            imports.append(result['import_ms'])
+            first_boots.append(result['first_boot_ms'])
+        forked = run_child('preload', env, args.runs)
+    finally:
+        shutil.rmtree(directory)
+    print(json.dumps({
+        'runs': args.runs,
+        'fresh': {
+            'process_ms': median(spawned),
+            'import_ms': median(imports),
+            'first_boot_ms': median(first_boots)
+        },
+        'forked': {
+            'first_boot_ms': median(forked['fork_to_first_boot_ms'])
+        }
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
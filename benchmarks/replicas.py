@@ -0,0 +1,149 @@
+#!/usr/bin/python
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from coherency import call, free_port, seed, wait_ready
+
+COHERENCY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'coherency.py')
+
+
+def start(directory, name, port, engine, primary=None, verbose=False):
+    env = dict(os.environ, SBM_DATABASE_URI='sqlite:///{}'.format(
+        os.path.join(directory, name + '.db')))
+    if primary is not None:
+        env['SBM_REPLICA_OF'] = 'http://127.0.0.1:{}'.format(primary)
+    return subprocess.Popen(
+        [sys.executable, COHERENCY, '--serve', str(port), '--engine', engine],
+        env=env, cwd=directory,
+        stderr=None if verbose else subprocess.DEVNULL)
+
+
+def converge(ports, path, expected, timeout):
+    # Replicas apply the primary's changes asynchronously, time how long
+    # each one takes to serve the new content
+    start = time.perf_counter()
+    lags = {}
+    while len(lags) < len(ports) and time.perf_counter() - start < timeout:
+        for port in ports:
+            if port not in lags and \
+                    call(port, path)[1].strip() == expected:
+                lags[port] = (time.perf_counter() - start) * 1000
+        time.sleep(0.01)
+    return len(lags) == len(ports), [lags.get(port) for port in ports]
+
+
+def run_checks(primary, replicas, args):
+    results = []
+    seed(primary)
+    ok, lags = converge(replicas, '/api/v1/boot/test/switched/',
+                        '#!ipxe\nA 0', args.timeout)
+    results.append(('bootstrap and seed', ok, lags))
+
+    for i in range(1, 4):
+        call(primary, '/api/v1/variable/x/', 'POST',
+             {'key': 'x', 'value': str(i)})
+        ok, lags = converge(replicas, '/api/v1/boot/test/switched/',
+                            '#!ipxe\nA {}'.format(i), args.timeout)
+        results.append(('variable update {}'.format(i), ok, lags))
+
+    call(primary, '/api/v1/machine_group/', 'PUT', {
+        'name': 'rack', 'pattern': 'r[1-4]', 'default_boot': 'b',
+        'alternate_boot': 'a', 'switch_type': 'switched',
+        'time_between': 600})
+    ok, lags = converge(replicas, '/api/v1/boot/test/r2/', '#!ipxe\nB 3',
+                        args.timeout)
+    results.append(('machine group added', ok, lags))
+
+    status, body = call(replicas[0], '/api/v1/variable/x/', 'POST',
+                        {'key': 'x', 'value': 'local'})
+    results.append(('replica refuses writes', status == 403, [status]))
+
+    # Boots land on the replicas round robin, their state goes back to
+    # the primary and from there to the other replicas
+    served = []
+    for i in range(2 * len(replicas)):
+        served.append(call(
+            replicas[i % len(replicas)],
+            '/api/v1/boot/?mac=52:54:00:00:00:01')[1].split('\n')[1][0])
+        time.sleep(args.settle)
+    results.append(('alternating boots', served ==
+                    ['A', 'B'] * len(replicas), served))
+    machine = json.loads(call(primary, '/api/v1/machine/alternating/')[1])
+    results.append(('state reached the primary',
+                    machine['use_alternate'] is False,
+                    [machine['use_alternate'], machine['last_boot']]))
+    return results
+
+
+def time_boots(ports, count):
+    start = time.perf_counter()
+    for i in range(count):
+        call(ports[i % len(ports)], '/api/v1/boot/?mac=52:54:00:00:00:00')
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a primary and several read-only replicas locally '
+                    'and check that boots and changes flow between them')
+    parser.add_argument('--replicas', type=int, default=2)
+    parser.add_argument('--engine', default='orm',
+                        choices=['orm', 'sql', 'memory'])
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='seconds a replica may take to catch up')
+    parser.add_argument('--settle', type=float, default=1.0,
+                        help='seconds between round robin boots, enough '
+                             'for a forward and a feed round trip')
+    parser.add_argument('--boots', type=int, default=300)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='sbm-replicas-')
+    processes = []
+    try:
+        primary = free_port()
+        processes.append(start(directory, 'primary', primary, args.engine,
+                               verbose=args.verbose))
+        deadline = time.time() + 30
+        wait_ready(primary, deadline)
+        replicas = [free_port() for i in range(args.replicas)]
+        for i, port in enumerate(replicas):
+            processes.append(start(directory, 'replica{}'.format(i), port,
+                                   args.engine, primary, args.verbose))
+        for port in replicas:
+            wait_ready(port, deadline)
+        results = run_checks(primary, replicas, args)
+        report = {
+            'engine': args.engine,
+            'replicas': args.replicas,
+            'passed': all(ok for name, ok, detail in results),
+            'checks': [{'check': name, 'ok': ok, 'detail': detail}
+                       for name, ok, detail in results],
+            'boots_per_second': {
+                'primary': time_boots([primary], args.boots),
+                'replicas': time_boots(replicas, args.boots)
+            }
+        }
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        shutil.rmtree(directory)
+    for check in report['checks']:
+        sys.stderr.write('{:<28} {:<6} {}\n'.format(
+            check['check'], 'ok' if check['ok'] else 'FAILED',
+            check['detail']))
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['passed'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from boot_storm import STORAGE_MODES
+
+BOOT_STORM = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'boot_storm.py')
+COLUMNS = ['throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'errors']
+
+
+def run_mode(mode, args):
+    command = [
+        sys.executable, BOOT_STORM,
+        '--storage', mode,
+        '--machines', str(args.machines),
+        '--concurrency', str(args.concurrency),
+        '--iterations', str(args.iterations),
+        '--write-mode', args.write_mode
+    ]
+    if args.database:
+        command.extend(['--database', args.database])
+    # Each mode gets a fresh process, so no engine or pool is shared
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf8'))
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return '{:.2f}'.format(value)
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare storage engine settings under a boot storm')
+    parser.add_argument('--modes', nargs='+', default=sorted(STORAGE_MODES),
+                        choices=sorted(STORAGE_MODES))
+    parser.add_argument('--machines', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--write-mode', default='immediate',
+                        choices=['immediate', 'group', 'deferred'])
+    parser.add_argument('--database', default=None,
+                        help='SQLAlchemy URI, defaults to a temporary SQLite '
+                             'file per mode')
+    parser.add_argument('--output', default=None,
+                        help='write the JSON reports here')
+    args = parser.parse_args()
+
+    reports = {}
+    rows = []
+    for mode in args.modes:
+        report = reports[mode] = run_mode(mode, args)
+        for endpoint in ['boot', 'finished']:
+            summary = report[endpoint]['all']
+            rows.append([mode, endpoint] + [
+                format_value(summary.get(column)) for column in COLUMNS])
+    header = ['storage', 'endpoint'] + COLUMNS
+    widths = [max(len(row[i]) for row in rows + [header])
+              for i in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)))
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(json.dumps(reports, indent=2, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
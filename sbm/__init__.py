@@ -1 +1,12 @@
-from .sbm import app
+from .sbm import create_app
+from . import sbm
+from . import bulk
+from . import inventory
+
+
+def __getattr__(name):
+    # The default app lives in sbm.sbm, where older setups look for it
+    if name != 'app':
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+    return sbm.app
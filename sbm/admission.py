@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class AdmissionGate(object):
+    # Caps the requests working at once. Up to queue_size more wait their
+    # turn for at most timeout seconds, anything beyond is turned away
+    def __init__(self, limit, queue_size=0, timeout=1.0):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._queued = 0
+        self._stats = {'admitted': 0, 'queue_full': 0, 'timeout': 0,
+                       'queue_seconds': 0.0}
+
+    def acquire(self):
+        with self._cond:
+            if self._active < self.limit:
+                self._active += 1
+                self._stats['admitted'] += 1
+                return None
+            if self._queued >= self.queue_size:
+                self._stats['queue_full'] += 1
+                return 'queue_full'
+            self._queued += 1
+            start = time.monotonic()
+            try:
+                admitted = self._cond.wait_for(
+                    lambda: self._active < self.limit, self.timeout)
+            finally:
+                self._queued -= 1
+                self._stats['queue_seconds'] += time.monotonic() - start
+            if not admitted:
+                self._stats['timeout'] += 1
+                return 'timeout'
+            self._active += 1
+            self._stats['admitted'] += 1
+            return None
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['active'] = self._active
+            stats['queued'] = self._queued
+        stats['limit'] = self.limit
+        stats['queue_size'] = self.queue_size
+        return stats
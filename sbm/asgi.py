@@ -0,0 +1,219 @@
+import asyncio
+import io
+import socket
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from flask import json
+
+from .sbm import create_app, get_components, Machine
+
+app = create_app()
+app.config.setdefault('SBM_ASGI_BOOT_WORKERS', 16)
+app.config.setdefault('SBM_ASGI_DNS_WORKERS', 8)
+app.config.setdefault('SBM_ASGI_ADMIN_WORKERS', 4)
+app.config.setdefault('SBM_ASGI_WATCH_WORKERS', 64)
+
+RESOLVED_PATHS = ['/api/v1/boot/', '/api/v1/boot/finished/']
+BOOT_PREFIX = '/api/v1/boot/'
+WATCH_PATHS = ['/api/v1/changes/']
+STREAM_BUFFER = 8
+
+
+def build_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode(
+            'latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+class AsyncBootServer(object):
+    def __init__(self, wsgi_app, boot_workers=16, dns_workers=8,
+                 admin_workers=4, watch_workers=64):
+        self.wsgi_app = wsgi_app
+        # Pool threads have no app context, so take the app's own parts
+        self.components = get_components(wsgi_app)
+        self._boot = ThreadPoolExecutor(
+            max_workers=boot_workers, thread_name_prefix='sbm-boot')
+        self._dns = ThreadPoolExecutor(
+            max_workers=dns_workers, thread_name_prefix='sbm-dns')
+        self._admin = ThreadPoolExecutor(
+            max_workers=admin_workers, thread_name_prefix='sbm-admin')
+        # Long-polls sit idle for most of their life, keep them from
+        # starving the admin pool
+        self._watch = ThreadPoolExecutor(
+            max_workers=watch_workers, thread_name_prefix='sbm-watch')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_running_loop().run_in_executor(
+                    self._admin, self.components.state_writer.stop)
+                for executor in [self._boot, self._dns, self._admin,
+                                 self._watch]:
+                    executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        path = scope['path']
+        executor = self._admin
+        if path.startswith(BOOT_PREFIX):
+            executor = self._boot
+        elif path in WATCH_PATHS:
+            executor = self._watch
+        query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+        identified = any(query.get(kind) for kind in Machine._identifiers)
+        if path in RESOLVED_PATHS and scope.get('client') and not identified:
+            # Warm the resolver cache off the boot workers, so a slow
+            # DNS server only ties up the smaller DNS pool
+            try:
+                await loop.run_in_executor(
+                    self._dns, self.components.resolver.resolve,
+                    scope['client'][0])
+            except socket.herror as ex:
+                await self.send_error(send, 404, traceback.format_exc())
+                return
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        environ = build_environ(scope, b''.join(body))
+        queue = asyncio.Queue(maxsize=STREAM_BUFFER)
+        worker = loop.run_in_executor(
+            executor, self.run_wsgi, environ, loop, queue)
+        connected = True
+        started = False
+        while True:
+            item = await queue.get()
+            if not connected:
+                if item[0] == 'end':
+                    break
+                continue
+            try:
+                if item[0] == 'start':
+                    started = True
+                    await send({
+                        'type': 'http.response.start',
+                        'status': int(item[1].split(' ', 1)[0]),
+                        'headers': [
+                            (name.lower().encode('latin1'),
+                             value.encode('latin1'))
+                            for name, value in item[2]
+                        ]
+                    })
+                elif item[0] == 'body':
+                    await send({
+                        'type': 'http.response.body',
+                        'body': item[1],
+                        'more_body': True
+                    })
+                elif item[0] == 'error':
+                    if started:
+                        await send({'type': 'http.response.body', 'body': b''})
+                    else:
+                        await self.send_error(send, 500, item[1])
+                    connected = False
+                elif item[0] == 'end':
+                    await send({'type': 'http.response.body', 'body': b''})
+                    break
+            except Exception:
+                # The client went away, keep draining so the worker finishes
+                connected = False
+        await worker
+
+    def run_wsgi(self, environ, loop, queue):
+        # The whole response is produced on this one thread, so streamed
+        # responses keep their request context and database session
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            put(('start', status, headers))
+
+        try:
+            app_iter = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in app_iter:
+                    if chunk:
+                        put(('body', chunk))
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        except Exception:
+            put(('error', traceback.format_exc()))
+        put(('end',))
+
+    async def send_error(self, send, status, err):
+        body = json.dumps({'err': err}).encode('utf8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode('latin1'))
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def get_pool_size(app, workers, gate_name):
+    # Let requests queue in the admission gate, which has a deadline,
+    # rather than without bound on the event loop
+    if not app.config['SBM_ADMISSION_CONTROL']:
+        return workers
+    gate = get_components(app).admission_gates[gate_name]
+    return max(workers, gate.limit + gate.queue_size)
+
+
+application = AsyncBootServer(
+    app,
+    boot_workers=get_pool_size(app, app.config['SBM_ASGI_BOOT_WORKERS'],
+                               'boot'),
+    dns_workers=app.config['SBM_ASGI_DNS_WORKERS'],
+    admin_workers=get_pool_size(app, app.config['SBM_ASGI_ADMIN_WORKERS'],
+                                'management'),
+    watch_workers=app.config['SBM_ASGI_WATCH_WORKERS']
+)
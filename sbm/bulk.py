@@ -0,0 +1,438 @@
+from flask import current_app, jsonify, make_response, request
+
+from .matcher import HostMatcher
+from .sbm import blueprint, db, BootConfig, HostState, Machine, MachineGroup
+from .sbm import Variable
+from .sbm import change_row, normalize_identifier, record_changes
+from .sbm import change_notifier, render_cache, mark_scripts
+from .sbm import state_writer, update_state_engine, variable_snapshot
+
+import datetime
+import sys
+import traceback
+
+# Stay below SQLite's limit on bound parameters per statement
+IN_CHUNK = 500
+
+
+def get_definitions(model, column, values):
+    values = list(set(v for v in values if isinstance(v, str)))
+    definitions = {}
+    for i in range(0, len(values), IN_CHUNK):
+        for definition in model.query.filter(
+                column.in_(values[i:i + IN_CHUNK])):
+            definitions[getattr(definition, column.key)] = definition
+    return definitions
+
+
+def item_key(item, key):
+    if isinstance(item, dict):
+        return item.get(key)
+    return item
+
+
+def apply_bulk(key, items, apply_item, atomic=False):
+    # Items only touch the session once they are known to be valid, so
+    # a failed item leaves nothing behind when the rest are committed
+    results = []
+    seen = set()
+    for item in items:
+        result = {key: item_key(item, key)}
+        try:
+            if result[key] in seen:
+                raise ValueError('{} {} appears more than once'.format(
+                    key, repr(result[key])))
+            seen.add(result[key])
+            result['status'] = apply_item(item)
+        except Exception:
+            result['status'] = 'error'
+            result['err'] = ''.join(
+                traceback.format_exception_only(*sys.exc_info()[:2])).strip()
+        results.append(result)
+    if atomic and any(r['status'] == 'error' for r in results):
+        db.session.rollback()
+        for result in results:
+            if result['status'] != 'error':
+                result['status'] = 'rolled_back'
+        return False, results
+    try:
+        db.session.commit()
+    except Exception as ex:
+        db.session.rollback()
+        current_app.logger.exception('Failed to commit a bulk request')
+        # The driver's message, without the statement and its parameters
+        ex = getattr(ex, 'orig', None) or ex
+        err = 'Batch not committed: {}: {}'.format(type(ex).__name__, ex)
+        for result in results:
+            if result['status'] != 'error':
+                result['status'] = 'error'
+                result['err'] = err
+        return False, results
+    return True, results
+
+
+def get_existing(definitions, kind, key):
+    if key not in definitions:
+        raise KeyError('Unknown {} {}'.format(kind, repr(key)))
+    return definitions[key]
+
+
+def set_machine_definitions(mdjsons, atomic=False):
+    machines = get_definitions(
+        Machine, Machine.hostname,
+        [item_key(md, 'hostname') for md in mdjsons])
+    boot_configs = get_definitions(
+        BootConfig, BootConfig.title,
+        [item_key(md, k) for md in mdjsons
+         for k in ['default_boot', 'alternate_boot']])
+
+    def apply_item(mdjson):
+        hostname = mdjson['hostname']
+        refs = {}
+        for k in ['default_boot', 'alternate_boot']:
+            refs[k] = get_existing(boot_configs, 'boot config', mdjson[k])
+        switch_type = Machine._switch_type.index(mdjson['switch_type'])
+        time_between = int(mdjson['time_between'])
+        # Identifiers left out of the request are left alone
+        identifiers = dict(
+            (kind, normalize_identifier(kind, mdjson[kind]))
+            for kind in Machine._identifiers if kind in mdjson)
+        md = machines.get(hostname)
+        status = 'updated'
+        if md is None:
+            md = Machine(hostname, refs['default_boot'],
+                         refs['alternate_boot'], mdjson['switch_type'])
+            db.session.add(md)
+            status = 'created'
+        md.default_boot = refs['default_boot']
+        md.alternate_boot = refs['alternate_boot']
+        md.switch_type = switch_type
+        md.time_between = time_between
+        for kind, value in identifiers.items():
+            setattr(md, kind, value)
+        return status
+
+    committed, results = apply_bulk('hostname', mdjsons, apply_item, atomic)
+    if committed:
+        update_state_engine(
+            hostnames=[result['hostname'] for result in results])
+    return committed, results
+
+
+def remove_machine_definitions(hostnames, atomic=False):
+    hostnames = [item_key(h, 'hostname') for h in hostnames]
+    machines = get_definitions(Machine, Machine.hostname, hostnames)
+
+    def apply_item(hostname):
+        db.session.delete(get_existing(machines, 'machine', hostname))
+        return 'deleted'
+
+    committed, results = apply_bulk('hostname', hostnames, apply_item,
+                                    atomic)
+    if committed:
+        update_state_engine(hostnames=hostnames)
+    return committed, results
+
+
+def set_boot_config_definitions(bcjsons, atomic=False):
+    boot_configs = get_definitions(
+        BootConfig, BootConfig.title,
+        [item_key(bc, 'title') for bc in bcjsons])
+
+    def apply_item(bcjson):
+        title = bcjson['title']
+        render_cache.compile(title, bcjson['config'])
+        bc = boot_configs.get(title)
+        status = 'updated'
+        if bc is None:
+            bc = BootConfig(title, bcjson['config'])
+            db.session.add(bc)
+            status = 'created'
+        bc.config = bcjson['config']
+        return status
+
+    committed, results = apply_bulk('title', bcjsons, apply_item, atomic)
+    if committed:
+        update_state_engine(titles=[result['title'] for result in results])
+    return committed, results
+
+
+def remove_boot_config_definitions(titles, atomic=False):
+    titles = [item_key(t, 'title') for t in titles]
+    boot_configs = get_definitions(BootConfig, BootConfig.title, titles)
+
+    def apply_item(title):
+        db.session.delete(get_existing(boot_configs, 'boot config', title))
+        return 'deleted'
+
+    committed, results = apply_bulk('title', titles, apply_item, atomic)
+    if committed:
+        for result in results:
+            render_cache.invalidate(result['title'])
+        update_state_engine(titles=titles)
+    return committed, results
+
+
+def set_variable_definitions(vjsons, atomic=False):
+    variables = get_definitions(
+        Variable, Variable.key,
+        [item_key(v, 'key') for v in vjsons])
+
+    def apply_item(vjson):
+        key = vjson['key']
+        value = vjson['value']
+        vd = variables.get(key)
+        status = 'updated'
+        if vd is None:
+            vd = Variable(key, value)
+            db.session.add(vd)
+            status = 'created'
+        vd.value = value
+        return status
+
+    committed, results = apply_bulk('key', vjsons, apply_item, atomic)
+    if committed:
+        variable_snapshot.invalidate()
+    return committed, results
+
+
+def remove_variable_definitions(keys, atomic=False):
+    keys = [item_key(k, 'key') for k in keys]
+    variables = get_definitions(Variable, Variable.key, keys)
+
+    def apply_item(key):
+        db.session.delete(get_existing(variables, 'variable', key))
+        return 'deleted'
+
+    committed, results = apply_bulk('key', keys, apply_item, atomic)
+    if committed:
+        variable_snapshot.invalidate()
+    return committed, results
+
+
+def get_existing_hostnames(conn, table, hostnames):
+    existing = []
+    for i in range(0, len(hostnames), IN_CHUNK):
+        existing.extend(hostname for (hostname,) in conn.execute(
+            db.select([table.c.hostname]).where(
+                table.c.hostname.in_(hostnames[i:i + IN_CHUNK]))))
+    return existing
+
+
+def points_at(table, profile, boot_config_id):
+    # Hosts whose use_alternate flag currently points at the config
+    return db.or_(
+        db.and_(table.c.use_alternate,
+                profile.c.alternate_boot_id == boot_config_id),
+        db.and_(db.not_(table.c.use_alternate),
+                profile.c.default_boot_id == boot_config_id))
+
+
+def select_state_targets(conn, selection):
+    # Returns the hostnames to update per table, and for selectors SQL can
+    # evaluate the conditions that pick them, for the UPDATE to reuse
+    selectors = [key for key in ['hostnames', 'pattern', 'boot_config']
+                 if key in selection]
+    if len(selectors) != 1:
+        raise ValueError(
+            'Select hosts with one of hostnames, pattern or boot_config')
+    machines = Machine.__table__
+    members = HostState.__table__
+    if 'boot_config' in selection:
+        boot_configs = BootConfig.__table__
+        groups = MachineGroup.__table__
+        boot_config_id = conn.execute(db.select([boot_configs.c.id]).where(
+            boot_configs.c.title == selection['boot_config'])).scalar()
+        if boot_config_id is None:
+            raise KeyError('Unknown boot config {}'.format(
+                repr(selection['boot_config'])))
+        conditions = [
+            points_at(machines, machines, boot_config_id),
+            db.and_(
+                db.exists().where(db.and_(
+                    groups.c.id == members.c.group_id,
+                    points_at(members, groups, boot_config_id))),
+                # Machines take precedence over a stale group membership
+                ~db.exists().where(machines.c.hostname == members.c.hostname))
+        ]
+        targets = [[hostname for (hostname,) in conn.execute(
+            db.select([table.c.hostname]).where(condition))]
+            for table, condition in zip([machines, members], conditions)]
+        return targets, conditions
+    if 'hostnames' in selection:
+        hostnames = list(set(item_key(h, 'hostname')
+                             for h in selection['hostnames']))
+        targets = [get_existing_hostnames(conn, machines, hostnames),
+                   get_existing_hostnames(conn, members, hostnames)]
+    else:
+        matcher = HostMatcher([(True, selection.get('pattern_type', 'range'),
+                                selection['pattern'], 0)])
+        targets = [
+            [hostname for (hostname,) in conn.execute(
+                db.select([table.c.hostname])) if matcher.match(hostname)]
+            for table in [machines, members]]
+    # Machines take precedence over a stale group membership
+    shadowed = set(targets[0])
+    targets[1] = [h for h in targets[1] if h not in shadowed]
+    return targets, [None, None]
+
+
+def get_state_values(operation):
+    state = {}
+    if 'use_alternate' in operation:
+        if operation['use_alternate'] == 'toggle':
+            state['use_alternate'] = None
+        elif isinstance(operation['use_alternate'], bool):
+            state['use_alternate'] = operation['use_alternate']
+        else:
+            raise ValueError('use_alternate takes true, false or "toggle"')
+    if operation.get('reset_last_boot'):
+        state['last_boot'] = datetime.datetime(1970, 1, 1)
+    definition = {}
+    if 'switch_type' in operation:
+        definition['switch_type'] = Machine._switch_type.index(
+            operation['switch_type'])
+    if 'time_between' in operation:
+        definition['time_between'] = int(operation['time_between'])
+    if not state and not definition:
+        raise ValueError('Nothing to change, give use_alternate, '
+                         'reset_last_boot, switch_type or time_between')
+    return state, definition
+
+
+def read_machine_changes(conn, hostnames, state, definition):
+    table = Machine.__table__
+    default_boot = BootConfig.__table__.alias('default_boot')
+    alternate_boot = BootConfig.__table__.alias('alternate_boot')
+    statement = db.select([
+        table, default_boot.c.title.label('default_title'),
+        alternate_boot.c.title.label('alternate_title')
+    ]).select_from(table.outerjoin(
+        default_boot, table.c.default_boot_id == default_boot.c.id
+    ).outerjoin(
+        alternate_boot, table.c.alternate_boot_id == alternate_boot.c.id
+    )).where(table.c.hostname.in_(
+        db.bindparam('hostnames', expanding=True)))
+    rows = []
+    for i in range(0, len(hostnames), IN_CHUNK):
+        for row in conn.execute(
+                statement, hostnames=hostnames[i:i + IN_CHUNK]):
+            if definition:
+                rows.append(change_row('machine', row.hostname, 'set', {
+                    'hostname': row.hostname,
+                    'default_boot': row.default_title,
+                    'alternate_boot': row.alternate_title,
+                    'switch_type': Machine._switch_type[row.switch_type],
+                    'use_alternate': row.use_alternate,
+                    'last_boot': row.last_boot,
+                    'time_between': row.time_between,
+                    'mac': row.mac,
+                    'ip': row.ip,
+                    'uuid': row.uuid
+                }))
+            if state:
+                rows.append(change_row('state', row.hostname, 'set', {
+                    'use_alternate': row.use_alternate,
+                    'last_boot': row.last_boot
+                }))
+    return rows
+
+
+def read_state_changes(conn, table, hostnames):
+    statement = db.select([
+        table.c.hostname, table.c.use_alternate, table.c.last_boot
+    ]).where(table.c.hostname.in_(db.bindparam('hostnames', expanding=True)))
+    rows = []
+    for i in range(0, len(hostnames), IN_CHUNK):
+        for row in conn.execute(
+                statement, hostnames=hostnames[i:i + IN_CHUNK]):
+            rows.append(change_row('state', row.hostname, 'set', {
+                'use_alternate': row.use_alternate,
+                'last_boot': row.last_boot
+            }))
+    return rows
+
+
+def update_machine_states(selection):
+    state, definition = get_state_values(selection)
+    # Queued boots would land on top of the update and undo it
+    state_writer.flush()
+    with db.get_engine().begin() as conn:
+        (machines, members), conditions = select_state_targets(
+            conn, selection)
+        if not state:
+            # Group members take switch_type and time_between from their
+            # group
+            members = []
+        for table, hostnames, condition, values in [
+                (Machine.__table__, machines, conditions[0],
+                 dict(state, **definition)),
+                (HostState.__table__, members, conditions[1], dict(state))]:
+            if not hostnames:
+                continue
+            if 'use_alternate' in values and values['use_alternate'] is None:
+                values['use_alternate'] = db.not_(table.c.use_alternate)
+            if condition is not None:
+                conn.execute(table.update().where(condition).values(values))
+                continue
+            # Hostnames and patterns are resolved to names first
+            statement = table.update().where(table.c.hostname.in_(
+                db.bindparam('hostnames', expanding=True))).values(values)
+            for i in range(0, len(hostnames), IN_CHUNK):
+                conn.execute(statement, hostnames=hostnames[i:i + IN_CHUNK])
+        if definition:
+            rows = read_machine_changes(conn, machines, state, definition)
+        else:
+            rows = read_state_changes(conn, Machine.__table__, machines)
+        record_changes(conn, rows + read_state_changes(
+            conn, HostState.__table__, members))
+    change_notifier.notify()
+    update_state_engine(hostnames=machines + members)
+    mark_scripts(*[('host', hostname) for hostname in machines + members])
+    return {'machines': len(machines), 'members': len(members)}
+
+
+def bulk_response(set_definitions, remove_definitions):
+    atomic = request.args.get('atomic', '').lower() in ('1', 'true', 'yes')
+    try:
+        items = request.get_json()
+        if not isinstance(items, list):
+            raise ValueError('Bulk requests take a JSON array')
+        if request.method == 'PUT':
+            committed, results = set_definitions(items, atomic)
+        else:
+            committed, results = remove_definitions(items, atomic)
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+    response = jsonify(committed=committed, results=results)
+    if not committed:
+        response.status_code = 406
+    return response
+
+
+@blueprint.route('/api/v1/bulk/machine/', methods=['PUT', 'DELETE'])
+def api_v1_bulk_machine():
+    return bulk_response(set_machine_definitions, remove_machine_definitions)
+
+
+@blueprint.route('/api/v1/bulk/boot_config/', methods=['PUT', 'DELETE'])
+def api_v1_bulk_boot_config():
+    return bulk_response(set_boot_config_definitions,
+                         remove_boot_config_definitions)
+
+
+@blueprint.route('/api/v1/bulk/variable/', methods=['PUT', 'DELETE'])
+def api_v1_bulk_variable():
+    return bulk_response(set_variable_definitions, remove_variable_definitions)
+
+
+@blueprint.route('/api/v1/bulk/state/', methods=['POST'])
+def api_v1_bulk_state():
+    try:
+        selection = request.get_json()
+        if not isinstance(selection, dict):
+            raise ValueError('Bulk state requests take a JSON object')
+        updated = update_machine_states(selection)
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+    return jsonify(status="ok", **updated)
@@ -0,0 +1,74 @@
+import threading
+
+from .render import compile_template
+
+
+class Snapshot(object):
+    def __init__(self, loader):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.generation = 0
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    def get(self):
+        return self.snapshot()[1]
+
+    def peek(self):
+        # The current value if it is loaded and valid, without loading it
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == self.generation:
+            return snapshot[1]
+        return None
+
+    def update(self, fn):
+        # Changes the loaded value in place. Holding the lock waits out a
+        # reload in flight, which may have read the rows before the change
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot[0] == self.generation:
+                fn(snapshot[1])
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != self.generation:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot[0] != self.generation:
+                    snapshot = (self.generation, self._loader())
+                    self._snapshot = snapshot
+        return snapshot
+
+
+class RenderCache(object):
+    def __init__(self):
+        self._plans = {}
+        self._rendered = {}
+
+    def compile(self, key, config):
+        plan = compile_template(config)
+        self._plans[key] = plan
+        self._rendered.pop(key, None)
+        return plan
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._plans.clear()
+            self._rendered.clear()
+        else:
+            self._plans.pop(key, None)
+            self._rendered.pop(key, None)
+
+    def render(self, key, config, variables, generation):
+        entry = self._rendered.get(key)
+        if entry is not None and entry[0] == generation and entry[1] == config:
+            return entry[2]
+        plan = self._plans.get(key)
+        if plan is None or plan.source != config:
+            plan = self.compile(key, config)
+        rendered = plan.render(variables)
+        self._rendered[key] = (generation, config, rendered)
+        return rendered
@@ -0,0 +1,91 @@
+import threading
+import time
+
+
+class ChangeNotifier(object):
+    def __init__(self, poll_interval=1.0, prune_fn=None, prune_interval=60.0):
+        self.poll_interval = poll_interval
+        self.prune_interval = prune_interval
+        self._prune_fn = prune_fn
+        self._cond = threading.Condition()
+        self._sequence = 0
+        self._pruned = time.monotonic()
+
+    def notify(self):
+        with self._cond:
+            self._sequence += 1
+            self._cond.notify_all()
+            prune = (self._prune_fn is not None and
+                     time.monotonic() - self._pruned >= self.prune_interval)
+            if prune:
+                self._pruned = time.monotonic()
+        if prune:
+            self._prune_fn()
+
+    def wait(self, fetch, timeout):
+        # Commits from other processes are only seen by polling, so waiters
+        # wake every poll_interval even without a local notification
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._cond:
+                sequence = self._sequence
+            result = fetch()
+            remaining = deadline - time.monotonic()
+            if result or remaining <= 0:
+                return result
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._sequence != sequence,
+                    min(self.poll_interval, remaining))
+
+
+class ChangeFollower(object):
+    # Replays changes committed by other processes into this one's caches
+    def __init__(self, bounds_fn, fetch_fn, apply_fn, reset_fn,
+                 interval=0.0, max_replay=1000):
+        self.interval = interval
+        self.max_replay = max_replay
+        self._bounds_fn = bounds_fn
+        self._fetch_fn = fetch_fn
+        self._apply_fn = apply_fn
+        self._reset_fn = reset_fn
+        self._lock = threading.Lock()
+        self._revision = None
+        self._checked = None
+        self._stats = {'checks': 0, 'replayed': 0, 'resets': 0}
+
+    def check(self):
+        now = time.monotonic()
+        if (self.interval and self._checked is not None and
+                now - self._checked < self.interval):
+            return 0
+        # Another thread is already catching up, no need to queue behind it
+        if not self._lock.acquire(False):
+            return 0
+        try:
+            self._checked = now
+            self._stats['checks'] += 1
+            oldest, head = self._bounds_fn()
+            head = head or 0
+            if self._revision is None or head < self._revision or (
+                    oldest is not None and self._revision < oldest - 1) or (
+                    head - self._revision > self.max_replay):
+                # First check, a reset log or too far behind to replay
+                self._reset_fn()
+                self._revision = head
+                self._stats['resets'] += 1
+                return 0
+            if head == self._revision:
+                return 0
+            changes = self._fetch_fn(self._revision, head)
+            self._apply_fn(changes)
+            self._revision = head
+            self._stats['replayed'] += len(changes)
+            return len(changes)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['revision'] = self._revision
+        return stats
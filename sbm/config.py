@@ -0,0 +1,38 @@
+import json
+import os
+
+CONFIG_ENV = 'SBM_CONFIG'
+ENV_PREFIX = 'SBM_'
+# Not on/off, which are SQLite journal modes and synchronous levels
+ENV_CONSTANTS = {'true': True, 'yes': True, 'false': False, 'no': False,
+                 'none': None, 'null': None}
+
+
+def parse_env_value(value):
+    # Numbers, lists and objects are JSON, anything else stays a string
+    if value.lower() in ENV_CONSTANTS:
+        return ENV_CONSTANTS[value.lower()]
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def load_config_file(config, path):
+    if path.endswith('.json'):
+        with open(path) as config_file:
+            config.update(json.load(config_file))
+    else:
+        config.from_pyfile(os.path.abspath(path))
+
+
+def load_config(config, environ=None):
+    # The file comes first so the environment can override single settings
+    if environ is None:
+        environ = os.environ
+    if environ.get(CONFIG_ENV):
+        load_config_file(config, environ[CONFIG_ENV])
+    for name, value in environ.items():
+        if name.startswith(ENV_PREFIX) and name != CONFIG_ENV:
+            config[name] = parse_env_value(value)
+    return config
@@ -0,0 +1,377 @@
+from flask import Response, jsonify, make_response, request
+from flask import stream_with_context
+
+from sqlalchemy.orm import aliased
+
+from .matcher import compile_pattern
+from .render import compile_template
+from .sbm import blueprint, db, BootConfig, HostState, Machine, MachineGroup
+from .sbm import Variable
+from .sbm import change_row, normalize_identifier, record_changes
+from .sbm import boot_state, change_notifier, group_matcher, mark_all_scripts
+from .sbm import render_cache, state_writer, variable_snapshot
+
+import datetime
+import io
+import json
+import traceback
+
+SNAPSHOT_VERSION = 2
+# Version 1 had no machine groups or group members
+READ_VERSIONS = [1, 2]
+IMPORT_BATCH_SIZE = 1000
+IN_CHUNK = 500
+SECTIONS = [
+    ('boot_config', 'boot_configs'),
+    ('variable', 'variables'),
+    ('machine_group', 'machine_groups'),
+    ('machine', 'machines'),
+    ('host_state', 'host_states')
+]
+
+
+def export_records():
+    state_writer.flush()
+    for title, config in db.session.query(
+            BootConfig.title, BootConfig.config).order_by(BootConfig.id):
+        yield 'boot_config', {'title': title, 'config': config}
+    for key, value in db.session.query(
+            Variable.key, Variable.value).order_by(Variable.id):
+        yield 'variable', {'key': key, 'value': value}
+    default_boot = aliased(BootConfig)
+    alternate_boot = aliased(BootConfig)
+    groups = db.session.query(
+        MachineGroup.name,
+        MachineGroup.pattern,
+        MachineGroup.pattern_type,
+        MachineGroup.priority,
+        default_boot.title,
+        alternate_boot.title,
+        MachineGroup.switch_type,
+        MachineGroup.time_between
+    ).outerjoin(
+        default_boot, MachineGroup.default_boot_id == default_boot.id
+    ).outerjoin(
+        alternate_boot, MachineGroup.alternate_boot_id == alternate_boot.id
+    ).order_by(MachineGroup.id)
+    for row in groups:
+        yield 'machine_group', {
+            'name': row[0],
+            'pattern': row[1],
+            'pattern_type': MachineGroup._pattern_type[row[2]],
+            'priority': row[3] or 0,
+            'default_boot': row[4],
+            'alternate_boot': row[5],
+            'switch_type': MachineGroup._switch_type[row[6]],
+            'time_between': row[7]
+        }
+    machines = db.session.query(
+        Machine.hostname,
+        default_boot.title,
+        alternate_boot.title,
+        Machine.switch_type,
+        Machine.use_alternate,
+        Machine.last_boot,
+        Machine.time_between,
+        Machine.mac,
+        Machine.ip,
+        Machine.uuid
+    ).outerjoin(
+        default_boot, Machine.default_boot_id == default_boot.id
+    ).outerjoin(
+        alternate_boot, Machine.alternate_boot_id == alternate_boot.id
+    ).order_by(Machine.id).yield_per(IMPORT_BATCH_SIZE)
+    for row in machines:
+        yield 'machine', {
+            'hostname': row[0],
+            'default_boot': row[1],
+            'alternate_boot': row[2],
+            'switch_type': Machine._switch_type[row[3]],
+            'use_alternate': row[4],
+            'last_boot': row[5].isoformat() if row[5] else None,
+            'time_between': row[6],
+            'mac': row[7],
+            'ip': row[8],
+            'uuid': row[9]
+        }
+    members = db.session.query(
+        HostState.hostname,
+        MachineGroup.name,
+        HostState.use_alternate,
+        HostState.last_boot
+    ).join(
+        MachineGroup, HostState.group_id == MachineGroup.id
+    ).order_by(HostState.id).yield_per(IMPORT_BATCH_SIZE)
+    for row in members:
+        yield 'host_state', {
+            'hostname': row[0],
+            'group': row[1],
+            'use_alternate': row[2],
+            'last_boot': row[3].isoformat() if row[3] else None
+        }
+
+
+def export_ndjson():
+    yield json.dumps({'type': 'sbm', 'version': SNAPSHOT_VERSION}) + '\n'
+    for kind, record in export_records():
+        record['type'] = kind
+        yield json.dumps(record) + '\n'
+
+
+def export_json():
+    yield '{{"version": {}'.format(SNAPSHOT_VERSION)
+    section = None
+    for kind, record in export_records():
+        if kind != section:
+            if section is not None:
+                yield ']'
+            section = kind
+            yield ', "{}": ['.format(dict(SECTIONS)[kind])
+        else:
+            yield ', '
+        yield json.dumps(record)
+    if section is not None:
+        yield ']'
+    yield '}\n'
+
+
+def read_ndjson(stream):
+    for line in io.TextIOWrapper(stream, encoding='utf-8'):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        kind = record.pop('type', None)
+        if kind == 'sbm':
+            if record.get('version') not in READ_VERSIONS:
+                raise ValueError('Unsupported snapshot version {}'.format(
+                    repr(record.get('version'))))
+            continue
+        yield kind, record
+
+
+def read_json(stream):
+    snapshot = json.load(io.TextIOWrapper(stream, encoding='utf-8'))
+    if snapshot.get('version') not in READ_VERSIONS:
+        raise ValueError('Unsupported snapshot version {}'.format(
+            repr(snapshot.get('version'))))
+    for kind, section in SECTIONS:
+        for record in snapshot.get(section, []):
+            yield kind, record
+
+
+def get_ids(conn, table, column, values):
+    values = list(values)
+    ids = {}
+    for i in range(0, len(values), IN_CHUNK):
+        ids.update(conn.execute(
+            db.select([table.c[column], table.c.id])
+            .where(table.c[column].in_(values[i:i + IN_CHUNK]))
+        ).fetchall())
+    return ids
+
+
+def upsert_rows(conn, table, column, rows):
+    if not rows:
+        return
+    existing = get_ids(conn, table, column, rows)
+    inserts = [row for key, row in rows.items() if key not in existing]
+    updates = [dict(row, b_id=existing[key])
+               for key, row in rows.items() if key in existing]
+    if inserts:
+        conn.execute(table.insert(), inserts)
+    if updates:
+        columns = [c for c in updates[0] if c != 'b_id']
+        conn.execute(
+            table.update()
+            .where(table.c.id == db.bindparam('b_id'))
+            .values({c: db.bindparam(c) for c in columns}),
+            updates
+        )
+
+
+def boot_config_row(record):
+    compile_template(record['config'])
+    return record['title'], {
+        'title': record['title'],
+        'config': record['config']
+    }
+
+
+def variable_row(record):
+    return record['key'], {'key': record['key'], 'value': record['value']}
+
+
+def parse_last_boot(record):
+    last_boot = record.get('last_boot')
+    if last_boot:
+        return datetime.datetime.fromisoformat(last_boot)
+    return datetime.datetime(1970, 1, 1)
+
+
+def machine_group_row(record):
+    pattern_type = record.get('pattern_type', 'range')
+    compile_pattern(pattern_type, record['pattern'])
+    return record['name'], {
+        'name': record['name'],
+        'pattern': record['pattern'],
+        'pattern_type': MachineGroup._pattern_type.index(pattern_type),
+        'priority': int(record.get('priority', 0)),
+        'default_boot_id': record['default_boot'],
+        'alternate_boot_id': record['alternate_boot'],
+        'switch_type': MachineGroup._switch_type.index(
+            record['switch_type']),
+        'time_between': int(record.get('time_between', 600))
+    }
+
+
+def machine_row(record):
+    last_boot = parse_last_boot(record)
+    return record['hostname'], {
+        'hostname': record['hostname'],
+        'default_boot_id': record['default_boot'],
+        'alternate_boot_id': record['alternate_boot'],
+        'switch_type': Machine._switch_type.index(record['switch_type']),
+        'use_alternate': bool(record.get('use_alternate', False)),
+        'last_boot': last_boot,
+        'time_between': int(record.get('time_between', 600)),
+        'mac': normalize_identifier('mac', record.get('mac')),
+        'ip': normalize_identifier('ip', record.get('ip')),
+        'uuid': normalize_identifier('uuid', record.get('uuid'))
+    }
+
+
+def host_state_row(record):
+    return record['hostname'], {
+        'hostname': record['hostname'],
+        'group_id': record['group'],
+        'use_alternate': bool(record.get('use_alternate', False)),
+        'last_boot': parse_last_boot(record)
+    }
+
+
+def resolve_refs(rows, refs, ids, name, key):
+    # Snapshots refer to other rows by name, ids differ between databases
+    for row in rows.values():
+        for ref in refs:
+            if row[ref] not in ids:
+                raise KeyError('Unknown {} {} for {}'.format(
+                    name, repr(row[ref]), repr(row[key])))
+            row[ref] = ids[row[ref]]
+
+
+def import_records(records, replace=False, batch_size=IMPORT_BATCH_SIZE):
+    if batch_size <= 0:
+        raise ValueError('batch_size must be positive, not {}'.format(
+            batch_size))
+    builders = {
+        'boot_config': boot_config_row,
+        'variable': variable_row,
+        'machine_group': machine_group_row,
+        'machine': machine_row,
+        'host_state': host_state_row
+    }
+    # In dependency order, replace clears them in reverse
+    tables = [
+        ('boot_config', BootConfig.__table__, 'title'),
+        ('variable', Variable.__table__, 'key'),
+        ('machine_group', MachineGroup.__table__, 'name'),
+        ('machine', Machine.__table__, 'hostname'),
+        ('host_state', HostState.__table__, 'hostname')
+    ]
+    boot_refs = ['default_boot_id', 'alternate_boot_id']
+    counts = {section: 0 for kind, section in SECTIONS}
+    pending = {kind: {} for kind in builders}
+    engine = db.get_engine()
+    state_writer.flush()
+    with engine.connect() as conn:
+        boot_config_ids = dict(conn.execute(db.select(
+            [BootConfig.__table__.c.title, BootConfig.__table__.c.id]
+        )).fetchall())
+        group_ids = dict(conn.execute(db.select(
+            [MachineGroup.__table__.c.name, MachineGroup.__table__.c.id]
+        )).fetchall())
+
+    def flush(conn):
+        for kind, table, column in tables:
+            rows = pending[kind]
+            if kind in ('machine_group', 'machine'):
+                resolve_refs(rows, boot_refs, boot_config_ids,
+                             'boot config', column)
+            elif kind == 'host_state':
+                resolve_refs(rows, ['group_id'], group_ids,
+                             'machine group', column)
+            upsert_rows(conn, table, column, rows)
+            if kind == 'boot_config':
+                boot_config_ids.update(get_ids(conn, table, column, rows))
+            elif kind == 'machine_group':
+                group_ids.update(get_ids(conn, table, column, rows))
+        # Watchers reload everything rather than replaying each row
+        record_changes(conn, [change_row('import', None, 'resync')])
+        for kind, section in SECTIONS:
+            counts[section] += len(pending[kind])
+            pending[kind].clear()
+
+    def flush_batch():
+        with engine.begin() as conn:
+            flush(conn)
+
+    def load(flush_fn):
+        queued = 0
+        for kind, record in records:
+            if kind not in builders:
+                raise ValueError('Unknown record type {}'.format(repr(kind)))
+            key, row = builders[kind](record)
+            pending[kind][key] = row
+            queued += 1
+            if queued >= batch_size:
+                flush_fn()
+                queued = 0
+        flush_fn()
+
+    try:
+        if replace:
+            # Batches still bound the rows held in memory, but they share
+            # one transaction, so a bad record anywhere leaves the existing
+            # data as it was
+            with engine.begin() as conn:
+                for kind, table, column in reversed(tables):
+                    conn.execute(table.delete())
+                boot_config_ids.clear()
+                group_ids.clear()
+                load(lambda: flush(conn))
+        else:
+            load(flush_batch)
+    finally:
+        change_notifier.notify()
+        variable_snapshot.invalidate()
+        group_matcher.invalidate()
+        render_cache.invalidate()
+        boot_state.invalidate()
+        mark_all_scripts()
+    return counts
+
+
+@blueprint.route('/api/v1/export/', methods=['GET'])
+def api_v1_export():
+    if request.args.get('format', 'json') == 'ndjson':
+        return Response(stream_with_context(export_ndjson()),
+                        mimetype='application/x-ndjson')
+    return Response(stream_with_context(export_json()),
+                    mimetype='application/json')
+
+
+@blueprint.route('/api/v1/import/', methods=['POST'])
+def api_v1_import():
+    replace = request.args.get('replace', '').lower() in ('1', 'true', 'yes')
+    ndjson = (request.args.get('format') == 'ndjson' or
+              request.mimetype == 'application/x-ndjson')
+    try:
+        batch_size = int(request.args.get('batch_size', IMPORT_BATCH_SIZE))
+        if ndjson:
+            records = read_ndjson(request.stream)
+        else:
+            records = read_json(request.stream)
+        counts = import_records(records, replace, batch_size)
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+    return jsonify(status="ok", **counts)
@@ -0,0 +1,175 @@
+import bisect
+import fnmatch
+import re
+
+PATTERN_TYPES = ['range', 'glob', 'regex']
+
+_range_pattern = re.compile(r'^([^\[\]]*)\[([0-9,\- ]+)\]([^\[\]]*)$')
+_digits = re.compile(r'\d+')
+_global_flags = re.compile(r'\(\?[aiLmsux]+\)')
+
+
+def parse_range(pattern):
+    if '[' not in pattern and ']' not in pattern:
+        return pattern, None, None
+    match = _range_pattern.match(pattern)
+    if match is None:
+        raise ValueError(
+            'Range pattern {} must look like prefix[lo-hi,n,...]suffix'
+            .format(repr(pattern)))
+    prefix, spec, suffix = match.groups()
+    if prefix[-1:].isdigit() or suffix[:1].isdigit():
+        raise ValueError(
+            'The range in {} must not touch other digits'.format(
+                repr(pattern)))
+    intervals = []
+    for part in spec.replace(' ', '').split(','):
+        lo, _, hi = part.partition('-')
+        hi = hi or lo
+        if not lo.isdigit() or not hi.isdigit() or int(lo) > int(hi):
+            raise ValueError('Bad range {} in {}'.format(
+                repr(part), repr(pattern)))
+        width = 0
+        if len(lo) > 1 and lo.startswith('0'):
+            if len(lo) != len(hi):
+                raise ValueError(
+                    'Zero padded range {} must use equal widths in {}'
+                    .format(repr(part), repr(pattern)))
+            width = len(lo)
+        intervals.append((int(lo), int(hi), width))
+    return prefix, intervals, suffix
+
+
+def check_regex(pattern):
+    # Group expressions are merged into one alternation, where global
+    # flags are an error and group numbers no longer line up
+    i = 0
+    in_class = False
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if not in_class and pattern[i + 1:i + 2] in set('123456789'):
+                raise ValueError(
+                    'Backreferences are not allowed in {}'.format(
+                        repr(pattern)))
+            i += 2
+            continue
+        if in_class:
+            if char == ']':
+                in_class = False
+        elif char == '[':
+            in_class = True
+            # A ] straight after [ or [^ is a literal
+            if pattern[i + 1:i + 2] == '^':
+                i += 1
+            if pattern[i + 1:i + 2] == ']':
+                i += 1
+        elif pattern.startswith('(?(', i):
+            raise ValueError(
+                'Conditional groups are not allowed in {}'.format(
+                    repr(pattern)))
+        elif _global_flags.match(pattern, i):
+            raise ValueError(
+                'Global flags are not allowed in {}, scope them like '
+                '(?i:...)'.format(repr(pattern)))
+        i += 1
+
+
+def compile_pattern(pattern_type, pattern):
+    if pattern_type == 'range':
+        return parse_range(pattern)
+    if pattern_type == 'glob':
+        return re.compile(fnmatch.translate(pattern))
+    if pattern_type == 'regex':
+        check_regex(pattern)
+        compiled = re.compile(pattern)
+        if compiled.groupindex:
+            raise ValueError(
+                'Named groups are not allowed in {}'.format(repr(pattern)))
+        return compiled
+    raise ValueError('Unknown pattern type {}'.format(repr(pattern_type)))
+
+
+class RangeBucket(object):
+    __slots__ = ('los', 'intervals', 'max_his')
+
+    def __init__(self, intervals):
+        intervals = sorted(intervals)
+        self.intervals = intervals
+        self.los = [interval[0] for interval in intervals]
+        self.max_his = []
+        max_hi = -1
+        for interval in intervals:
+            max_hi = max(max_hi, interval[1])
+            self.max_his.append(max_hi)
+
+    def stab(self, digits):
+        number = int(digits)
+        best = None
+        index = bisect.bisect_right(self.los, number) - 1
+        # max_his only grows, so once it is below the number nothing
+        # further left can contain it either
+        while index >= 0 and self.max_his[index] >= number:
+            lo, hi, width, order, key = self.intervals[index]
+            if hi >= number and (
+                    len(digits) == width if width else
+                    digits == str(number)):
+                if best is None or order < best[0]:
+                    best = (order, key)
+            index -= 1
+        return best
+
+
+class HostMatcher(object):
+    def __init__(self, patterns=()):
+        self._exact = {}
+        ranges = {}
+        expressions = []
+        for key, pattern_type, pattern, order in patterns:
+            compiled = compile_pattern(pattern_type, pattern)
+            if pattern_type == 'range':
+                prefix, intervals, suffix = compiled
+                if intervals is None:
+                    if prefix not in self._exact or \
+                            order < self._exact[prefix][0]:
+                        self._exact[prefix] = (order, key)
+                    continue
+                bucket = ranges.setdefault((prefix, suffix), [])
+                for lo, hi, width in intervals:
+                    bucket.append((lo, hi, width, order, key))
+            else:
+                expressions.append((order, key, compiled.pattern))
+        self._ranges = dict(
+            (split, RangeBucket(intervals))
+            for split, intervals in ranges.items())
+        self._keys = {}
+        self._expression = None
+        if expressions:
+            # One alternation in precedence order: the first alternative
+            # that matches is the one the regex engine reports
+            alternatives = []
+            for i, (order, key, expression) in enumerate(sorted(expressions)):
+                name = 'p{}'.format(i)
+                self._keys[name] = (order, key)
+                alternatives.append('(?P<{}>(?:{}))'.format(name, expression))
+            self._expression = re.compile('|'.join(alternatives))
+
+    def match(self, hostname):
+        candidates = []
+        if hostname in self._exact:
+            candidates.append(self._exact[hostname])
+        if self._ranges:
+            for digits in _digits.finditer(hostname):
+                bucket = self._ranges.get(
+                    (hostname[:digits.start()], hostname[digits.end():]))
+                if bucket is not None:
+                    best = bucket.stab(digits.group(0))
+                    if best is not None:
+                        candidates.append(best)
+        if self._expression is not None:
+            match = self._expression.fullmatch(hostname)
+            if match is not None:
+                candidates.append(self._keys[match.lastgroup])
+        if not candidates:
+            return None
+        return min(candidates)[1]
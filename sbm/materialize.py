@@ -0,0 +1,251 @@
+import atexit
+import datetime
+import heapq
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Common and combined log format, as written by nginx and Apache
+ACCESS_LOG_PATTERN = (r'^(?P<address>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+                      r'"GET (?P<path>[^ "?]+)[^"]*" (?P<status>\d{3})')
+ACCESS_LOG_TIME = '%d/%b/%Y:%H:%M:%S %z'
+TREE_KINDS = ['host', 'ip']
+
+
+def write_atomic(path, content):
+    try:
+        with open(path) as current:
+            if current.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as out:
+            out.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def link_atomic(path, target):
+    if os.path.islink(path) and os.readlink(path) == target:
+        return False
+    tmp = os.path.join(os.path.dirname(path),
+                       '.tmp-{}-{}'.format(os.getpid(), threading.get_ident()))
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+    return True
+
+
+def check_name(name):
+    if not name or name.startswith('.') or '/' in name or '\0' in name:
+        raise ValueError('{} cannot be used as a file name'.format(repr(name)))
+    return name
+
+
+class AccessLogReader(object):
+    def __init__(self, path, pattern=ACCESS_LOG_PATTERN):
+        self.path = path
+        self.pattern = re.compile(pattern)
+        self._inode = None
+        self._offset = 0
+
+    def read(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return []
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            # Rotated or truncated, start from the top of the new file
+            self._inode = st.st_ino
+            self._offset = 0
+        with open(self.path, 'rb') as logfile:
+            logfile.seek(self._offset)
+            data = logfile.read()
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        hits = []
+        for line in data[:end].decode('utf8', 'replace').splitlines():
+            match = self.pattern.match(line)
+            if match is None or not match.group('status').startswith('2'):
+                continue
+            parts = match.group('path').rstrip('/').split('/')
+            if len(parts) < 2 or parts[-2] not in TREE_KINDS:
+                continue
+            hits.append((
+                datetime.datetime.strptime(match.group('time'),
+                                           ACCESS_LOG_TIME),
+                parts[-2],
+                parts[-1]
+            ))
+        return hits
+
+
+class ScriptTree(object):
+    def __init__(self, root, render_fn, resolve_fn, addresses_fn=None,
+                 poll_fn=None, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self._render_fn = render_fn
+        self._resolve_fn = resolve_fn
+        self._addresses_fn = addresses_fn
+        self._poll_fn = poll_fn
+        self._cond = threading.Condition()
+        self._sync_lock = threading.Lock()
+        self._dirty = set()
+        self._retry = set()
+        self._expiries = []
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stats = {'syncs': 0, 'rendered': 0, 'written': 0, 'removed': 0,
+                       'failures': 0, 'polled': 0}
+        for kind in TREE_KINDS:
+            directory = os.path.join(root, kind)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        atexit.register(self.stop)
+
+    def path(self, kind, name):
+        return os.path.join(self.root, kind, check_name(name))
+
+    def hostname_for_address(self, address):
+        try:
+            return os.path.basename(os.readlink(self.path('ip', address)))
+        except (OSError, ValueError):
+            return None
+
+    def mark(self, *keys):
+        with self._cond:
+            self._ensure_started()
+            self._dirty.update(keys)
+            self._cond.notify_all()
+
+    def mark_all(self):
+        self.mark(('all', None))
+
+    def sync(self):
+        with self._sync_lock:
+            with self._cond:
+                # Failed keys ride along with the next sync rather than
+                # waking the worker straight away
+                keys = self._dirty | self._retry
+                self._dirty = set()
+                self._retry = set()
+                now = time.time()
+                while self._expiries and self._expiries[0][0] <= now:
+                    keys.add(('host', heapq.heappop(self._expiries)[1]))
+            if not keys:
+                return 0
+            try:
+                hostnames, complete = self._resolve_fn(keys)
+                if complete and self._addresses_fn is not None:
+                    self._sync_links(self._addresses_fn())
+            except Exception:
+                log.exception('Failed to resolve %d changes', len(keys))
+                with self._cond:
+                    self._retry.update(keys)
+                    self._stats['failures'] += 1
+                return 0
+            for hostname in hostnames:
+                self._materialize(hostname)
+            if complete:
+                current = set(hostnames)
+                for name in os.listdir(os.path.join(self.root, 'host')):
+                    if name not in current and not name.startswith('.'):
+                        self._remove(name)
+            with self._cond:
+                self._stats['syncs'] += 1
+            return len(hostnames)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['dirty'] = len(self._dirty) + len(self._retry)
+            stats['scheduled'] = len(self._expiries)
+        return stats
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self._thread = None
+
+    def _materialize(self, hostname):
+        try:
+            result = self._render_fn(hostname)
+            if result is None:
+                self._remove(hostname)
+                return
+            script, expires = result
+            written = write_atomic(self.path('host', hostname), script)
+        except Exception:
+            log.exception('Failed to materialize the boot script for %s',
+                          hostname)
+            with self._cond:
+                self._retry.add(('host', hostname))
+                self._stats['failures'] += 1
+            return
+        with self._cond:
+            self._stats['rendered'] += 1
+            if written:
+                self._stats['written'] += 1
+            if expires is not None:
+                # Timed hosts fall back to their default boot on their own
+                heapq.heappush(self._expiries, (expires, hostname))
+
+    def _remove(self, hostname):
+        try:
+            os.unlink(self.path('host', hostname))
+        except (OSError, ValueError):
+            return
+        with self._cond:
+            self._stats['removed'] += 1
+
+    def _sync_links(self, addresses):
+        directory = os.path.join(self.root, 'ip')
+        for address, hostname in addresses.items():
+            link_atomic(self.path('ip', address),
+                        os.path.join('..', 'host', check_name(hostname)))
+        for name in os.listdir(directory):
+            if name not in addresses and not name.startswith('.'):
+                os.unlink(os.path.join(directory, name))
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name='sbm-materialize')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopping or self._dirty, self.interval)
+                if self._stopping:
+                    return
+            if self._poll_fn is not None:
+                try:
+                    polled = self._poll_fn()
+                except Exception:
+                    log.exception('Failed to reconcile boots')
+                    polled = 0
+                with self._cond:
+                    self._stats['polled'] += polled
+            self.sync()
@@ -0,0 +1,64 @@
+import re
+import string
+
+_formatter = string.Formatter()
+_field_root = re.compile(r'[^.\[]*')
+
+
+class RenderPlan(object):
+    __slots__ = ('source', 'chunks', 'names')
+
+    def __init__(self, source, chunks, names):
+        self.source = source
+        self.chunks = chunks
+        self.names = names
+
+    def render(self, variables):
+        parts = []
+        for literal, name, field in self.chunks:
+            parts.append(literal)
+            if field is not None:
+                parts.append(field.format_map(variables))
+            elif name is not None:
+                parts.append(str(variables[name]))
+        return ''.join(parts)
+
+
+def _check_fields(source):
+    names = set()
+    for literal, field_name, format_spec, conversion in _formatter.parse(source):
+        if field_name is None:
+            continue
+        root = _field_root.match(field_name).group(0)
+        if root == '' or root.isdigit():
+            raise ValueError(
+                'Positional placeholder {{{}}} is not supported, boot configs '
+                'can only reference variables by name'.format(field_name))
+        if conversion not in (None, 'r', 's', 'a'):
+            raise ValueError(
+                'Unknown conversion !{} in placeholder {{{}}}'.format(
+                    conversion, field_name))
+        names.add(root)
+        if format_spec:
+            names.update(_check_fields(format_spec))
+    return names
+
+
+def compile_template(source):
+    names = _check_fields(source)
+    chunks = []
+    for literal, field_name, format_spec, conversion in _formatter.parse(source):
+        if field_name is None:
+            chunks.append((literal, None, None))
+        elif field_name.isidentifier() and not format_spec and not conversion:
+            chunks.append((literal, field_name, None))
+        else:
+            # Attribute/index lookups, conversions and format specs are rare,
+            # so they keep str.format semantics on just that placeholder
+            field = '{' + field_name
+            if conversion:
+                field += '!' + conversion
+            if format_spec:
+                field += ':' + format_spec
+            chunks.append((literal, None, field + '}'))
+    return RenderPlan(source, tuple(chunks), frozenset(names))
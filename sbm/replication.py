@@ -0,0 +1,152 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import threading
+import urllib.error
+import urllib.request
+
+log = logging.getLogger(__name__)
+
+
+class PrimaryClient(object):
+    def __init__(self, url, timeout=10.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def open(self, path, data=None, timeout=None):
+        headers = {}
+        if data is not None:
+            data = json.dumps(data).encode('utf8')
+            headers['Content-Type'] = 'application/json'
+        return urllib.request.urlopen(
+            urllib.request.Request(self.url + path, data=data,
+                                   headers=headers),
+            timeout=timeout or self.timeout)
+
+    def get_json(self, path, timeout=None):
+        with self.open(path, timeout=timeout) as response:
+            return json.loads(response.read().decode('utf8'))
+
+    def post_json(self, path, data):
+        with self.open(path, data) as response:
+            return json.loads(response.read().decode('utf8'))
+
+    def stream_ndjson(self, path):
+        with self.open(path) as response:
+            for line in response:
+                if line.strip():
+                    yield json.loads(line.decode('utf8'))
+
+
+class ChangeStream(object):
+    def __init__(self, client, bootstrap_fn, apply_fn, wait=30,
+                 retry=5.0, lock_path=None):
+        self.client = client
+        self.wait = wait
+        self.retry = retry
+        self.lock_path = lock_path
+        self._bootstrap_fn = bootstrap_fn
+        self._apply_fn = apply_fn
+        self._cond = threading.Condition()
+        self._revision = None
+        self._lock_file = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stats = {'bootstraps': 0, 'applied': 0, 'failures': 0,
+                       'following': False}
+        atexit.register(self.stop)
+
+    def ensure_started(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        with self._cond:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._lock_file = None
+                self._stopping = False
+                self._thread = threading.Thread(
+                    target=self._run, name='sbm-replica')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['revision'] = self._revision
+        stats['primary'] = self.client.url
+        return stats
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            # A long-poll in flight is left to run out on its own
+            thread.join(0.1)
+        self._thread = None
+
+    def _sleep(self, seconds):
+        with self._cond:
+            self._cond.wait_for(lambda: self._stopping, seconds)
+            return not self._stopping
+
+    def _take_lock(self):
+        # Worker processes sharing one replica database elect a single
+        # follower, the others stand by in case it goes away
+        if self.lock_path is None or self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _run(self):
+        while not self._stopping:
+            if not self._take_lock():
+                if not self._sleep(self.retry):
+                    return
+                continue
+            with self._cond:
+                self._stats['following'] = True
+            try:
+                self._follow()
+            except Exception:
+                log.exception('Failed to follow %s', self.client.url)
+                with self._cond:
+                    self._stats['failures'] += 1
+                if not self._sleep(self.retry):
+                    return
+
+    def _follow(self):
+        if self._revision is None:
+            revision = self._bootstrap_fn(self.client)
+            with self._cond:
+                self._revision = revision
+                self._stats['bootstraps'] += 1
+        try:
+            feed = self.client.get_json(
+                '/api/v1/changes/?since={}&wait={}'.format(
+                    self._revision, self.wait),
+                timeout=self.wait + self.client.timeout)
+        except urllib.error.HTTPError as ex:
+            if ex.code == 410:
+                # Fell behind the primary's retention, start over
+                self._revision = None
+                return
+            raise
+        changes = feed['changes']
+        if any(change['kind'] == 'import' for change in changes):
+            self._revision = None
+            return
+        if changes:
+            self._apply_fn(changes)
+        with self._cond:
+            self._revision = feed['revision']
+            self._stats['applied'] += len(changes)
@@ -0,0 +1,111 @@
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+class HostResolver(object):
+    def __init__(self, positive_ttl=300, negative_ttl=30, max_entries=4096,
+                 timeout=2.0, workers=4, static_hosts=None):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._cache = OrderedDict()
+        self._inflight = {}
+        self._static = {}
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'negative_hits': 0,
+            'static_hits': 0,
+            'timeouts': 0,
+            'evictions': 0
+        }
+        if static_hosts:
+            self.load_static_hosts(static_hosts)
+
+    def load_static_hosts(self, static_hosts):
+        with self._lock:
+            self._static.update(static_hosts)
+
+    def load_hosts_file(self, path):
+        static_hosts = {}
+        with open(path) as hosts_file:
+            for line in hosts_file:
+                fields = line.split('#', 1)[0].split()
+                if len(fields) >= 2 and fields[0] not in static_hosts:
+                    static_hosts[fields[0]] = fields[1]
+        self.load_static_hosts(static_hosts)
+
+    def static_hosts(self):
+        with self._lock:
+            return dict(self._static)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._cache)
+            stats['static_size'] = len(self._static)
+        return stats
+
+    def resolve(self, address):
+        now = time.time()
+        with self._lock:
+            if address in self._static:
+                self._stats['static_hits'] += 1
+                return self._static[address]
+            entry = self._cache.get(address)
+            if entry is not None and entry[0] > now:
+                self._cache.move_to_end(address)
+                if entry[1] is None:
+                    self._stats['negative_hits'] += 1
+                    raise socket.herror(
+                        'cached lookup failure for {}'.format(address))
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
+            # Concurrent misses for the same address share one lookup
+            future = self._inflight.get(address)
+            if future is None:
+                future = self._pool.submit(socket.gethostbyaddr, address)
+                self._inflight[address] = future
+                future.add_done_callback(
+                    lambda f, address=address: self._store(address, f))
+        try:
+            return future.result(timeout=self.timeout)[0]
+        except FutureTimeoutError:
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise socket.herror('lookup timed out for {}'.format(address))
+        except (socket.herror, socket.gaierror):
+            raise socket.herror('lookup failed for {}'.format(address))
+
+    def _store(self, address, future):
+        # Runs when the lookup completes, even if the caller gave up waiting
+        try:
+            hostname = future.result()[0]
+            expires = time.time() + self.positive_ttl
+        except (socket.herror, socket.gaierror):
+            hostname = None
+            expires = time.time() + self.negative_ttl
+        except Exception:
+            hostname = None
+            expires = 0
+        with self._lock:
+            if self._inflight.get(address) is future:
+                del self._inflight[address]
+            if expires:
+                self._cache[address] = (expires, hostname)
+                self._cache.move_to_end(address)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+                self._stats['evictions'] += 1
@@ -1,20 +1,141 @@
 #!/usr/bin/python
 
 from flask import Flask, jsonify, make_response, request, render_template
-
-from flask_sqlalchemy import SQLAlchemy
-
+from flask import Blueprint, Config, Response, g, current_app
+from flask import has_app_context, has_request_context, stream_with_context
+
+from werkzeug.http import parse_date
+from werkzeug.local import LocalProxy
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import configure_mappers
+
+from .admission import AdmissionGate
+from .cache import RenderCache, Snapshot
+from .changes import ChangeFollower, ChangeNotifier
+from .config import load_config, load_config_file
+from .materialize import ACCESS_LOG_PATTERN, AccessLogReader, ScriptTree
+from .matcher import HostMatcher, compile_pattern
+from .render import compile_template
+from .replication import ChangeStream, PrimaryClient
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry
+from .resolver import HostResolver
+from .schema import add_columns, create_indexes, create_tables, migrate
+from .state import BootProfile, BootRecord, HostRecord, StateEngine
+from .storage import TunedSQLAlchemy
+from .telemetry import EventRing
+from .writebehind import WriteBehindQueue
+
+import os
 import socket
 import datetime
+import hashlib
+import ipaddress
+import itertools
 import logging
+import random
+import threading
+import time
 import traceback
+import uuid
 logging.basicConfig()
-logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
 
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
-db = SQLAlchemy(app)
-db.create_all()
+
+def set_defaults(config):
+    config.setdefault(
+        'SQLALCHEMY_DATABASE_URI',
+        config.get('SBM_DATABASE_URI', 'sqlite:///test.db')
+    )
+    config.setdefault('SQLALCHEMY_TRACK_MODIFICATIONS', False)
+    config.setdefault('SBM_SQL_ECHO', False)
+    config.setdefault('SBM_AUTO_MIGRATE', True)
+    config.setdefault('SBM_SQLITE_JOURNAL_MODE', 'wal')
+    config.setdefault('SBM_SQLITE_SYNCHRONOUS', 'normal')
+    config.setdefault('SBM_SQLITE_BUSY_TIMEOUT', 5000)
+    config.setdefault('SBM_SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+    config.setdefault('SBM_DB_POOL_SIZE', 10)
+    config.setdefault('SBM_DB_MAX_OVERFLOW', 20)
+    config.setdefault('SBM_DB_POOL_TIMEOUT', 30)
+    config.setdefault('SBM_DB_POOL_RECYCLE', 3600)
+    config.setdefault('SBM_MATERIALIZE_DIR', None)
+    config.setdefault('SBM_MATERIALIZE_INTERVAL', 1.0)
+    config.setdefault('SBM_MATERIALIZE_ACCESS_LOG', None)
+    config.setdefault('SBM_MATERIALIZE_LOG_PATTERN', ACCESS_LOG_PATTERN)
+    config.setdefault('SBM_CHANGES_RETENTION', 100000)
+    config.setdefault('SBM_CHANGES_MAX_WAIT', 60)
+    config.setdefault('SBM_CHANGES_POLL_INTERVAL', 1.0)
+    config.setdefault('SBM_CACHE_COHERENCY', True)
+    config.setdefault('SBM_CACHE_CHECK_INTERVAL', 0.0)
+    config.setdefault('SBM_REPLICA_OF', None)
+    config.setdefault('SBM_REPLICA_WAIT', 30)
+    config.setdefault('SBM_REPLICA_TIMEOUT', 10.0)
+    config.setdefault('SBM_REPLICA_FORWARD_INTERVAL', 0.25)
+    config.setdefault('SBM_REPLICA_FORWARD_SIZE', 500)
+    config.setdefault('SBM_REPLICA_LOCK', None)
+    config.setdefault('SBM_ADMISSION_CONTROL', False)
+    config.setdefault('SBM_ADMISSION_BOOT_LIMIT', 16)
+    config.setdefault('SBM_ADMISSION_BOOT_QUEUE', 64)
+    config.setdefault('SBM_ADMISSION_BOOT_TIMEOUT', 2.0)
+    config.setdefault('SBM_ADMISSION_MANAGEMENT_LIMIT', 4)
+    config.setdefault('SBM_ADMISSION_MANAGEMENT_QUEUE', 32)
+    config.setdefault('SBM_ADMISSION_MANAGEMENT_TIMEOUT', 10.0)
+    config.setdefault('SBM_ADMISSION_RETRY_AFTER', 2)
+    config.setdefault('SBM_BOOT_EVENTS_CAPACITY', 100000)
+    config.setdefault('SBM_BOOT_EVENTS_FLUSH_INTERVAL', 1.0)
+    config.setdefault('SBM_BOOT_EVENTS_BATCH_SIZE', 5000)
+    config.setdefault('SBM_BOOT_EVENTS_RETENTION', 1000000)
+    config.setdefault('SBM_DNS_POSITIVE_TTL', 300)
+    config.setdefault('SBM_DNS_NEGATIVE_TTL', 30)
+    config.setdefault('SBM_DNS_CACHE_SIZE', 4096)
+    config.setdefault('SBM_DNS_TIMEOUT', 2.0)
+    config.setdefault('SBM_DNS_WORKERS', 4)
+    config.setdefault('SBM_DNS_STATIC_HOSTS', None)
+    config.setdefault('SBM_BOOT_ENGINE', 'orm')
+    config.setdefault('SBM_STATE_WRITE_MODE', 'immediate')
+    config.setdefault('SBM_STATE_FLUSH_INTERVAL', 0.25)
+    config.setdefault('SBM_STATE_FLUSH_SIZE', 256)
+    config.setdefault('SBM_STATE_GROUP_TIMEOUT', 5.0)
+    return config
+
+
+db = TunedSQLAlchemy()
+blueprint = Blueprint('sbm', __name__, cli_group=None)
+
+
+def get_components(app=None):
+    # What create_app built for this app: caches, queues and their threads
+    return (app or current_app).extensions['sbm']
+
+
+def component(name):
+    return LocalProxy(lambda: getattr(get_components(), name))
+
+
+# Resolve to the current app's, so they work in any request or app context
+resolver = component('resolver')
+metrics = component('metrics')
+request_count = component('request_count')
+request_latency = component('request_latency')
+boot_stage_latency = component('boot_stage_latency')
+boot_count = component('boot_count')
+boot_finished_count = component('boot_finished_count')
+variable_snapshot = component('variable_snapshot')
+group_matcher = component('group_matcher')
+boot_state = component('boot_state')
+render_cache = component('render_cache')
+change_notifier = component('change_notifier')
+change_follower = component('change_follower')
+state_writer = component('state_writer')
+admission_gates = component('admission_gates')
+boot_events = component('boot_events')
+
+
+def load_static_hosts(resolver, config):
+    if isinstance(config['SBM_DNS_STATIC_HOSTS'], dict):
+        resolver.load_static_hosts(config['SBM_DNS_STATIC_HOSTS'])
+    elif config['SBM_DNS_STATIC_HOSTS']:
+        resolver.load_hosts_file(config['SBM_DNS_STATIC_HOSTS'])
 
 
 class BootConfig(db.Model):
@@ -32,6 +153,7 @@ class BootConfig(db.Model):
 
 class Machine(db.Model):
     _switch_type = ['switched', 'alternating', 'timed']
+    _identifiers = ['mac', 'ip', 'uuid']
     id = db.Column(db.Integer, primary_key=True)
     hostname = db.Column(db.String(80), unique=True)
     default_boot_id = db.Column(
@@ -54,6 +176,9 @@ class Machine(db.Model):
     use_alternate = db.Column(db.Boolean)
     last_boot = db.Column(db.DateTime)
     time_between = db.Column(db.Integer)
+    mac = db.Column(db.String(17), unique=True, index=True)
+    ip = db.Column(db.String(45), unique=True, index=True)
+    uuid = db.Column(db.String(36), unique=True, index=True)
 
     def __init__(self, hostname, default_boot,
                  alternate_boot, switch_type='switched'):
@@ -90,6 +215,174 @@ class Variable(db.Model):
         )
 
 
+class MachineGroup(db.Model):
+    _switch_type = Machine._switch_type
+    _pattern_type = ['range', 'glob', 'regex']
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), unique=True)
+    pattern = db.Column(db.String(255))
+    pattern_type = db.Column(db.Integer)
+    priority = db.Column(db.Integer)
+    default_boot_id = db.Column(
+        db.Integer,
+        db.ForeignKey('boot_config.id')
+    )
+    default_boot = db.relationship(
+        'BootConfig',
+        foreign_keys=[default_boot_id]
+    )
+    alternate_boot_id = db.Column(
+        db.Integer,
+        db.ForeignKey('boot_config.id')
+    )
+    alternate_boot = db.relationship(
+        'BootConfig',
+        foreign_keys=[alternate_boot_id]
+    )
+    switch_type = db.Column(db.Integer)
+    time_between = db.Column(db.Integer)
+
+    def __init__(self, name, pattern, default_boot, alternate_boot,
+                 switch_type='switched', pattern_type='range'):
+        self.name = name
+        self.pattern = pattern
+        self.pattern_type = self._pattern_type.index(pattern_type)
+        self.priority = 0
+        self.default_boot = default_boot
+        self.alternate_boot = alternate_boot
+        self.switch_type = self._switch_type.index(switch_type)
+        self.time_between = 600
+
+    def __repr__(self):
+        return '<MachineGroup {} -- {} -- {} -- {}>'.format(
+            repr(self.name),
+            repr(self.pattern),
+            repr(self.default_boot),
+            repr(self.alternate_boot)
+        )
+
+
+class HostState(db.Model):
+    _switch_type = Machine._switch_type
+    id = db.Column(db.Integer, primary_key=True)
+    hostname = db.Column(db.String(80), unique=True)
+    group_id = db.Column(
+        db.Integer,
+        db.ForeignKey('machine_group.id')
+    )
+    group = db.relationship('MachineGroup')
+    use_alternate = db.Column(db.Boolean)
+    last_boot = db.Column(db.DateTime)
+
+    def __init__(self, hostname, group):
+        self.hostname = hostname
+        self.group = group
+        self.use_alternate = False
+        self.last_boot = datetime.datetime(1970, 1, 1)
+
+    @property
+    def default_boot(self):
+        return self.group.default_boot
+
+    @property
+    def alternate_boot(self):
+        return self.group.alternate_boot
+
+    @property
+    def switch_type(self):
+        return self.group.switch_type
+
+    @property
+    def time_between(self):
+        return self.group.time_between
+
+    def __repr__(self):
+        return '<HostState {} -- {}>'.format(
+            repr(self.hostname),
+            repr(self.group)
+        )
+
+
+class Change(db.Model):
+    __tablename__ = 'change_log'
+    # Revisions are never reused, even after old entries are pruned
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20))
+    key = db.Column(db.String(255))
+    op = db.Column(db.String(10))
+    time = db.Column(db.DateTime)
+    data = db.Column(db.Text)
+
+    def __init__(self, kind, key, op, time, data=None):
+        self.kind = kind
+        self.key = key
+        self.op = op
+        self.time = time
+        self.data = data
+
+    def __repr__(self):
+        return '<Change {} {} {} {}>'.format(
+            self.id,
+            self.op,
+            self.kind,
+            repr(self.key)
+        )
+
+
+class BootEvent(db.Model):
+    __tablename__ = 'boot_event'
+    __table_args__ = (
+        db.Index('ix_boot_event_kind_time', 'kind', 'time'),
+        db.Index('ix_boot_event_hostname_time', 'hostname', 'time'),
+        {'sqlite_autoincrement': True}
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    # Epoch seconds, the rate query buckets on it in SQL
+    time = db.Column(db.Float)
+    kind = db.Column(db.String(10))
+    hostname = db.Column(db.String(80))
+    boot_config = db.Column(db.String(80))
+    latency = db.Column(db.Float)
+
+    def __init__(self, time, kind, hostname, boot_config=None, latency=None):
+        self.time = time
+        self.kind = kind
+        self.hostname = hostname
+        self.boot_config = boot_config
+        self.latency = latency
+
+    def __repr__(self):
+        return '<BootEvent {} {} {}>'.format(
+            self.time,
+            self.kind,
+            repr(self.hostname)
+        )
+
+
+def normalize_identifier(kind, value):
+    if value is None or value == '':
+        return None
+    if kind == 'mac':
+        digits = value.replace(':', '').replace('-', '').replace('.', '')
+        if len(digits) != 12:
+            raise ValueError('Bad MAC address {}'.format(repr(value)))
+        int(digits, 16)
+        return ':'.join(digits[i:i + 2] for i in range(0, 12, 2)).lower()
+    if kind == 'ip':
+        return str(ipaddress.ip_address(value))
+    if kind == 'uuid':
+        return str(uuid.UUID(value))
+    raise ValueError('Unknown identifier {}'.format(repr(kind)))
+
+
+def set_machine_identifiers(md, mdjson):
+    # Identifiers left out of the request are left alone
+    for kind in Machine._identifiers:
+        if kind in mdjson:
+            setattr(md, kind, normalize_identifier(kind, mdjson[kind]))
+
+
 def set_machine_definition(mdjson):
     md = get_machine_definition(mdjson['hostname'])
     dbc = get_boot_config_definition(mdjson['default_boot'])
@@ -101,7 +394,9 @@ def set_machine_definition(mdjson):
     md.default_boot = dbc
     md.switch_type = md._switch_type.index(mdjson['switch_type'])
     md.time_between = mdjson['time_between']
+    set_machine_identifiers(md, mdjson)
     db.session.commit()
+    update_state_engine(hostnames=[mdjson['hostname']])
 
 
 def get_list_of_machines():
@@ -117,15 +412,18 @@ def remove_machine_definition(hostname):
     machine = get_machine_definition(hostname)
     db.session.delete(machine)
     db.session.commit()
+    update_state_engine(hostnames=[hostname])
 
 
 def set_boot_config_definition(bcjson):
+    render_cache.compile(bcjson['title'], bcjson['config'])
     bc = get_boot_config_definition(bcjson['title'])
     if bc is None:
         bc = BootConfig(bcjson['title'], bcjson['config'])
         db.session.add(bc)
     bc.config = bcjson['config']
     db.session.commit()
+    update_state_engine(titles=[bcjson['title']])
 
 
 def get_list_of_boot_configs():
@@ -141,34 +439,603 @@ def remove_boot_config_definition(title):
     boot_config = get_boot_config_definition(title)
     db.session.delete(boot_config)
     db.session.commit()
+    render_cache.invalidate(title)
+    update_state_engine(titles=[title])
+
+
+def set_machine_group_definition(mgjson):
+    pattern_type = mgjson.get('pattern_type', 'range')
+    compile_pattern(pattern_type, mgjson['pattern'])
+    mg = get_machine_group_definition(mgjson['name'])
+    dbc = get_boot_config_definition(mgjson['default_boot'])
+    abc = get_boot_config_definition(mgjson['alternate_boot'])
+    if mg is None:
+        mg = MachineGroup(mgjson['name'], mgjson['pattern'], dbc, abc,
+                          mgjson['switch_type'], pattern_type)
+        db.session.add(mg)
+    mg.pattern = mgjson['pattern']
+    mg.pattern_type = mg._pattern_type.index(pattern_type)
+    mg.priority = int(mgjson.get('priority', 0))
+    mg.alternate_boot = abc
+    mg.default_boot = dbc
+    mg.switch_type = mg._switch_type.index(mgjson['switch_type'])
+    mg.time_between = mgjson['time_between']
+    try:
+        # Every boot goes through the combined matcher, so it has to
+        # build before the group is stored
+        load_group_matcher()
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    group_matcher.invalidate()
+    update_state_engine(groups=True)
+
+
+def get_list_of_machine_groups():
+    all_machine_groups = MachineGroup.query.all()
+    return [machine_group.name for machine_group in all_machine_groups]
 
 
-def get_parsed_boot_config(hostname, test=False):
+def get_machine_group_definition(name):
+    return MachineGroup.query.filter_by(name=name).first()
+
+
+def remove_machine_group_definition(name):
+    machine_group = get_machine_group_definition(name)
+    HostState.query.filter_by(group_id=machine_group.id).delete()
+    db.session.delete(machine_group)
+    db.session.commit()
+    group_matcher.invalidate()
+    update_state_engine(groups=True)
+
+
+def load_group_matcher():
+    groups = db.session.query(
+        MachineGroup.id,
+        MachineGroup.pattern_type,
+        MachineGroup.pattern,
+        MachineGroup.priority
+    )
+    return HostMatcher(
+        (group_id, MachineGroup._pattern_type[pattern_type], pattern,
+         (-(priority or 0), group_id))
+        for group_id, pattern_type, pattern, priority in groups
+    )
+
+
+def get_group_member(hostname, persist=True):
+    group_id = group_matcher.get().match(hostname)
+    if group_id is None:
+        return None
+    group = MachineGroup.query.get(group_id)
+    member = HostState.query.filter_by(hostname=hostname).first()
+    if member is None:
+        member = HostState(hostname, group)
+        if persist:
+            db.session.add(member)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Another worker registered the same host first
+                db.session.rollback()
+                member = HostState.query.filter_by(hostname=hostname).first()
+    elif member.group_id != group_id:
+        member.group = group
+        if persist:
+            db.session.commit()
+    return member
+
+
+def build_boot_target_statement():
+    default_boot = BootConfig.__table__.alias('default_boot')
+    alternate_boot = BootConfig.__table__.alias('alternate_boot')
+    selects = []
+    for precedence, table, profile, group_id in [
+            (0, Machine.__table__, Machine.__table__, db.null()),
+            (1, HostState.__table__, MachineGroup.__table__,
+             HostState.__table__.c.group_id)]:
+        joined = table
+        if profile is not table:
+            joined = joined.join(profile, table.c.group_id == profile.c.id)
+        joined = joined.outerjoin(
+            default_boot, profile.c.default_boot_id == default_boot.c.id
+        ).outerjoin(
+            alternate_boot, profile.c.alternate_boot_id == alternate_boot.c.id
+        )
+        selects.append(db.select([
+            group_id.label('group_id'),
+            profile.c.switch_type,
+            profile.c.time_between,
+            table.c.use_alternate,
+            table.c.last_boot,
+            default_boot.c.title,
+            default_boot.c.config,
+            alternate_boot.c.title,
+            alternate_boot.c.config,
+            db.literal(precedence).label('precedence')
+        ]).select_from(joined).where(
+            table.c.hostname == db.bindparam('hostname')))
+    # Machines sort first, they take precedence over group membership.
+    # Not by group_id, databases disagree on where NULLs sort
+    return db.union_all(*selects).order_by('precedence')
+
+
+def get_boot_row(hostname, persist=True):
+    with db.get_engine().connect() as conn:
+        rows = conn.execution_options(compiled_cache=compiled_statements) \
+            .execute(boot_target_statement, hostname=hostname).fetchall()
+    for row in rows:
+        if row[0] is not None and row[0] != group_matcher.get().match(
+                hostname):
+            break
+        return HostRecord(
+            hostname,
+            BootProfile(
+                BootRecord(row[5], row[6]) if row[5] is not None else None,
+                BootRecord(row[7], row[8]) if row[7] is not None else None,
+                row[1],
+                row[2]
+            ),
+            row[0],
+            row[3],
+            row[4]
+        )
+    # First boot of a group member, or its group changed
+    return get_group_member(hostname, persist)
+
+
+def update_boot_row(machine, **state):
+    table = Machine.__table__
+    if getattr(machine, 'group_id', None) is not None:
+        table = HostState.__table__
+    key = (table.name, tuple(sorted(state)))
+    statement = state_update_statements.get(key)
+    if statement is None:
+        statement = state_update_statements[key] = table.update().where(
+            table.c.hostname == db.bindparam('b_hostname')
+        ).values({column: db.bindparam(column) for column in key[1]})
+    with db.get_engine().begin() as conn:
+        conn.execution_options(compiled_cache=compiled_statements).execute(
+            statement, b_hostname=machine.hostname, **state)
+        record_changes(conn, [
+            change_row('state', machine.hostname, 'set', state)])
+    change_notifier.notify()
+
+
+def get_boot_target(hostname, persist=True):
+    if current_app.config['SBM_BOOT_ENGINE'] == 'sql':
+        return get_boot_row(hostname, persist)
     machine = get_machine_definition(hostname)
-    switch_type = machine._switch_type[machine.switch_type]
-    ct = datetime.datetime.now()
-    if switch_type == 'timed':
-        td = datetime.timedelta(seconds=machine.time_between)
-        if machine.last_boot + td > ct:
-            boot_config = machine.alternate_boot
-        else:
-            boot_config = machine.default_boot
-    elif switch_type == 'alternating':
-        if machine.use_alternate:
-            boot_config = machine.alternate_boot
-        else:
-            boot_config = machine.default_boot
-        machine.use_alternate = not machine.use_alternate
-    elif switch_type == 'switched':
-        if machine.use_alternate:
-            boot_config = machine.alternate_boot
-        else:
-            boot_config = machine.default_boot
-    machine.last_boot = ct
-    if not test:
+    if machine is None:
+        machine = get_group_member(hostname, persist)
+    return machine
+
+
+def get_hostname_by_identifier(kind, value):
+    if current_app.config['SBM_BOOT_ENGINE'] == 'memory':
+        return boot_state.get().identify(kind, value)
+    return db.session.query(Machine.hostname).filter(
+        getattr(Machine, kind) == value).scalar()
+
+
+def get_identified_hostname():
+    # iPXE can pass ${mac}, ${ip} and ${uuid}, which saves a reverse lookup
+    with boot_stage_latency.time('identify'):
+        for kind in Machine._identifiers:
+            try:
+                value = normalize_identifier(kind, request.args.get(kind))
+            except ValueError:
+                continue
+            if value is None:
+                continue
+            hostname = get_hostname_by_identifier(kind, value)
+            if hostname is not None:
+                return hostname
+    return get_requesting_hostname()
+
+
+def get_requesting_hostname():
+    with boot_stage_latency.time('dns'):
+        host = resolver.resolve(request.remote_addr)
+    return host.split('.')[0]
+
+
+def load_state_engine():
+    # Pending writes are read first, a flush that lands in between is then
+    # already in the rows read below
+    pending = state_writer.snapshot()
+    engine = StateEngine()
+    for row in db.session.query(
+            BootConfig.id, BootConfig.title, BootConfig.config):
+        engine.add_boot_config(*row)
+    for row in db.session.query(
+            MachineGroup.id,
+            MachineGroup.default_boot_id,
+            MachineGroup.alternate_boot_id,
+            MachineGroup.switch_type,
+            MachineGroup.time_between):
+        engine.add_group(*row)
+    for row in db.session.query(
+            Machine.hostname,
+            Machine.default_boot_id,
+            Machine.alternate_boot_id,
+            Machine.switch_type,
+            Machine.time_between,
+            Machine.use_alternate,
+            Machine.last_boot,
+            Machine.mac,
+            Machine.ip,
+            Machine.uuid):
+        engine.add_machine(*row[:7])
+        for kind, value in zip(Machine._identifiers, row[7:]):
+            if value is not None:
+                engine.add_identifier(kind, value, row[0])
+    for row in db.session.query(
+            HostState.hostname,
+            HostState.group_id,
+            HostState.use_alternate,
+            HostState.last_boot):
+        # An explicit machine wins over state its group left behind
+        if engine.has_group(row[1]) and engine.get(row[0]) is None:
+            engine.add_member(*row)
+    for hostname, state in pending.items():
+        record = engine.get(hostname)
+        if record is not None:
+            for key, value in state.items():
+                setattr(record, key, value)
+    return engine
+
+
+def query_in(query, column, values):
+    values = list(values)
+    for i in range(0, len(values), 500):
+        for row in query.filter(column.in_(values[i:i + 500])):
+            yield row
+
+
+def refresh_boot_configs(engine, titles):
+    found = set()
+    for row in query_in(db.session.query(
+            BootConfig.id, BootConfig.title, BootConfig.config),
+            BootConfig.title, titles):
+        engine.set_boot_config(*row)
+        found.add(row[1])
+    for title in set(titles) - found:
+        engine.remove_boot_config(title)
+
+
+def refresh_groups(engine):
+    group_ids = set()
+    for row in db.session.query(
+            MachineGroup.id,
+            MachineGroup.default_boot_id,
+            MachineGroup.alternate_boot_id,
+            MachineGroup.switch_type,
+            MachineGroup.time_between):
+        engine.add_group(*row)
+        group_ids.add(row[0])
+    for group_id in set(engine.group_ids()) - group_ids:
+        engine.remove_group(group_id)
+
+
+def refresh_hosts(engine, hostnames):
+    # The same rows load_state_engine reads, for these hosts only
+    pending = state_writer.snapshot()
+    hostnames = set(hostnames)
+    engine.remove_identifiers(hostnames)
+    found = set()
+    for row in query_in(db.session.query(
+            Machine.hostname,
+            Machine.default_boot_id,
+            Machine.alternate_boot_id,
+            Machine.switch_type,
+            Machine.time_between,
+            Machine.use_alternate,
+            Machine.last_boot,
+            Machine.mac,
+            Machine.ip,
+            Machine.uuid), Machine.hostname, hostnames):
+        engine.add_machine(*row[:7])
+        for kind, value in zip(Machine._identifiers, row[7:]):
+            if value is not None:
+                engine.add_identifier(kind, value, row[0])
+        found.add(row[0])
+    for row in query_in(db.session.query(
+            HostState.hostname,
+            HostState.group_id,
+            HostState.use_alternate,
+            HostState.last_boot), HostState.hostname, hostnames):
+        if engine.has_group(row[1]) and row[0] not in found:
+            engine.add_member(*row)
+            found.add(row[0])
+    for hostname in hostnames:
+        if hostname not in found:
+            engine.remove_host(hostname)
+        elif hostname in pending:
+            record = engine.get(hostname)
+            for key, value in pending[hostname].items():
+                setattr(record, key, value)
+
+
+def update_state_engine(hostnames=(), titles=(), groups=False):
+    # A loaded engine takes the changed rows in place, reloading it all
+    # would stall the next boot on every write
+    def update(engine):
+        if titles:
+            refresh_boot_configs(engine, titles)
+        if groups:
+            refresh_groups(engine)
+        if hostnames:
+            refresh_hosts(engine, hostnames)
+    boot_state.update(update)
+
+
+def get_host_record(hostname, persist=True):
+    engine = boot_state.get()
+    record = engine.get(hostname)
+    if record is not None and record.group_id is None:
+        return record
+    group_id = group_matcher.get().match(hostname)
+    if group_id is None:
+        return None
+    if record is not None and record.group_id == group_id:
+        return record
+    # First boot of a group member, or its group changed: both are rare,
+    # so the row is written through the ORM as usual
+    member = get_group_member(hostname, persist)
+    if record is not None:
+        state = (record.use_alternate, record.last_boot)
+    else:
+        state = (member.use_alternate, member.last_boot)
+    if not persist:
+        return engine.member(hostname, group_id, *state)
+    return engine.add_member(hostname, group_id, *state)
+
+
+def get_machine_state(hostname, persist=True):
+    if current_app.config['SBM_BOOT_ENGINE'] == 'memory':
+        machine = get_host_record(hostname, persist)
+        if machine is None:
+            return None, None
+        return machine, {
+            'use_alternate': machine.use_alternate,
+            'last_boot': machine.last_boot
+        }
+    pending = state_writer.pending(hostname)
+    machine = get_boot_target(hostname, persist)
+    if machine is None:
+        return None, None
+    state = {
+        'use_alternate': machine.use_alternate,
+        'last_boot': machine.last_boot
+    }
+    if pending:
+        state.update(pending)
+    return machine, state
+
+
+def wait_machine_state(hostname, batch, state):
+    timeout = current_app.config['SBM_STATE_GROUP_TIMEOUT']
+    if not state_writer.wait(batch, timeout):
+        # The group flush failed or is stuck, so this host is written on
+        # its own. If that fails too the caller answers 503, the state
+        # stays queued either way
+        flush_machine_states({hostname: state})
+
+
+def set_machine_state(machine, **state):
+    mode = current_app.config['SBM_STATE_WRITE_MODE']
+    engine = current_app.config['SBM_BOOT_ENGINE']
+    if engine == 'memory':
+        # The record is authoritative, the database catches up behind it.
+        # Immediate mode still waits so a reply means the state is stored
+        for key, value in state.items():
+            setattr(machine, key, value)
+        batch = state_writer.record(machine.hostname, **state)
+        if mode != 'deferred':
+            wait_machine_state(machine.hostname, batch, state)
+    elif mode == 'immediate' and engine == 'sql':
+        update_boot_row(machine, **state)
+    elif mode == 'immediate':
+        for key, value in state.items():
+            setattr(machine, key, value)
         db.session.commit()
-    variables = {v.key: v.value for v in [get_variable_definition(vn) for vn in get_list_of_variables()]}
-    return boot_config.config.format(**variables)
+    elif mode in ('group', 'deferred'):
+        batch = state_writer.record(machine.hostname, **state)
+        if mode == 'group':
+            wait_machine_state(machine.hostname, batch, state)
+    else:
+        raise ValueError('Unknown SBM_STATE_WRITE_MODE {}'.format(repr(mode)))
+    parts = get_components()
+    if parts.script_tree is not None:
+        parts.script_tree.mark(('host', machine.hostname))
+    if parts.state_forwarder is not None:
+        parts.state_forwarder.record(machine.hostname, **state)
+
+
+def flush_machine_states(states):
+    updates = {}
+    for hostname, state in states.items():
+        row = dict(state, b_hostname=hostname)
+        updates.setdefault(tuple(sorted(state)), []).append(row)
+    with db.get_engine().begin() as conn:
+        # A hostname lives in exactly one of these tables, the other
+        # statement matches nothing
+        for table in [Machine.__table__, HostState.__table__]:
+            for columns, rows in updates.items():
+                conn.execute(
+                    table.update()
+                    .where(table.c.hostname == db.bindparam('b_hostname'))
+                    .values({column: db.bindparam(column)
+                             for column in columns}),
+                    rows
+                )
+        record_changes(conn, [
+            change_row('state', hostname, 'set', state)
+            for hostname, state in states.items()
+        ])
+    change_notifier.notify()
+
+
+def get_parsed_boot_config(hostname, test=False, now=None):
+    # Each proxy lookup costs more than a cached render, so the hot path
+    # resolves the app's components once
+    components = get_components()
+    stage_latency = components.boot_stage_latency
+    with stage_latency.time('machine_lookup'):
+        machine, state = get_machine_state(hostname, persist=not test)
+        switch_type = machine._switch_type[machine.switch_type]
+        use_alternate = state['use_alternate']
+        ct = now or datetime.datetime.now()
+        if switch_type == 'timed':
+            td = datetime.timedelta(seconds=machine.time_between)
+            if state['last_boot'] + td > ct:
+                boot_config = machine.alternate_boot
+            else:
+                boot_config = machine.default_boot
+        elif switch_type == 'alternating':
+            if use_alternate:
+                boot_config = machine.alternate_boot
+            else:
+                boot_config = machine.default_boot
+            use_alternate = not use_alternate
+        elif switch_type == 'switched':
+            if use_alternate:
+                boot_config = machine.alternate_boot
+            else:
+                boot_config = machine.default_boot
+    if not test:
+        with stage_latency.time('commit'):
+            set_machine_state(machine, use_alternate=use_alternate,
+                              last_boot=ct)
+        components.boot_count.inc(boot_config.title, switch_type)
+    with stage_latency.time('variable_load'):
+        generation, variables = components.variable_snapshot.snapshot()
+    with stage_latency.time('render'):
+        script = components.render_cache.render(
+            boot_config.title,
+            boot_config.config,
+            variables,
+            generation
+        )
+    if not test:
+        record_boot_event('boot', hostname, boot_config.title, ct.timestamp())
+    return script
+
+
+def record_boot_event(kind, hostname, boot_config=None, when=None):
+    # Only queued here, the ring's own thread writes the events out
+    latency = None
+    if has_request_context() and 'request_start' in g:
+        latency = time.perf_counter() - g.request_start
+    boot_events.record((when or time.time(), kind, hostname, boot_config,
+                        latency))
+
+
+def flush_boot_events(events):
+    with db.get_engine().begin() as conn:
+        conn.execute(BootEvent.__table__.insert(), [{
+            'time': when,
+            'kind': kind,
+            'hostname': hostname,
+            'boot_config': boot_config,
+            'latency': latency
+        } for when, kind, hostname, boot_config, latency in events])
+
+
+def prune_boot_events():
+    with db.get_engine().begin() as conn:
+        head = conn.execute(db.select([db.func.max(BootEvent.id)])).scalar()
+        retention = current_app.config['SBM_BOOT_EVENTS_RETENTION']
+        if head is not None:
+            conn.execute(BootEvent.__table__.delete().where(
+                BootEvent.id <= head - retention))
+
+
+def get_boot_rate(window, bucket):
+    if window <= 0 or bucket <= 0:
+        raise ValueError('window and bucket must be positive')
+    boot_events.flush()
+    now = time.time()
+    since = now - window
+    slot = db.cast(BootEvent.time / bucket, db.Integer).label('slot')
+    with db.get_engine().connect() as conn:
+        rows = conn.execute(
+            db.select([slot, BootEvent.kind, db.func.count()])
+            .where(BootEvent.time >= since)
+            .group_by(slot, BootEvent.kind)
+        ).fetchall()
+    first = int(since / bucket)
+    buckets = [{'time': (first + i) * bucket, 'boots': 0, 'finished': 0}
+               for i in range(int(now / bucket) - first + 1)]
+    totals = {'boot': 0, 'finished': 0}
+    for slot, kind, count in rows:
+        if kind in totals and 0 <= slot - first < len(buckets):
+            buckets[slot - first]['boots' if kind == 'boot' else kind] += \
+                count
+            totals[kind] += count
+    return {
+        'window': window,
+        'bucket': bucket,
+        'boots': totals['boot'],
+        'finished': totals['finished'],
+        'boots_per_second': totals['boot'] / window,
+        'finished_per_second': totals['finished'] / window,
+        'buckets': buckets
+    }
+
+
+def get_unfinished_boots(window, grace, boot_config=None):
+    boot_events.flush()
+    now = time.time()
+    table = BootEvent.__table__
+    booted = db.select([
+        table.c.hostname, db.func.max(table.c.time).label('time')
+    ]).where(db.and_(
+        table.c.kind == 'boot', table.c.time >= now - window
+    )).group_by(table.c.hostname).alias('booted')
+    finished = db.select([
+        table.c.hostname, db.func.max(table.c.time).label('time')
+    ]).where(db.and_(
+        table.c.kind == 'finished', table.c.time >= now - window
+    )).group_by(table.c.hostname).alias('finished')
+    last = table.alias('last')
+    statement = db.select([
+        booted.c.hostname, booted.c.time, last.c.boot_config
+    ]).select_from(booted.outerjoin(
+        finished, finished.c.hostname == booted.c.hostname
+    ).join(last, db.and_(
+        last.c.hostname == booted.c.hostname,
+        last.c.time == booted.c.time,
+        last.c.kind == 'boot'
+    ))).where(db.and_(
+        db.or_(finished.c.time.is_(None), finished.c.time < booted.c.time),
+        booted.c.time <= now - grace
+    )).order_by(booted.c.time)
+    if boot_config is not None:
+        statement = statement.where(last.c.boot_config == boot_config)
+    with db.get_engine().connect() as conn:
+        rows = conn.execute(statement).fetchall()
+    return [{
+        'hostname': hostname,
+        'boot_config': title,
+        'booted': when,
+        'waiting': now - when
+    } for hostname, when, title in rows]
+
+
+def get_host_events(hostname, limit):
+    boot_events.flush()
+    table = BootEvent.__table__
+    with db.get_engine().connect() as conn:
+        rows = conn.execute(
+            db.select([table.c.time, table.c.kind, table.c.boot_config,
+                       table.c.latency])
+            .where(table.c.hostname == hostname)
+            .order_by(table.c.time.desc()).limit(limit)
+        ).fetchall()
+    return [dict(row.items()) for row in rows]
 
 
 def set_variable_definition(vjson):
@@ -179,6 +1046,7 @@ def set_variable_definition(vjson):
     vd.key = vjson['key']
     vd.value = vjson['value']
     db.session.commit()
+    variable_snapshot.invalidate()
 
 
 def get_list_of_variables():
@@ -194,23 +1062,1017 @@ def remove_variable_definition(key):
     variable = get_variable_definition(key)
     db.session.delete(variable)
     db.session.commit()
-
-
-@app.route('/api/v1/machine/', methods=['GET', 'PUT'])
+    variable_snapshot.invalidate()
+
+
+def format_machine(machine):
+    fm = {}
+    fm['switch_type'] = machine._switch_type[machine.switch_type]
+    for item in ['hostname', 'use_alternate', 'last_boot', 'time_between',
+                 'mac', 'ip', 'uuid']:
+        fm[item] = getattr(machine, item)
+    fm.update(state_writer.pending(machine.hostname) or {})
+    for item in ['default_boot', 'alternate_boot']:
+        fm[item] = getattr(machine, item).title
+    return fm
+
+
+def format_machine_group(machine_group):
+    fg = {}
+    fg['switch_type'] = machine_group._switch_type[machine_group.switch_type]
+    fg['pattern_type'] = machine_group._pattern_type[
+        machine_group.pattern_type]
+    for item in ['name', 'pattern', 'priority', 'time_between']:
+        fg[item] = getattr(machine_group, item)
+    for item in ['default_boot', 'alternate_boot']:
+        fg[item] = getattr(machine_group, item).title
+    return fg
+
+
+def format_boot_config(boot_config):
+    return {'title': boot_config.title, 'config': boot_config.config}
+
+
+def format_variable(variable):
+    return {'key': variable.key, 'value': variable.value}
+
+
+def is_page_request():
+    for arg in ['expand', 'limit', 'after', 'boot_config', 'switch_type']:
+        if arg in request.args:
+            return True
+    return False
+
+
+def get_page(query, model, name, format_item):
+    expand = request.args.get('expand', '').lower() in ('1', 'true', 'yes')
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after', type=int)
+    query = query.order_by(model.id)
+    if after is not None:
+        query = query.filter(model.id > after)
+    if limit:
+        rows = query.limit(limit + 1).all()
+    else:
+        rows = query.all()
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = str(rows[-1].id)
+    if expand:
+        items = [format_item(row) for row in rows]
+    else:
+        items = [getattr(row, name) for row in rows]
+    return {'items': items, 'next': next_cursor}
+
+
+def get_page_of_machines():
+    query = Machine.query
+    if request.args.get('expand', '').lower() in ('1', 'true', 'yes'):
+        query = query.options(
+            db.joinedload(Machine.default_boot),
+            db.joinedload(Machine.alternate_boot)
+        )
+    if 'boot_config' in request.args:
+        boot_config = get_boot_config_definition(request.args['boot_config'])
+        boot_config_id = boot_config.id if boot_config is not None else None
+        query = query.filter(db.or_(
+            Machine.default_boot_id == boot_config_id,
+            Machine.alternate_boot_id == boot_config_id
+        ))
+    if 'switch_type' in request.args:
+        query = query.filter_by(switch_type=Machine._switch_type.index(
+            request.args['switch_type']))
+    return get_page(query, Machine, 'hostname', format_machine)
+
+
+def get_page_of_boot_configs():
+    return get_page(BootConfig.query, BootConfig, 'title', format_boot_config)
+
+
+def get_page_of_variables():
+    return get_page(Variable.query, Variable, 'key', format_variable)
+
+
+def build_fleet_statements():
+    machine = Machine.__table__
+    host_state = HostState.__table__
+    machine_group = MachineGroup.__table__
+    default_boot = BootConfig.__table__.alias('default_boot')
+    alternate_boot = BootConfig.__table__.alias('alternate_boot')
+    # Defined machines shadow any state left over from a group
+    member = host_state.c.hostname.notin_(db.select([machine.c.hostname]))
+    sources = [
+        (machine, machine, machine, db.null(), None),
+        (host_state, host_state.join(
+            machine_group, host_state.c.group_id == machine_group.c.id),
+         machine_group, machine_group.c.name, member)
+    ]
+    rows = []
+    switch_types = []
+    boot_configs = []
+    for table, joined, profile, group, where in sources:
+        select = db.select([
+            table.c.hostname,
+            group.label('group'),
+            profile.c.switch_type,
+            profile.c.time_between,
+            table.c.use_alternate,
+            table.c.last_boot,
+            default_boot.c.title.label('default_boot'),
+            alternate_boot.c.title.label('alternate_boot')
+        ]).select_from(joined.outerjoin(
+            default_boot, profile.c.default_boot_id == default_boot.c.id
+        ).outerjoin(
+            alternate_boot, profile.c.alternate_boot_id == alternate_boot.c.id
+        ))
+        counts = db.select([
+            profile.c.switch_type,
+            db.func.count().label('count'),
+            db.func.sum(db.case([(table.c.use_alternate, 1)], else_=0))
+            .label('use_alternate')
+        ]).select_from(joined).group_by(profile.c.switch_type)
+        if where is not None:
+            select = select.where(where)
+            counts = counts.where(where)
+        rows.append(select)
+        switch_types.append(counts)
+        for role, column in [('default', profile.c.default_boot_id),
+                             ('alternate', profile.c.alternate_boot_id)]:
+            references = db.select([
+                db.literal(role).label('role'),
+                BootConfig.__table__.c.title,
+                db.func.count().label('count')
+            ]).select_from(joined.join(
+                BootConfig.__table__, column == BootConfig.__table__.c.id
+            )).group_by(BootConfig.__table__.c.title)
+            if where is not None:
+                references = references.where(where)
+            boot_configs.append(references)
+    return {
+        'rows': db.union_all(*rows).order_by('hostname'),
+        'switch_types': db.union_all(*switch_types),
+        'boot_configs': db.union_all(*boot_configs)
+    }
+
+
+def select_boot(switch_type, use_alternate, last_boot, time_between, now):
+    if switch_type == 'timed':
+        if last_boot is None or time_between is None:
+            return 'default'
+        td = datetime.timedelta(seconds=time_between)
+        return 'alternate' if last_boot + td > now else 'default'
+    return 'alternate' if use_alternate else 'default'
+
+
+def get_dashboard():
+    now = datetime.datetime.now()
+    pending = state_writer.snapshot()
+    with db.get_engine().connect() as conn:
+        conn = conn.execution_options(compiled_cache=compiled_statements)
+        revision = conn.execute(
+            db.select([db.func.max(Change.id)])).scalar() or 0
+        rows = conn.execute(fleet_statements['rows']).fetchall()
+        switch_type_counts = conn.execute(
+            fleet_statements['switch_types']).fetchall()
+        boot_config_counts = conn.execute(
+            fleet_statements['boot_configs']).fetchall()
+    switch_types = {}
+    for switch_type, count, use_alternate in switch_type_counts:
+        counts = switch_types.setdefault(
+            Machine._switch_type[switch_type],
+            {'machines': 0, 'use_alternate': 0}
+        )
+        counts['machines'] += count
+        counts['use_alternate'] += use_alternate or 0
+    boot_configs = {}
+    for role, title, count in boot_config_counts:
+        counts = boot_configs.setdefault(
+            title, {'default': 0, 'alternate': 0, 'selected': 0})
+        counts[role] += count
+    machines = []
+    for row in rows:
+        state = pending.get(row.hostname, {})
+        switch_type = Machine._switch_type[row.switch_type]
+        use_alternate = state.get('use_alternate', row.use_alternate)
+        last_boot = state.get('last_boot', row.last_boot)
+        selected = row.alternate_boot if select_boot(
+            switch_type, use_alternate, last_boot, row.time_between, now
+        ) == 'alternate' else row.default_boot
+        if selected in boot_configs:
+            boot_configs[selected]['selected'] += 1
+        machines.append([
+            row.hostname,
+            row.group,
+            switch_type,
+            row.time_between,
+            use_alternate,
+            last_boot,
+            row.default_boot,
+            row.alternate_boot,
+            selected
+        ])
+    return {
+        'revision': revision,
+        'time': now,
+        'switch_types': switch_types,
+        'boot_configs': boot_configs,
+        # Rows instead of objects, the key names would be most of the payload
+        'columns': ['hostname', 'group', 'switch_type', 'time_between',
+                    'use_alternate', 'last_boot', 'default_boot',
+                    'alternate_boot', 'selected'],
+        'machines': machines
+    }
+
+
+def get_list_etag():
+    # Every committed write adds to the change log, and queued boot state
+    # only changes when a boot is recorded. Read before the list, so a
+    # write racing the query gives an older tag, never a stale body
+    head = get_change_bounds()[1] or 0
+    stats = state_writer.stats()
+    queued = stats['records'] if stats['pending'] else 0
+    return hashlib.sha1('{} {} {}'.format(
+        head, queued, request.full_path).encode('utf8')).hexdigest()
+
+
+def conditional_response(build):
+    etag = get_list_etag()
+    if etag in request.if_none_match:
+        response = make_response('', 304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    return response
+
+
+def render_host_script(hostname):
+    machine, state = get_machine_state(hostname, persist=False)
+    if machine is None:
+        return None
+    script = get_parsed_boot_config(hostname, test=True)
+    expires = None
+    if machine._switch_type[machine.switch_type] == 'timed':
+        expires = state['last_boot'] + datetime.timedelta(
+            seconds=machine.time_between)
+        if expires > datetime.datetime.now():
+            expires = time.mktime(expires.timetuple())
+        else:
+            expires = None
+    return script, expires
+
+
+def get_affected_hostnames(keys):
+    if ('all', None) in keys:
+        hostnames = [hostname for (hostname,) in itertools.chain(
+            db.session.query(Machine.hostname),
+            db.session.query(HostState.hostname))]
+        return hostnames, True
+    hostnames = set(key for kind, key in keys if kind == 'host')
+    titles = set(key for kind, key in keys if kind == 'boot_config')
+    names = set(key for kind, key in keys if kind == 'variable')
+    if names:
+        for title, config in db.session.query(
+                BootConfig.title, BootConfig.config):
+            if compile_template(config).names & names:
+                titles.add(title)
+    if titles:
+        ids = db.session.query(BootConfig.id).filter(
+            BootConfig.title.in_(titles))
+        ids = [boot_config_id for (boot_config_id,) in ids]
+        hostnames.update(hostname for (hostname,) in db.session.query(
+            Machine.hostname
+        ).filter(db.or_(
+            Machine.default_boot_id.in_(ids),
+            Machine.alternate_boot_id.in_(ids)
+        )))
+        hostnames.update(hostname for (hostname,) in db.session.query(
+            HostState.hostname
+        ).join(MachineGroup).filter(db.or_(
+            MachineGroup.default_boot_id.in_(ids),
+            MachineGroup.alternate_boot_id.in_(ids)
+        )))
+    return sorted(hostnames), False
+
+
+def get_materialized_addresses():
+    addresses = dict(
+        (address, host.split('.')[0])
+        for address, host in resolver.static_hosts().items()
+    )
+    addresses.update(db.session.query(Machine.ip, Machine.hostname).filter(
+        Machine.ip.isnot(None)))
+    return addresses
+
+
+def reconcile_access_log():
+    parts = get_components()
+    hits = parts.access_log.read()
+    for when, kind, key in hits:
+        hostname = key
+        if kind == 'ip':
+            hostname = parts.script_tree.hostname_for_address(key)
+        if hostname is None:
+            continue
+        # Replay the boot as the front-end served it
+        when = when.astimezone().replace(tzinfo=None)
+        try:
+            get_parsed_boot_config(hostname, now=when)
+        except Exception:
+            logging.getLogger(__name__).exception(
+                'Failed to reconcile a boot of %s', hostname)
+    return len(hits)
+
+
+def collect_changed_scripts(session, flush_context, instances):
+    keys = session.info.setdefault('sbm_materialize', set())
+    for instance in itertools.chain(
+            session.new, session.dirty, session.deleted):
+        if isinstance(instance, (Machine, HostState)):
+            keys.add(('host', instance.hostname))
+            if isinstance(instance, Machine) and \
+                    db.inspect(instance).attrs.ip.history.has_changes():
+                # Address links are only rebuilt with the whole tree
+                keys.add(('all', None))
+        elif isinstance(instance, BootConfig):
+            keys.add(('boot_config', instance.title))
+        elif isinstance(instance, Variable):
+            keys.add(('variable', instance.key))
+        elif isinstance(instance, MachineGroup):
+            keys.add(('all', None))
+
+
+def mark_changed_scripts(session):
+    keys = session.info.pop('sbm_materialize', None)
+    if keys:
+        mark_scripts(*keys)
+
+
+def discard_changed_scripts(session, *args):
+    session.info.pop('sbm_materialize', None)
+
+
+def change_row(kind, key, op, data=None):
+    if data is not None:
+        data = current_app.json.dumps(data)
+    return {
+        'kind': kind,
+        'key': key,
+        'op': op,
+        'time': datetime.datetime.now(),
+        'data': data
+    }
+
+
+def record_changes(conn, rows):
+    if rows:
+        conn.execute(Change.__table__.insert(), rows)
+
+
+def describe_change(instance, op):
+    formatters = [
+        (Machine, 'machine', 'hostname', format_machine),
+        (BootConfig, 'boot_config', 'title', format_boot_config),
+        (Variable, 'variable', 'key', format_variable),
+        (MachineGroup, 'machine_group', 'name', format_machine_group),
+        (HostState, 'state', 'hostname', None)
+    ]
+    for model, kind, key, formatter in formatters:
+        if isinstance(instance, model):
+            break
+    else:
+        return None
+    if op == 'remove':
+        return change_row(kind, getattr(instance, key), op)
+    if isinstance(instance, Machine) and instance in db.session.dirty:
+        changed = set(attr.key for attr in db.inspect(instance).attrs
+                      if attr.history.has_changes())
+        if changed <= set(['use_alternate', 'last_boot']):
+            formatter = None
+            kind = 'state'
+    if formatter is None:
+        return change_row(kind, getattr(instance, key), op, {
+            'use_alternate': instance.use_alternate,
+            'last_boot': instance.last_boot
+        })
+    try:
+        return change_row(kind, getattr(instance, key), op,
+                          formatter(instance))
+    except AttributeError:
+        # A definition pointing at a missing boot config cannot be
+        # formatted, the change is still worth recording
+        return change_row(kind, getattr(instance, key), op)
+
+
+def collect_changes(session, flush_context, instances):
+    rows = []
+    for instance in session.new:
+        rows.append(describe_change(instance, 'set'))
+    for instance in session.dirty:
+        if session.is_modified(instance):
+            rows.append(describe_change(instance, 'set'))
+    for instance in session.deleted:
+        rows.append(describe_change(instance, 'remove'))
+    rows = [row for row in rows if row is not None]
+    for row in rows:
+        session.add(Change(**row))
+    if rows:
+        session.info['sbm_changes'] = True
+
+
+def notify_changes(session):
+    if session.info.pop('sbm_changes', False):
+        change_notifier.notify()
+
+
+def discard_changes(session, *args):
+    session.info.pop('sbm_changes', None)
+
+
+def prune_changes():
+    with db.get_engine().begin() as conn:
+        head = conn.execute(db.select([db.func.max(Change.id)])).scalar()
+        retention = current_app.config['SBM_CHANGES_RETENTION']
+        if head is not None:
+            conn.execute(Change.__table__.delete().where(
+                Change.id <= head - retention))
+
+
+def get_change_bounds():
+    with db.get_engine().connect() as conn:
+        return tuple(conn.execute(
+            db.select([db.func.min(Change.id), db.func.max(Change.id)])
+        ).fetchone())
+
+
+def reset_caches():
+    variable_snapshot.invalidate()
+    group_matcher.invalidate()
+    boot_state.invalidate()
+    render_cache.invalidate()
+
+
+def apply_remote_states(changes):
+    engine = boot_state.peek()
+    if engine is None:
+        return
+    # The log is in commit order, so later entries win. Hosts with writes
+    # still queued here are newer than anything in the log
+    for change in changes:
+        record = engine.get(change['key'])
+        if change['kind'] != 'state' or record is None or not change['data']:
+            continue
+        if state_writer.pending(change['key']):
+            continue
+        state = dict(change['data'])
+        if state.get('last_boot') is not None:
+            state['last_boot'] = parse_date(state['last_boot']).replace(
+                tzinfo=None)
+            # The log keeps whole seconds, keep the exact time of a write
+            # that came from this process
+            if (record.last_boot is not None and
+                    record.last_boot.replace(microsecond=0) ==
+                    state['last_boot']):
+                del state['last_boot']
+        for key, value in state.items():
+            setattr(record, key, value)
+
+
+def apply_remote_changes(changes):
+    kinds = set(change['kind'] for change in changes)
+    if 'import' in kinds:
+        reset_caches()
+        return
+    if 'variable' in kinds:
+        variable_snapshot.invalidate()
+    if 'machine_group' in kinds:
+        group_matcher.invalidate()
+    hostnames = set(change['key'] for change in changes
+                    if change['kind'] == 'machine')
+    if kinds & set(['machine', 'boot_config', 'machine_group']):
+        update_state_engine(
+            hostnames=hostnames,
+            titles=[change['key'] for change in changes
+                    if change['kind'] == 'boot_config'],
+            groups='machine_group' in kinds)
+    if 'state' in kinds:
+        # Hosts read back above are already newer than their log entries
+        apply_remote_states([change for change in changes
+                             if change['key'] not in hostnames])
+
+
+def get_stored_states(hostnames):
+    hostnames = list(hostnames)
+    stored = {}
+    with db.get_engine().connect() as conn:
+        for table in [HostState.__table__, Machine.__table__]:
+            for i in range(0, len(hostnames), 500):
+                stored.update(conn.execute(
+                    db.select([table.c.hostname, table.c.last_boot])
+                    .where(table.c.hostname.in_(hostnames[i:i + 500]))
+                ).fetchall())
+    return stored
+
+
+def store_states(states, stored):
+    # Group members booted elsewhere first need their own row here
+    for hostname in list(states):
+        if hostname not in stored:
+            if get_group_member(hostname) is None:
+                del states[hostname]
+                continue
+            stored[hostname] = None
+    if states:
+        flush_machine_states(states)
+        engine = boot_state.peek()
+        for hostname, state in states.items():
+            record = engine.get(hostname) if engine is not None else None
+            if record is not None:
+                for key, value in state.items():
+                    setattr(record, key, value)
+        mark_scripts(*[('host', hostname) for hostname in states])
+    return len(states)
+
+
+def apply_forwarded_states(states):
+    updates = {}
+    for hostname, state in states.items():
+        state = dict((key, state[key]) for key in ['use_alternate', 'last_boot']
+                     if key in state)
+        if state.get('last_boot') is not None:
+            state['last_boot'] = datetime.datetime.fromisoformat(
+                state['last_boot'])
+        if state:
+            updates[hostname] = state
+    stored = get_stored_states(updates)
+    for hostname, state in list(updates.items()):
+        # Batches from several replicas can arrive out of order
+        if (state.get('last_boot') is not None and
+                stored.get(hostname) is not None and
+                state['last_boot'] < stored[hostname]):
+            del updates[hostname]
+    return store_states(updates, stored)
+
+
+def forward_states(states):
+    replica_client = get_components().replica_client
+    replica_client.post_json('/api/v1/replica/states/', {'states': dict(
+        (hostname, dict(
+            (key, value.isoformat() if isinstance(value, datetime.datetime)
+             else value)
+            for key, value in state.items()))
+        for hostname, state in states.items()
+    )})
+
+
+def export_replica_snapshot():
+    state_writer.flush()
+    # The revision is read first, so a change racing the export is replayed
+    # on top of it. Replaying a change twice does no harm
+    oldest, head = get_change_bounds()
+    yield current_app.json.dumps(
+        {'type': 'sbm-replica', 'revision': head or 0}) + '\n'
+    with db.get_engine().connect() as conn:
+        for model in replica_models:
+            table = model.__table__
+            for row in conn.execute(db.select([table]).order_by(table.c.id)):
+                yield current_app.json.dumps({'table': table.name, 'row': dict(
+                    (key, value.isoformat()
+                     if isinstance(value, datetime.datetime) else value)
+                    for key, value in row.items()
+                )}) + '\n'
+
+
+def bootstrap_replica(client):
+    tables = dict((model.__table__.name, model.__table__)
+                  for model in replica_models)
+    rows = dict((name, []) for name in tables)
+    records = client.stream_ndjson('/api/v1/replica/snapshot/')
+    revision = next(records)['revision']
+    for record in records:
+        table = tables[record['table']]
+        row = record['row']
+        for column in table.columns:
+            if (isinstance(column.type, db.DateTime) and
+                    row.get(column.name) is not None):
+                row[column.name] = datetime.datetime.fromisoformat(
+                    row[column.name])
+        rows[table.name].append(row)
+    state_writer.flush()
+    with db.get_engine().begin() as conn:
+        # Rows keep the primary's ids, so references need no mapping
+        for model in reversed(replica_models):
+            conn.execute(model.__table__.delete())
+        for model in replica_models:
+            if rows[model.__table__.name]:
+                conn.execute(model.__table__.insert(),
+                             rows[model.__table__.name])
+        record_changes(conn, [change_row('import', None, 'resync')])
+    change_notifier.notify()
+    reset_caches()
+    mark_all_scripts()
+    return revision
+
+
+def apply_replicated_states(states):
+    stored = get_stored_states(states)
+    updates = {}
+    for hostname, state in states.items():
+        if (state_writer.pending(hostname) or
+                get_components().state_forwarder.pending(hostname)):
+            continue
+        state = dict(state)
+        if state.get('last_boot') is not None:
+            state['last_boot'] = parse_date(state['last_boot']).replace(
+                tzinfo=None)
+            # Our own boots come back from the primary, and the feed keeps
+            # whole seconds, so only strictly newer boots replace ours
+            if (stored.get(hostname) is not None and
+                    state['last_boot'] <=
+                    stored[hostname].replace(microsecond=0)):
+                continue
+        updates[hostname] = state
+    return store_states(updates, stored)
+
+
+def apply_replicated_changes(changes):
+    handlers = {
+        'machine': (set_machine_definition, get_machine_definition,
+                    remove_machine_definition),
+        'boot_config': (set_boot_config_definition,
+                        get_boot_config_definition,
+                        remove_boot_config_definition),
+        'variable': (set_variable_definition, get_variable_definition,
+                     remove_variable_definition),
+        'machine_group': (set_machine_group_definition,
+                          get_machine_group_definition,
+                          remove_machine_group_definition)
+    }
+    states = {}
+    for change in changes:
+        if change['kind'] == 'state':
+            if change['data']:
+                states.setdefault(change['key'], {}).update(
+                    change['data'])
+            continue
+        if states:
+            apply_replicated_states(states)
+            states = {}
+        if change['kind'] not in handlers:
+            continue
+        set_fn, get_fn, remove_fn = handlers[change['kind']]
+        if change['op'] == 'remove':
+            if get_fn(change['key']) is not None:
+                remove_fn(change['key'])
+        elif change['data'] is not None:
+            set_fn(change['data'])
+    if states:
+        apply_replicated_states(states)
+
+
+def get_replica_lock_path(app):
+    if app.config['SBM_REPLICA_LOCK']:
+        return app.config['SBM_REPLICA_LOCK']
+    url = db.get_engine(app).url
+    if url.drivername.startswith('sqlite') and url.database not in (
+            None, '', ':memory:'):
+        return url.database + '.replica-lock'
+    return None
+
+
+def get_changes(since, limit):
+    table = Change.__table__
+    with db.get_engine().connect() as conn:
+        rows = conn.execute(
+            db.select([table]).where(table.c.id > since)
+            .order_by(table.c.id).limit(limit)
+        ).fetchall()
+    return [{
+        'revision': row.id,
+        'kind': row.kind,
+        'key': row.key,
+        'op': row.op,
+        'time': row.time,
+        'data': (current_app.json.loads(row.data)
+                 if row.data is not None else None)
+    } for row in rows]
+
+
+def load_variables():
+    return dict(db.session.query(Variable.key, Variable.value))
+
+
+boot_target_statement = build_boot_target_statement()
+state_update_statements = {}
+fleet_statements = build_fleet_statements()
+compiled_statements = {}
+replica_models = [BootConfig, Variable, MachineGroup, Machine, HostState]
+# Endpoints that only touch this process, replicas accept writes to these
+REPLICA_LOCAL_PATHS = ['/api/v1/state_engine/', '/api/v1/materialize/',
+                       '/api/v1/resolver/']
+# Long-polls mostly sleep, metrics must stay reachable under load
+ADMISSION_EXEMPT_PATHS = ['/metrics', '/static/', '/api/v1/changes/',
+                          '/api/v1/admission/']
+
+
+def mark_scripts(*keys):
+    script_tree = get_components().script_tree
+    if script_tree is not None and keys:
+        script_tree.mark(*keys)
+
+
+def mark_all_scripts():
+    script_tree = get_components().script_tree
+    if script_tree is not None:
+        script_tree.mark_all()
+
+
+event.listen(db.session, 'before_flush', collect_changes)
+event.listen(db.session, 'after_commit', notify_changes)
+event.listen(db.session, 'after_rollback', discard_changes)
+event.listen(db.session, 'before_flush', collect_changed_scripts)
+event.listen(db.session, 'after_commit', mark_changed_scripts)
+event.listen(db.session, 'after_rollback', discard_changed_scripts)
+
+
+def bind(app, fn):
+    # Component threads run outside any request, so callbacks get an app
+    # context of their own unless they are already inside one of this app
+    def call(*args, **kwargs):
+        if has_app_context() and current_app._get_current_object() is app:
+            return fn(*args, **kwargs)
+        with app.app_context():
+            return fn(*args, **kwargs)
+    return call
+
+
+class Components(object):
+    def __init__(self, app):
+        config = app.config
+        self.resolver = HostResolver(
+            positive_ttl=config['SBM_DNS_POSITIVE_TTL'],
+            negative_ttl=config['SBM_DNS_NEGATIVE_TTL'],
+            max_entries=config['SBM_DNS_CACHE_SIZE'],
+            timeout=config['SBM_DNS_TIMEOUT'],
+            workers=config['SBM_DNS_WORKERS']
+        )
+        load_static_hosts(self.resolver, config)
+        self.variable_snapshot = Snapshot(load_variables)
+        self.group_matcher = Snapshot(load_group_matcher)
+        self.boot_state = Snapshot(load_state_engine)
+        self.render_cache = RenderCache()
+        self.change_notifier = ChangeNotifier(
+            poll_interval=config['SBM_CHANGES_POLL_INTERVAL'],
+            prune_fn=bind(app, prune_changes)
+        )
+        self.change_follower = ChangeFollower(
+            get_change_bounds,
+            lambda since, head: get_changes(since, head - since),
+            apply_remote_changes,
+            reset_caches,
+            interval=config['SBM_CACHE_CHECK_INTERVAL']
+        )
+        self.state_writer = WriteBehindQueue(
+            bind(app, flush_machine_states),
+            interval=config['SBM_STATE_FLUSH_INTERVAL'],
+            max_pending=config['SBM_STATE_FLUSH_SIZE']
+        )
+        self.admission_gates = {
+            'boot': AdmissionGate(
+                config['SBM_ADMISSION_BOOT_LIMIT'],
+                queue_size=config['SBM_ADMISSION_BOOT_QUEUE'],
+                timeout=config['SBM_ADMISSION_BOOT_TIMEOUT']
+            ),
+            # Kept apart so a boot storm cannot lock operators out
+            'management': AdmissionGate(
+                config['SBM_ADMISSION_MANAGEMENT_LIMIT'],
+                queue_size=config['SBM_ADMISSION_MANAGEMENT_QUEUE'],
+                timeout=config['SBM_ADMISSION_MANAGEMENT_TIMEOUT']
+            )
+        }
+        self.boot_events = EventRing(
+            bind(app, flush_boot_events),
+            capacity=config['SBM_BOOT_EVENTS_CAPACITY'],
+            interval=config['SBM_BOOT_EVENTS_FLUSH_INTERVAL'],
+            batch_size=config['SBM_BOOT_EVENTS_BATCH_SIZE'],
+            prune_fn=bind(app, prune_boot_events)
+        )
+        self.script_tree = None
+        self.access_log = None
+        if config['SBM_MATERIALIZE_DIR']:
+            if config['SBM_MATERIALIZE_ACCESS_LOG']:
+                self.access_log = AccessLogReader(
+                    config['SBM_MATERIALIZE_ACCESS_LOG'],
+                    config['SBM_MATERIALIZE_LOG_PATTERN']
+                )
+            self.script_tree = ScriptTree(
+                config['SBM_MATERIALIZE_DIR'],
+                bind(app, render_host_script),
+                bind(app, get_affected_hostnames),
+                addresses_fn=bind(app, get_materialized_addresses),
+                poll_fn=(bind(app, reconcile_access_log)
+                         if self.access_log is not None else None),
+                interval=config['SBM_MATERIALIZE_INTERVAL']
+            )
+        self.replica_client = None
+        self.change_stream = None
+        self.state_forwarder = None
+        if config['SBM_REPLICA_OF']:
+            self.replica_client = PrimaryClient(
+                config['SBM_REPLICA_OF'],
+                timeout=config['SBM_REPLICA_TIMEOUT']
+            )
+            self.change_stream = ChangeStream(
+                self.replica_client,
+                bind(app, bootstrap_replica),
+                bind(app, apply_replicated_changes),
+                wait=config['SBM_REPLICA_WAIT'],
+                lock_path=get_replica_lock_path(app)
+            )
+            self.state_forwarder = WriteBehindQueue(
+                bind(app, forward_states),
+                interval=config['SBM_REPLICA_FORWARD_INTERVAL'],
+                max_pending=config['SBM_REPLICA_FORWARD_SIZE']
+            )
+        self.build_metrics()
+
+    def build_metrics(self):
+        metrics = self.metrics = Registry()
+        self.request_count = metrics.counter(
+            'sbm_http_requests_total',
+            'HTTP requests by route, method and status',
+            ['route', 'method', 'status']
+        )
+        self.request_latency = metrics.histogram(
+            'sbm_http_request_duration_seconds',
+            'HTTP request latency by route',
+            ['route']
+        )
+        self.boot_stage_latency = metrics.histogram(
+            'sbm_boot_stage_duration_seconds',
+            'Time spent in each stage of serving a boot',
+            ['stage']
+        )
+        self.boot_count = metrics.counter(
+            'sbm_boots_total',
+            'Boots served by boot config and switch type',
+            ['boot_config', 'switch_type']
+        )
+        self.boot_finished_count = metrics.counter(
+            'sbm_boot_finished_total',
+            'Calls to /api/v1/boot/finished/'
+        )
+        for name in ['hits', 'misses', 'negative_hits', 'static_hits',
+                     'timeouts', 'evictions']:
+            metrics.gauge(
+                'sbm_resolver_{}_total'.format(name),
+                'Reverse DNS cache {}'.format(name.replace('_', ' ')),
+                lambda name=name: self.resolver.stats()[name],
+                kind='counter'
+            )
+        metrics.gauge(
+            'sbm_resolver_cache_entries',
+            'Addresses held in the reverse DNS cache',
+            lambda: self.resolver.stats()['size']
+        )
+        for name in ['checks', 'replayed', 'resets']:
+            metrics.gauge(
+                'sbm_cache_coherency_{}_total'.format(name),
+                'Change log {} by the cache coherency check'.format(name),
+                lambda name=name: self.change_follower.stats()[name],
+                kind='counter'
+            )
+        for gate_name in ['boot', 'management']:
+            for name in ['active', 'queued']:
+                metrics.gauge(
+                    'sbm_admission_{}_{}'.format(gate_name, name),
+                    'Requests {} at the {} admission gate'.format(
+                        name, gate_name),
+                    lambda gate_name=gate_name, name=name:
+                        self.admission_gates[gate_name].stats()[name]
+                )
+            for name in ['admitted', 'queue_full', 'timeout']:
+                metrics.gauge(
+                    'sbm_admission_{}_{}_total'.format(gate_name, name),
+                    'Requests {} by the {} admission gate'.format(
+                        name.replace('_', ' '), gate_name),
+                    lambda gate_name=gate_name, name=name:
+                        self.admission_gates[gate_name].stats()[name],
+                    kind='counter'
+                )
+        for name in ['recorded', 'dropped', 'flushed']:
+            metrics.gauge(
+                'sbm_boot_events_{}_total'.format(name),
+                'Boot events {} by the telemetry ring'.format(name),
+                lambda name=name: self.boot_events.stats()[name],
+                kind='counter'
+            )
+
+
+# Only ever append: a database's version is the number of steps it has
+# run. Steps create what is missing from the current models, so a fresh
+# database gets the whole schema from the first one and skips the rest
+schema_migrations = [
+    create_tables(BootConfig.__table__, Machine.__table__,
+                  Variable.__table__),
+    create_tables(MachineGroup.__table__, HostState.__table__),
+    add_columns(Machine.__table__, 'mac', 'ip', 'uuid'),
+    create_indexes(Machine.__table__, 'ix_machine_mac', 'ix_machine_ip',
+                   'ix_machine_uuid'),
+    create_tables(Change.__table__),
+    create_tables(BootEvent.__table__)
+]
+schema_versions = {}
+schema_lock = threading.Lock()
+
+
+def ensure_schema():
+    # Once per process and database, on first use rather than at import
+    uri = current_app.config['SQLALCHEMY_DATABASE_URI']
+    if uri not in schema_versions:
+        with schema_lock:
+            if uri not in schema_versions:
+                schema_versions[uri] = migrate(db.get_engine(),
+                                               schema_migrations)
+    return schema_versions[uri]
+
+
+def create_app(config=None):
+    # Every call builds a separate app with its own caches, queues and
+    # threads. Settings come from SBM_CONFIG and the environment, then
+    # config (a mapping or a file) on top
+    app = Flask(__name__)
+    load_config(app.config)
+    overrides = Config(app.root_path)
+    if isinstance(config, str):
+        load_config_file(overrides, config)
+    elif config:
+        overrides.update(config)
+    if 'SBM_DATABASE_URI' in overrides:
+        overrides.setdefault('SQLALCHEMY_DATABASE_URI',
+                             overrides['SBM_DATABASE_URI'])
+    app.config.update(overrides)
+    set_defaults(app.config)
+    if app.config['SBM_SQL_ECHO']:
+        logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+    db.init_app(app)
+    with app.app_context():
+        components = app.extensions['sbm'] = Components(app)
+    app.register_blueprint(blueprint)
+    if components.script_tree is not None:
+        # The tree starts reading the database right away, so it has to be
+        # migrated first rather than by the first request
+        if app.config['SBM_AUTO_MIGRATE']:
+            with app.app_context():
+                ensure_schema()
+        components.script_tree.mark_all()
+    # Otherwise done by the first query, in every forked worker
+    configure_mappers()
+    return app
+
+
+default_app = None
+default_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    # sbm.sbm:app named the one app before create_app built a new one per
+    # call. It is built from the environment on first use, not at import
+    global default_app
+    if name != 'app':
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+    with default_app_lock:
+        if default_app is None:
+            default_app = create_app()
+    return default_app
+
+
+os.register_at_fork(after_in_child=db.discard_connections)
+
+
+@blueprint.route('/api/v1/machine/', methods=['GET', 'PUT'])
 def api_v1_machine():
     if request.method == 'PUT':
         try:
             set_machine_definition(request.get_json())
         except Exception as ex:
             return make_response(jsonify(err=traceback.format_exc()), 406)
+    switch_type = request.args.get('switch_type')
+    if switch_type is not None and switch_type not in Machine._switch_type:
+        return make_response(jsonify(
+            err='Unknown switch_type {}'.format(switch_type)), 400)
     try:
-        machine_list = get_list_of_machines()
+        if is_page_request():
+            return conditional_response(
+                lambda: jsonify(**get_page_of_machines()))
+        return conditional_response(
+            lambda: jsonify(*get_list_of_machines()))
     except Exception as ex:
         return make_response(jsonify(err=traceback.format_exc()), 404)
-    return jsonify(*machine_list)
 
 
-@app.route('/api/v1/boot_config/', methods=['GET', 'PUT'])
+@blueprint.route('/api/v1/boot_config/', methods=['GET', 'PUT'])
 def api_v1_boot_config():
     if request.method == 'PUT':
         try:
@@ -218,13 +2080,16 @@ def api_v1_boot_config():
         except Exception as ex:
             return make_response(jsonify(err=traceback.format_exc()), 406)
     try:
-        boot_config_list = get_list_of_boot_configs()
+        if is_page_request():
+            return conditional_response(
+                lambda: jsonify(**get_page_of_boot_configs()))
+        return conditional_response(
+            lambda: jsonify(*get_list_of_boot_configs()))
     except Exception as ex:
         return make_response(jsonify(err=traceback.format_exc()), 404)
-    return jsonify(*boot_config_list)
 
 
-@app.route('/api/v1/variable/', methods=['GET', 'PUT'])
+@blueprint.route('/api/v1/variable/', methods=['GET', 'PUT'])
 def api_v1_variable():
     if request.method == 'PUT':
         try:
@@ -232,13 +2097,17 @@ def api_v1_variable():
         except Exception as ex:
             return make_response(jsonify(err=traceback.format_exc()), 406)
     try:
-        variable_list = get_list_of_variables()
+        if is_page_request():
+            return conditional_response(
+                lambda: jsonify(**get_page_of_variables()))
+        return conditional_response(
+            lambda: jsonify(*get_list_of_variables()))
     except Exception as ex:
         return make_response(jsonify(err=traceback.format_exc()), 404)
-    return jsonify(*variable_list)
 
 
-@app.route('/api/v1/machine/<hostname>/', methods=['GET', 'POST', 'DELETE'])
+@blueprint.route('/api/v1/machine/<hostname>/',
+                 methods=['GET', 'POST', 'DELETE'])
 def api_v1_machine_hostname(hostname):
     if request.method == 'POST':
         try:
@@ -256,18 +2125,14 @@ def api_v1_machine_hostname(hostname):
             return make_response(jsonify(err=traceback.format_exc()), 406)
         return jsonify(status="ok")
     try:
-        fm = {}
-        fm['switch_type'] = machine._switch_type[machine.switch_type]
-        for item in ['hostname', 'use_alternate', 'last_boot', 'time_between']:
-            fm[item] = getattr(machine, item)
-        for item in ['default_boot', 'alternate_boot']:
-            fm[item] = getattr(machine, item).title
+        fm = format_machine(machine)
     except:
         return make_response(jsonify(err=traceback.format_exc()), 404)
     return jsonify(**fm)
 
 
-@app.route('/api/v1/boot_config/<title>/', methods=['GET', 'POST', 'DELETE'])
+@blueprint.route('/api/v1/boot_config/<title>/',
+                 methods=['GET', 'POST', 'DELETE'])
 def api_v1_boot_config_title(title):
     if request.method == 'POST':
         try:
@@ -293,7 +2158,7 @@ def api_v1_boot_config_title(title):
     return jsonify(**formatted_boot_config)
 
 
-@app.route('/api/v1/variable/<key>/', methods=['GET', 'POST', 'DELETE'])
+@blueprint.route('/api/v1/variable/<key>/', methods=['GET', 'POST', 'DELETE'])
 def api_v1_variable_key(key):
     if request.method == 'POST':
         try:
@@ -320,17 +2185,75 @@ def api_v1_variable_key(key):
     return jsonify(**fv)
 
 
-@app.route('/api/v1/boot/', methods=['GET'])
+@blueprint.route('/api/v1/machine_group/', methods=['GET', 'PUT'])
+def api_v1_machine_group():
+    if request.method == 'PUT':
+        try:
+            set_machine_group_definition(request.get_json())
+        except Exception as ex:
+            return make_response(jsonify(err=traceback.format_exc()), 406)
+    try:
+        return conditional_response(
+            lambda: jsonify(*get_list_of_machine_groups()))
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 404)
+
+
+@blueprint.route('/api/v1/machine_group/<name>/',
+                 methods=['GET', 'POST', 'DELETE'])
+def api_v1_machine_group_name(name):
+    if request.method == 'POST':
+        try:
+            set_machine_group_definition(request.get_json())
+        except Exception as ex:
+            return make_response(jsonify(err=traceback.format_exc()), 406)
+    try:
+        machine_group = get_machine_group_definition(name)
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 404)
+    if request.method == 'DELETE':
+        try:
+            remove_machine_group_definition(name)
+        except Exception as ex:
+            return make_response(jsonify(err=traceback.format_exc()), 406)
+        return jsonify(status="ok")
+    try:
+        fg = format_machine_group(machine_group)
+    except:
+        return make_response(jsonify(err=traceback.format_exc()), 404)
+    return jsonify(**fg)
+
+
+@blueprint.route('/api/v1/machine_group/match/<hostname>/', methods=['GET'])
+def api_v1_machine_group_match(hostname):
+    try:
+        machine = get_boot_target(hostname, persist=False)
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 404)
+    if machine is None:
+        return make_response(jsonify(hostname=hostname, match=None), 404)
+    # Set on group members by every engine, ORM rows and host records alike
+    group_id = getattr(machine, 'group_id', None)
+    if group_id is not None:
+        return jsonify(hostname=hostname, match='group',
+                       group=MachineGroup.query.get(group_id).name)
+    return jsonify(hostname=hostname, match='machine')
+
+
+@blueprint.route('/api/v1/boot/', methods=['GET'])
 def api_v1_boot():
     try:
-        host = socket.gethostbyaddr(request.remote_addr)[0]
+        host = get_identified_hostname()
     except socket.herror as ex:
         return make_response(jsonify(err=traceback.format_exc()), 404)
-    host = host.split('.')[0]
-    return get_parsed_boot_config(host)
+    try:
+        return get_parsed_boot_config(host)
+    except SQLAlchemyError:
+        current_app.logger.exception('Could not store the boot of %s', host)
+        return retry_later('Boot state not stored, retry later')
 
 
-@app.route('/api/v1/boot/test/<hostname>/', methods=['GET'])
+@blueprint.route('/api/v1/boot/test/<hostname>/', methods=['GET'])
 def api_v1_boot_test(hostname):
     try:
         return get_parsed_boot_config(hostname, test=True)
@@ -338,34 +2261,276 @@ def api_v1_boot_test(hostname):
         return traceback.format_exc()
 
 
-@app.route('/api/v1/boot/finished/', methods=['GET'])
+@blueprint.route('/api/v1/boot/finished/', methods=['GET'])
 def api_v1_boot_finished():
     try:
-        host = socket.gethostbyaddr(request.remote_addr)[0]
+        host = get_identified_hostname()
     except socket.herror as ex:
         return make_response(jsonify(err=traceback.format_exc()), 404)
-    host = host.split('.')[0]
-    machine = get_machine_definition(host)
-    machine.use_alternate = not machine.use_alternate
-    db.session.commit()
+    machine, state = get_machine_state(host)
+    try:
+        set_machine_state(machine, use_alternate=not state['use_alternate'])
+    except SQLAlchemyError:
+        current_app.logger.exception('Could not store the boot of %s', host)
+        return retry_later('Boot state not stored, retry later')
+    boot_finished_count.inc()
+    record_boot_event('finished', host)
     return jsonify(status="ok")
 
 
-@app.route('/machines')
+@blueprint.route('/api/v1/resolver/', methods=['GET', 'DELETE'])
+def api_v1_resolver():
+    if request.method == 'DELETE':
+        resolver.clear()
+    return jsonify(**resolver.stats())
+
+
+@blueprint.route('/api/v1/state_engine/', methods=['GET', 'DELETE'])
+def api_v1_state_engine():
+    if request.method == 'DELETE':
+        state_writer.flush()
+        boot_state.invalidate()
+    return jsonify(engine=current_app.config['SBM_BOOT_ENGINE'],
+                   **boot_state.get().stats())
+
+
+@blueprint.route('/api/v1/materialize/', methods=['GET', 'POST'])
+def api_v1_materialize():
+    script_tree = get_components().script_tree
+    if script_tree is None:
+        return make_response(
+            jsonify(err='Set SBM_MATERIALIZE_DIR to materialize boot scripts'),
+            404)
+    if request.method == 'POST':
+        state_writer.flush()
+        script_tree.mark_all()
+        script_tree.sync()
+    return jsonify(root=script_tree.root, **script_tree.stats())
+
+
+@blueprint.route('/api/v1/materialize/reconcile/', methods=['POST'])
+def api_v1_materialize_reconcile():
+    parts = get_components()
+    if parts.access_log is None:
+        return make_response(
+            jsonify(err='Set SBM_MATERIALIZE_ACCESS_LOG to reconcile boots'),
+            404)
+    try:
+        boots = reconcile_access_log()
+        parts.script_tree.sync()
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+    return jsonify(status="ok", boots=boots)
+
+
+@blueprint.route('/api/v1/dashboard/', methods=['GET'])
+def api_v1_dashboard():
+    try:
+        return jsonify(**get_dashboard())
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 404)
+
+
+@blueprint.route('/api/v1/admission/', methods=['GET'])
+def api_v1_admission():
+    return jsonify(**dict(
+        (name, gate.stats()) for name, gate in admission_gates.items()))
+
+
+@blueprint.route('/api/v1/boot_events/', methods=['GET'])
+def api_v1_boot_events():
+    return jsonify(**boot_events.stats())
+
+
+@blueprint.route('/api/v1/boot_events/rate/', methods=['GET'])
+def api_v1_boot_events_rate():
+    try:
+        return jsonify(**get_boot_rate(
+            request.args.get('window', 60, type=float),
+            request.args.get('bucket', 1, type=float)))
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+
+
+@blueprint.route('/api/v1/boot_events/unfinished/', methods=['GET'])
+def api_v1_boot_events_unfinished():
+    try:
+        return jsonify(unfinished=get_unfinished_boots(
+            request.args.get('window', 3600, type=float),
+            request.args.get('grace', 300, type=float),
+            request.args.get('boot_config')))
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+
+
+@blueprint.route('/api/v1/boot_events/host/<hostname>/', methods=['GET'])
+def api_v1_boot_events_host(hostname):
+    try:
+        return jsonify(hostname=hostname, events=get_host_events(
+            hostname, request.args.get('limit', 50, type=int)))
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+
+
+@blueprint.route('/api/v1/replica/', methods=['GET'])
+def api_v1_replica():
+    parts = get_components()
+    if parts.change_stream is None:
+        return jsonify(role='primary')
+    return jsonify(role='replica', forwarder=parts.state_forwarder.stats(),
+                   **parts.change_stream.stats())
+
+
+@blueprint.route('/api/v1/replica/snapshot/', methods=['GET'])
+def api_v1_replica_snapshot():
+    return Response(stream_with_context(export_replica_snapshot()),
+                    mimetype='application/x-ndjson')
+
+
+@blueprint.route('/api/v1/replica/states/', methods=['POST'])
+def api_v1_replica_states():
+    try:
+        applied = apply_forwarded_states(request.get_json()['states'])
+    except Exception as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+    return jsonify(status="ok", applied=applied)
+
+
+@blueprint.route('/api/v1/changes/', methods=['GET'])
+def api_v1_changes():
+    try:
+        since = int(request.args.get('since', 0))
+        limit = max(0, min(int(request.args.get('limit', 500)), 5000))
+        wait = max(0.0, min(float(request.args.get('wait', 0)),
+                            current_app.config['SBM_CHANGES_MAX_WAIT']))
+    except ValueError as ex:
+        return make_response(jsonify(err=traceback.format_exc()), 406)
+    oldest, head = get_change_bounds()
+    if oldest is not None and since < oldest - 1:
+        # Pruned past the caller, it has to reload the lists
+        return make_response(
+            jsonify(err='Revision {} is no longer kept'.format(since),
+                    head=head), 410)
+    changes = []
+    if limit:
+        changes = change_notifier.wait(
+            lambda: get_changes(since, limit), wait)
+    return jsonify(
+        revision=changes[-1]['revision'] if changes else since,
+        head=max(head or 0, changes[-1]['revision'] if changes else 0),
+        changes=changes,
+        more=len(changes) == limit and limit > 0
+    )
+
+
+@blueprint.route('/metrics', methods=['GET'])
+def render_metrics():
+    return current_app.response_class(metrics.render(),
+                                      content_type=METRICS_CONTENT_TYPE)
+
+
+@blueprint.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@blueprint.before_app_request
+def prepare_schema():
+    if current_app.config['SBM_AUTO_MIGRATE']:
+        ensure_schema()
+
+
+def retry_later(err):
+    # Jitter spreads the retries of a whole rack over a few seconds
+    retry_after = current_app.config['SBM_ADMISSION_RETRY_AFTER']
+    response = make_response(jsonify(err=err), 503)
+    response.headers['Retry-After'] = str(
+        random.randint(retry_after, 2 * retry_after))
+    return response
+
+
+@blueprint.before_app_request
+def admit_request():
+    if not current_app.config['SBM_ADMISSION_CONTROL'] or any(
+            request.path.startswith(path) for path in ADMISSION_EXEMPT_PATHS):
+        return None
+    gate_name = 'management'
+    if request.path.startswith('/api/v1/boot/'):
+        gate_name = 'boot'
+    reason = admission_gates[gate_name].acquire()
+    if reason is not None:
+        return retry_later('Too busy ({}), retry later'.format(reason))
+    g.admission_gate = admission_gates[gate_name]
+    return None
+
+
+@blueprint.teardown_app_request
+def release_admission(exc):
+    gate = g.pop('admission_gate', None)
+    if gate is not None:
+        gate.release()
+
+
+@blueprint.before_app_request
+def check_replica():
+    parts = get_components()
+    if parts.change_stream is None:
+        return None
+    parts.change_stream.ensure_started()
+    if request.method not in ('GET', 'HEAD', 'OPTIONS') and not any(
+            request.path.startswith(path) for path in REPLICA_LOCAL_PATHS):
+        return make_response(jsonify(
+            err='Read-only replica, send changes to {}'.format(
+                parts.replica_client.url)), 403)
+    return None
+
+
+@blueprint.before_app_request
+def check_cache_coherency():
+    # Other worker processes write to the same database
+    if current_app.config['SBM_CACHE_COHERENCY']:
+        try:
+            change_follower.check()
+        except Exception:
+            current_app.logger.exception('Failed to check the change log')
+
+
+@blueprint.after_app_request
+def record_request_metrics(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency.observe(time.perf_counter() - start, route)
+        request_count.inc(route, request.method, str(response.status_code))
+    return response
+
+
+@blueprint.route('/machines')
 def render_machines():
     return render_template('machines.html')
 
 
-@app.route('/')
+@blueprint.route('/dashboard')
+def render_dashboard():
+    return render_template('dashboard.html')
+
+
+@blueprint.route('/')
 def render_home():
     return render_template('home.html')
 
 
-@app.route('/boot_configs')
+@blueprint.route('/boot_configs')
 def render_boot_configs():
     return render_template('boot_configs.html')
 
 
-@app.route('/variables')
+@blueprint.route('/variables')
 def render_variables():
     return render_template('variables.html')
+
+
+@blueprint.cli.command('migrate')
+def migrate_command():
+    found, version = ensure_schema()
+    print('Schema at version {} (was {})'.format(version, found))
@@ -0,0 +1,83 @@
+import logging
+
+from sqlalchemy import Column, Integer, MetaData, Table, inspect, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateColumn
+
+log = logging.getLogger(__name__)
+
+version_table = Table(
+    'sbm_schema', MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('version', Integer, nullable=False)
+)
+
+
+# Every step checks what is already there, so a database created before
+# versioning existed can run all of them and be stamped with the result
+def create_tables(*tables):
+    def step(conn):
+        for table in tables:
+            table.create(conn, checkfirst=True)
+    return step
+
+
+def add_columns(table, *names):
+    def step(conn):
+        existing = set(column['name']
+                       for column in inspect(conn).get_columns(table.name))
+        for name in names:
+            if name not in existing:
+                conn.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                    table.name,
+                    CreateColumn(table.c[name]).compile(dialect=conn.dialect)))
+    return step
+
+
+def create_indexes(table, *names):
+    def step(conn):
+        existing = set(index['name']
+                       for index in inspect(conn).get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in names and index.name not in existing:
+                index.create(conn)
+    return step
+
+
+def get_version(conn):
+    return conn.execute(select([version_table.c.version])).scalar() or 0
+
+
+def set_version(conn, version):
+    if conn.execute(version_table.update().values(
+            version=version)).rowcount == 0:
+        conn.execute(version_table.insert().values(id=1, version=version))
+
+
+def run_migrations(engine, migrations):
+    with engine.connect() as conn:
+        version_table.create(conn, checkfirst=True)
+        found = get_version(conn)
+    for number, step in enumerate(migrations[found:], found + 1):
+        with engine.begin() as conn:
+            # Another process may have got here first
+            if get_version(conn) < number:
+                log.info('Migrating schema to version %d', number)
+                step(conn)
+                set_version(conn, number)
+    return found
+
+
+def migrate(engine, migrations, attempts=3):
+    # Returns the version found and the version left behind. Each step
+    # commits together with its version, so a failed step is retried on
+    # the next run, and workers racing on one database retry theirs
+    for attempt in range(attempts):
+        try:
+            found = run_migrations(engine, migrations)
+            break
+        except OperationalError:
+            if attempt == attempts - 1:
+                raise
+            log.warning('Schema migration raced another process, retrying')
+    return found, max(found, len(migrations))
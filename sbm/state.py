@@ -0,0 +1,184 @@
+import sys
+
+SWITCH_TYPES = ['switched', 'alternating', 'timed']
+
+
+class BootRecord(object):
+    __slots__ = ('title', 'config')
+
+    def __init__(self, title, config):
+        self.title = title
+        self.config = config
+
+
+class BootProfile(object):
+    __slots__ = ('default_boot', 'alternate_boot', 'switch_type',
+                 'time_between')
+
+    def __init__(self, default_boot, alternate_boot, switch_type,
+                 time_between):
+        self.default_boot = default_boot
+        self.alternate_boot = alternate_boot
+        self.switch_type = switch_type
+        self.time_between = time_between
+
+
+class HostRecord(object):
+    # Quacks like Machine and HostState as far as booting is concerned
+    __slots__ = ('hostname', 'profile', 'group_id', 'use_alternate',
+                 'last_boot')
+    _switch_type = SWITCH_TYPES
+
+    def __init__(self, hostname, profile, group_id, use_alternate,
+                 last_boot):
+        self.hostname = hostname
+        self.profile = profile
+        self.group_id = group_id
+        self.use_alternate = use_alternate
+        self.last_boot = last_boot
+
+    @property
+    def default_boot(self):
+        return self.profile.default_boot
+
+    @property
+    def alternate_boot(self):
+        return self.profile.alternate_boot
+
+    @property
+    def switch_type(self):
+        return self.profile.switch_type
+
+    @property
+    def time_between(self):
+        return self.profile.time_between
+
+
+class StateEngine(object):
+    def __init__(self):
+        self._boot_configs = {}
+        self._profiles = {}
+        self._groups = {}
+        self._hosts = {}
+        self._identifiers = {}
+
+    def add_boot_config(self, boot_config_id, title, config):
+        self._boot_configs[boot_config_id] = BootRecord(title, config)
+
+    def profile(self, default_boot_id, alternate_boot_id, switch_type,
+                time_between):
+        # Machines mostly share a handful of settings, so profiles are
+        # interned and a host costs one small record
+        key = (default_boot_id, alternate_boot_id, switch_type, time_between)
+        profile = self._profiles.get(key)
+        if profile is None:
+            profile = self._profiles[key] = BootProfile(
+                self._boot_configs.get(default_boot_id),
+                self._boot_configs.get(alternate_boot_id),
+                switch_type,
+                time_between
+            )
+        return profile
+
+    def set_boot_config(self, boot_config_id, title, config):
+        # Profiles hold the record itself, so they see the new config
+        record = self._boot_configs.get(boot_config_id)
+        if record is None:
+            self.add_boot_config(boot_config_id, title, config)
+        else:
+            record.title = title
+            record.config = config
+
+    def remove_boot_config(self, title):
+        for boot_config_id, record in list(self._boot_configs.items()):
+            if record.title != title:
+                continue
+            del self._boot_configs[boot_config_id]
+            for profile in (list(self._profiles.values()) +
+                            list(self._groups.values())):
+                if profile.default_boot is record:
+                    profile.default_boot = None
+                if profile.alternate_boot is record:
+                    profile.alternate_boot = None
+
+    def add_group(self, group_id, default_boot_id, alternate_boot_id,
+                  switch_type, time_between):
+        # Groups are few and not interned, so their members follow a
+        # change made to the profile in place
+        profile = self._groups.get(group_id)
+        if profile is None:
+            profile = self._groups[group_id] = BootProfile(
+                None, None, switch_type, time_between)
+        profile.default_boot = self._boot_configs.get(default_boot_id)
+        profile.alternate_boot = self._boot_configs.get(alternate_boot_id)
+        profile.switch_type = switch_type
+        profile.time_between = time_between
+
+    def remove_group(self, group_id):
+        if self._groups.pop(group_id, None) is None:
+            return
+        # Member rows go with their group
+        for hostname in [hostname for hostname, record in self._hosts.items()
+                         if record.group_id == group_id]:
+            del self._hosts[hostname]
+
+    def group_ids(self):
+        return list(self._groups)
+
+    def add_machine(self, hostname, default_boot_id, alternate_boot_id,
+                    switch_type, time_between, use_alternate, last_boot):
+        record = self._hosts[hostname] = HostRecord(
+            hostname,
+            self.profile(default_boot_id, alternate_boot_id, switch_type,
+                         time_between),
+            None,
+            use_alternate,
+            last_boot
+        )
+        return record
+
+    def member(self, hostname, group_id, use_alternate, last_boot):
+        return HostRecord(hostname, self._groups[group_id], group_id,
+                          use_alternate, last_boot)
+
+    def add_member(self, hostname, group_id, use_alternate, last_boot):
+        record = self._hosts[hostname] = self.member(
+            hostname, group_id, use_alternate, last_boot)
+        return record
+
+    def remove_host(self, hostname):
+        self._hosts.pop(hostname, None)
+
+    def add_identifier(self, kind, value, hostname):
+        self._identifiers[(kind, value)] = hostname
+
+    def remove_identifiers(self, hostnames):
+        # Old values are not kept per host, one pass finds all of them
+        for key in [key for key, hostname in self._identifiers.items()
+                    if hostname in hostnames]:
+            del self._identifiers[key]
+
+    def identify(self, kind, value):
+        return self._identifiers.get((kind, value))
+
+    def has_group(self, group_id):
+        return group_id in self._groups
+
+    def get(self, hostname):
+        return self._hosts.get(hostname)
+
+    def stats(self):
+        records = list(self._hosts.values())
+        size = sys.getsizeof(self._hosts) + sum(
+            sys.getsizeof(record) + sys.getsizeof(record.hostname) +
+            sys.getsizeof(record.last_boot)
+            for record in records)
+        return {
+            'hosts': len(records),
+            'members': sum(1 for r in records if r.group_id is not None),
+            'profiles': len(self._profiles),
+            'groups': len(self._groups),
+            'boot_configs': len(self._boot_configs),
+            'identifiers': len(self._identifiers),
+            'approx_bytes': size
+        }
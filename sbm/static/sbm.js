@@ -1,54 +1,157 @@
-function parse_boot_config_list(response) {
+var boot_configs = {};
+var machines = {};
+var variables = {};
+var revision = null;
+var dashboard = null;
+var dashboard_reload = null;
+function VirtualList(container, row_height, render_row, search_key) {
+        // Only the rows in view exist in the DOM, so the list costs the
+        // same with 20 machines or 20000
+        this.container = $(container);
+        this.row_height = row_height;
+        this.render_row = render_row;
+        this.search_key = search_key;
+        this.items = [];
+        this.keys = [];
+        this.visible = [];
+        this.filter = '';
+        this.drawing = false;
+        this.spacer = $('<div>').css({'position': 'relative'});
+        this.container.css({'overflow-y': 'auto', 'position': 'relative'}).empty().append(this.spacer);
+        var list = this;
+        this.container.on('scroll', function() {
+                list.schedule();
+        });
+        $(window).on('resize', function() {
+                list.schedule();
+        });
+}
+VirtualList.prototype.set_items = function(items) {
+        this.items = items;
+        this.keys = [];
+        for(var i = 0; i < items.length; i++) {
+                this.keys.push(this.search_key(items[i]).toLowerCase());
+        }
+        this.set_filter(this.filter);
+};
+VirtualList.prototype.set_filter = function(filter) {
+        this.filter = filter;
+        var terms = filter.toLowerCase().split(/\s+/).filter(function(term) { return term.length; });
+        this.visible = [];
+        for(var i = 0; i < this.items.length; i++) {
+                var match = true;
+                for(var j = 0; j < terms.length && match; j++) {
+                        match = this.keys[i].indexOf(terms[j]) >= 0;
+                }
+                if(match) {
+                        this.visible.push(this.items[i]);
+                }
+        }
+        this.spacer.css('height', this.visible.length * this.row_height);
+        this.schedule();
+};
+VirtualList.prototype.schedule = function() {
+        if(this.drawing) {
+                return;
+        }
+        this.drawing = true;
+        var list = this;
+        window.requestAnimationFrame(function() {
+                list.drawing = false;
+                list.draw();
+        });
+};
+VirtualList.prototype.draw = function() {
+        var overscan = 10;
+        var first = Math.max(0, Math.floor(this.container.scrollTop() / this.row_height) - overscan);
+        var last = Math.min(this.visible.length, first + Math.ceil(this.container.height() / this.row_height) + 2 * overscan);
+        var rows = [];
+        for(var i = first; i < last; i++) {
+                rows.push(this.render_row(this.visible[i]).css({
+                        'position': 'absolute',
+                        'top': i * this.row_height,
+                        'left': 0,
+                        'right': 0,
+                        'height': this.row_height
+                }));
+        }
+        this.spacer.empty().append(rows);
+};
+function render_boot_config_list() {
         $('#boot_config_list').empty();
-        if (typeof(response) != "object") {
-                response = [response];
-        } 
-        response.sort();
-        for(var i = 0; i < response.length; i++) {
-                $('#boot_config_list').append($('<button type="button">').append(response[i]).addClass("boot_config list-group-item"));
+        var names = Object.keys(boot_configs).sort();
+        for(var i = 0; i < names.length; i++) {
+                $('#boot_config_list').append($('<button type="button">').append(names[i]).addClass("boot_config list-group-item"));
         }
         $('.boot_config').on('click', function() {
                 set_boot_config($(this).text());
-                load_boot_config($(this).text());
+                parse_boot_config_response(boot_configs[$(this).text()]);
         });
 }
-function parse_machine_list(response) {
-        $('#machine_list').empty();
-        if (typeof(response) != "object") {
-                response = [response];
-        } 
-        response.sort();
-        for(var i = 0; i < response.length; i++) {
-                $('#machine_list').append($('<button type="button">').append(response[i]).addClass("machine_config list-group-item"));
-        }
-        $('.machine_config').on('click', function() {
-                load_machine($(this).text());
-        });
+var machine_list = null;
+function render_machine_list() {
+        if(machine_list === null) {
+                machine_list = new VirtualList('#machine_list', 42, function(name) {
+                        return $('<button type="button">').text(name).addClass("machine_config list-group-item");
+                }, function(name) {
+                        return name;
+                });
+                $('#machine_list').on('click', '.machine_config', function() {
+                        parse_machine_response(machines[$(this).text()]);
+                });
+                $('#machine_search').on('input', function() {
+                        machine_list.set_filter($(this).val());
+                });
+        }
+        machine_list.set_items(Object.keys(machines).sort());
 }
-function parse_variable_list(response) {
+function render_variable_list() {
         $('#variable_list').empty();
-        if (typeof(response) != "object") {
-                response = [response];
-        } 
-        response.sort();
-        for(var i = 0; i < response.length; i++) {
-                $('#variable_list').append($('<button type="button">').append(response[i]).addClass("variable list-group-item"));
+        var names = Object.keys(variables).sort();
+        for(var i = 0; i < names.length; i++) {
+                $('#variable_list').append($('<button type="button">').append(names[i]).addClass("variable list-group-item"));
         }
         $('.variable').on('click', function() {
-                load_variable($(this).text());
+                parse_variable_response(variables[$(this).text()]);
         });
 }
+function parse_boot_config_list(response) {
+        boot_configs = {};
+        for(var i = 0; i < response.items.length; i++) {
+                boot_configs[response.items[i]['title']] = response.items[i];
+        }
+        render_boot_config_list();
+}
+function parse_machine_list(response) {
+        machines = {};
+        for(var i = 0; i < response.items.length; i++) {
+                machines[response.items[i]['hostname']] = response.items[i];
+        }
+        render_machine_list();
+}
+function parse_variable_list(response) {
+        variables = {};
+        for(var i = 0; i < response.items.length; i++) {
+                variables[response.items[i]['key']] = response.items[i];
+        }
+        render_variable_list();
+}
 function parse_boot_config_response(response) {
+        boot_configs[response['title']] = response;
         $('#config').val(response['config']);
         $('#config').attr('rows', response['config'].split(/\r\n|\r|\n/).length + 5);
         $('#title').val(response['title']);
 }
 function parse_machine_response(response) {
+        machines[response['hostname']] = response;
         $('#hostname').val(response['hostname']);
         $('#default_boot').val(response['default_boot']);
         $('#alternate_boot').val(response['alternate_boot']);
         $('#switch_type').val(response['switch_type']);
         $('#time_between').val(response['time_between']);
+        $('#mac').val(response['mac']);
+        $('#ip').val(response['ip']);
+        $('#uuid').val(response['uuid']);
         if(response['switch_type'] == 'timed') {
                 $("#time_between_div").show();
         } else {
@@ -56,6 +159,7 @@ function parse_machine_response(response) {
         }
 }
 function parse_variable_response(response) {
+        variables[response['key']] = response;
         $('#value').val(response['value']);
         $('#value').attr('rows', response['value'].split(/\r\n|\r|\n/).length + 5);
         $('#key').val(response['key']);
@@ -71,7 +175,7 @@ function log_ajax_err(xhr, resp, text) {
 }
 function get_boot_configs() {
         $.ajax({
-                url: '/api/v1/boot_config/',
+                url: '/api/v1/boot_config/?expand=1',
                 type: 'GET',
                 success: parse_boot_config_list,
                 error: log_ajax_err
@@ -79,7 +183,7 @@ function get_boot_configs() {
 }
 function get_machines() {
         $.ajax({
-                url: '/api/v1/machine/',
+                url: '/api/v1/machine/?expand=1',
                 type: 'GET',
                 success: parse_machine_list,
                 error: log_ajax_err
@@ -87,7 +191,7 @@ function get_machines() {
 }
 function get_variables() {
         $.ajax({
-                url: '/api/v1/variable/',
+                url: '/api/v1/variable/?expand=1',
                 type: 'GET',
                 success: parse_variable_list,
                 error: log_ajax_err
@@ -139,3 +243,196 @@ function serialize_form(form) {
         }
         return JSON.stringify(data);
 }
+function apply_changes(changes) {
+        var caches = {'boot_config': boot_configs, 'machine': machines, 'variable': variables};
+        var dirty = {};
+        for(var i = 0; i < changes.length; i++) {
+                var change = changes[i];
+                if(change['kind'] == 'import') {
+                        dirty = {'resync': true};
+                } else if(change['kind'] == 'state') {
+                        if(machines[change['key']] && change['data']) {
+                                $.extend(machines[change['key']], change['data']);
+                        }
+                        if(dashboard && dashboard.index[change['key']] && change['data']) {
+                                update_dashboard_row(dashboard.index[change['key']], change['data']);
+                                dirty['state'] = true;
+                        }
+                } else if(caches[change['kind']]) {
+                        if(change['op'] == 'remove') {
+                                delete caches[change['kind']][change['key']];
+                        } else if(change['data']) {
+                                caches[change['kind']][change['key']] = change['data'];
+                        }
+                        dirty[change['kind']] = true;
+                }
+                if(change['kind'] != 'state') {
+                        dirty['dashboard'] = true;
+                }
+        }
+        if(dirty['resync']) {
+                refresh_lists();
+                return;
+        }
+        if(dirty['boot_config'] && $('#boot_config_list').length) {
+                render_boot_config_list();
+        }
+        if(dirty['machine'] && $('#machine_list').length) {
+                render_machine_list();
+        }
+        if(dirty['variable'] && $('#variable_list').length) {
+                render_variable_list();
+        }
+        if(dashboard && dirty['dashboard']) {
+                schedule_dashboard_reload();
+        } else if(dashboard && dirty['state']) {
+                render_dashboard_counts();
+                dashboard.list.schedule();
+        }
+}
+function refresh_lists() {
+        if($('#boot_config_list').length) {
+                get_boot_configs();
+        }
+        if($('#machine_list').length) {
+                get_machines();
+        }
+        if($('#variable_list').length) {
+                get_variables();
+        }
+        if($('#dashboard_list').length) {
+                get_dashboard();
+        }
+}
+function watch_changes() {
+        // Take the head first, so nothing committed while the lists load
+        // is missed
+        $.ajax({
+                url: '/api/v1/changes/' + (revision === null ? '?limit=0' : '?wait=30&since=' + revision),
+                type: 'GET',
+                success: function(response) {
+                        if(revision === null) {
+                                revision = response['head'];
+                                refresh_lists();
+                        } else {
+                                revision = response['revision'];
+                                apply_changes(response['changes']);
+                        }
+                        setTimeout(watch_changes, response['more'] ? 0 : 100);
+                },
+                error: function(xhr) {
+                        if(xhr.status == 410) {
+                                revision = null;
+                        }
+                        setTimeout(watch_changes, 5000);
+                }
+        })
+}
+function get_dashboard() {
+        $.ajax({
+                url: '/api/v1/dashboard/',
+                type: 'GET',
+                success: parse_dashboard,
+                error: log_ajax_err
+        })
+}
+function schedule_dashboard_reload() {
+        // Definition changes can move many machines at once, reload the
+        // whole dashboard rather than patch it, but not more than every 2s
+        if(dashboard_reload === null) {
+                dashboard_reload = setTimeout(function() {
+                        dashboard_reload = null;
+                        get_dashboard();
+                }, 2000);
+        }
+}
+function select_boot(row) {
+        if(row['switch_type'] == 'timed') {
+                var now = Date.now() + dashboard.skew;
+                return row['last_boot'] + row['time_between'] * 1000 > now ? row['alternate_boot'] : row['default_boot'];
+        }
+        return row['use_alternate'] ? row['alternate_boot'] : row['default_boot'];
+}
+function update_dashboard_row(row, state) {
+        if('use_alternate' in state) {
+                row['use_alternate'] = state['use_alternate'];
+        }
+        if('last_boot' in state) {
+                row['last_boot'] = Date.parse(state['last_boot']);
+        }
+}
+function parse_dashboard(response) {
+        if(dashboard === null) {
+                dashboard = {};
+                dashboard.list = new VirtualList('#dashboard_list', 30, render_dashboard_row, function(row) {
+                        return [row['hostname'], row['group'] || '', row['switch_type'], row['default_boot'], row['alternate_boot']].join(' ');
+                });
+                var timer = null;
+                $('#dashboard_search').on('input', function() {
+                        var filter = $(this).val();
+                        clearTimeout(timer);
+                        timer = setTimeout(function() {
+                                dashboard.list.set_filter(filter);
+                                render_dashboard_counts();
+                        }, 100);
+                });
+        }
+        dashboard.skew = Date.parse(response['time']) - Date.now();
+        dashboard.index = {};
+        var rows = [];
+        for(var i = 0; i < response.machines.length; i++) {
+                var row = {};
+                for(var j = 0; j < response.columns.length; j++) {
+                        row[response.columns[j]] = response.machines[i][j];
+                }
+                row['last_boot'] = Date.parse(row['last_boot']);
+                dashboard.index[row['hostname']] = row;
+                rows.push(row);
+        }
+        dashboard.switch_types = response['switch_types'];
+        dashboard.boot_configs = response['boot_configs'];
+        dashboard.list.set_items(rows);
+        render_dashboard_counts();
+}
+function render_dashboard_row(row) {
+        var last_boot = row['last_boot'] > 0 ? new Date(row['last_boot']).toISOString().replace('T', ' ').substr(0, 19) : 'never';
+        return $('<div class="row dashboard_row">').append(
+                $('<div class="col-sm-3">').text(row['hostname']),
+                $('<div class="col-sm-2">').text(row['group'] || ''),
+                $('<div class="col-sm-2">').text(row['switch_type']),
+                $('<div class="col-sm-1">').text(row['use_alternate'] ? 'yes' : 'no'),
+                $('<div class="col-sm-2">').text(last_boot),
+                $('<div class="col-sm-2">').text(row['selected'] || '')
+        ).addClass(row['selected'] == row['alternate_boot'] ? 'bg-warning' : '');
+}
+function render_dashboard_counts() {
+        var selected = {};
+        var rows = dashboard.list.visible;
+        for(var i = 0; i < rows.length; i++) {
+                // Timed machines fall back on their own, so recount each time
+                rows[i]['selected'] = select_boot(rows[i]);
+                selected[rows[i]['selected']] = (selected[rows[i]['selected']] || 0) + 1;
+        }
+        $('#dashboard_total').text(rows.length + ' of ' + dashboard.list.items.length + ' machines');
+        $('#switch_type_counts').empty();
+        var names = Object.keys(dashboard.switch_types).sort();
+        for(var i = 0; i < names.length; i++) {
+                var counts = dashboard.switch_types[names[i]];
+                $('#switch_type_counts').append($('<tr>').append(
+                        $('<td>').text(names[i]),
+                        $('<td>').text(counts['machines']),
+                        $('<td>').text(counts['use_alternate'])
+                ));
+        }
+        $('#boot_config_counts').empty();
+        names = Object.keys(dashboard.boot_configs).sort();
+        for(var i = 0; i < names.length; i++) {
+                var counts = dashboard.boot_configs[names[i]];
+                $('#boot_config_counts').append($('<tr>').append(
+                        $('<td>').text(names[i]),
+                        $('<td>').text(counts['default']),
+                        $('<td>').text(counts['alternate']),
+                        $('<td>').text(selected[names[i]] || 0)
+                ));
+        }
+}
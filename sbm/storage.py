@@ -0,0 +1,112 @@
+import threading
+import weakref
+
+from flask import current_app, has_app_context
+from flask_sqlalchemy import SQLAlchemy
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+SQLITE_JOURNAL_MODES = ['delete', 'truncate', 'persist', 'memory', 'wal',
+                        'off']
+SQLITE_SYNCHRONOUS = ['off', 'normal', 'full', 'extra']
+
+
+def is_memory_sqlite(sa_url):
+    return sa_url.database in (None, '', ':memory:')
+
+
+def sqlite_pragmas(config):
+    pragmas = []
+    journal_mode = config.get('SBM_SQLITE_JOURNAL_MODE')
+    if journal_mode:
+        if journal_mode.lower() not in SQLITE_JOURNAL_MODES:
+            raise ValueError('Unknown SQLite journal mode {}'.format(
+                repr(journal_mode)))
+        pragmas.append('journal_mode={}'.format(journal_mode.lower()))
+    synchronous = config.get('SBM_SQLITE_SYNCHRONOUS')
+    if synchronous:
+        if synchronous.lower() not in SQLITE_SYNCHRONOUS:
+            raise ValueError('Unknown SQLite synchronous level {}'.format(
+                repr(synchronous)))
+        pragmas.append('synchronous={}'.format(synchronous.lower()))
+    if config.get('SBM_SQLITE_BUSY_TIMEOUT') is not None:
+        pragmas.append('busy_timeout={:d}'.format(
+            int(config['SBM_SQLITE_BUSY_TIMEOUT'])))
+    if config.get('SBM_SQLITE_MMAP_SIZE') is not None:
+        pragmas.append('mmap_size={:d}'.format(
+            int(config['SBM_SQLITE_MMAP_SIZE'])))
+    return pragmas
+
+
+def session_scope():
+    # Per app as well as per thread, so a request to one app never picks
+    # up the session, and the database, of another app in the same thread
+    app = current_app._get_current_object() if has_app_context() else None
+    return id(app), threading.get_ident()
+
+
+def pool_options(config, options):
+    options.setdefault('pool_size', config['SBM_DB_POOL_SIZE'])
+    options.setdefault('max_overflow', config['SBM_DB_MAX_OVERFLOW'])
+    options.setdefault('pool_timeout', config['SBM_DB_POOL_TIMEOUT'])
+    if config.get('SBM_DB_POOL_RECYCLE') is not None:
+        options.setdefault('pool_recycle', config['SBM_DB_POOL_RECYCLE'])
+    return options
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    def __init__(self, *args, **kwargs):
+        super(TunedSQLAlchemy, self).__init__(*args, **kwargs)
+        self.engines = weakref.WeakSet()
+        self.discarded_pools = []
+
+    def create_scoped_session(self, options=None):
+        options = dict(options or {})
+        options.setdefault('scopefunc', session_scope)
+        return super(TunedSQLAlchemy, self).create_scoped_session(options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        pooled = 'poolclass' not in options
+        sa_url, options = super(TunedSQLAlchemy, self).apply_driver_hacks(
+            app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            if is_memory_sqlite(sa_url):
+                return sa_url, options
+            if pooled and app.config['SBM_DB_POOL_SIZE']:
+                # Keep connections, and with them the page cache and mmap,
+                # instead of reopening the file on every request
+                options['poolclass'] = QueuePool
+                connect_args = options.setdefault('connect_args', {})
+                connect_args.setdefault('check_same_thread', False)
+                pool_options(app.config, options)
+            if app.config.get('SBM_SQLITE_BUSY_TIMEOUT') is not None:
+                connect_args = options.setdefault('connect_args', {})
+                connect_args.setdefault(
+                    'timeout', app.config['SBM_SQLITE_BUSY_TIMEOUT'] / 1000.0)
+        elif pooled:
+            pool_options(app.config, options)
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(TunedSQLAlchemy, self).create_engine(
+            sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite' and not is_memory_sqlite(sa_url):
+            pragmas = sqlite_pragmas(self.get_app().config)
+            if pragmas:
+                def set_pragmas(dbapi_connection, connection_record):
+                    cursor = dbapi_connection.cursor()
+                    for pragma in pragmas:
+                        cursor.execute('PRAGMA ' + pragma)
+                    cursor.close()
+                event.listen(engine, 'connect', set_pragmas)
+        self.engines.add(engine)
+        return engine
+
+    def discard_connections(self):
+        # In a forked child the pooled connections still belong to the
+        # parent. Closing them would end the parent's sessions, so the old
+        # pools are kept, never closed, and each engine gets a fresh one
+        for engine in list(self.engines):
+            self.discarded_pools.append(engine.pool)
+            engine.pool = engine.pool.recreate()
@@ -0,0 +1,111 @@
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class EventRing(object):
+    # Events wait here for the flush thread, a burst larger than the ring
+    # drops the oldest events rather than slowing down the boots
+    def __init__(self, flush_fn, capacity=100000, interval=1.0,
+                 batch_size=5000, prune_fn=None, prune_interval=60.0):
+        self.capacity = capacity
+        self.interval = interval
+        self.batch_size = batch_size
+        self.prune_interval = prune_interval
+        self._flush_fn = flush_fn
+        self._prune_fn = prune_fn
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._events = collections.deque(maxlen=capacity)
+        self._pruned = time.monotonic()
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stats = {'recorded': 0, 'dropped': 0, 'flushed': 0,
+                       'failures': 0}
+        atexit.register(self.stop)
+
+    def record(self, event):
+        with self._cond:
+            self._ensure_started()
+            if len(self._events) == self.capacity:
+                self._stats['dropped'] += 1
+            self._events.append(event)
+            self._stats['recorded'] += 1
+            if len(self._events) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                events = list(self._events)
+                self._events.clear()
+            for i in range(0, len(events), self.batch_size):
+                batch = events[i:i + self.batch_size]
+                try:
+                    self._flush_fn(batch)
+                except Exception:
+                    log.exception('Failed to flush %d boot events',
+                                  len(events) - i)
+                    with self._cond:
+                        # Older events go back in front, the ring still
+                        # bounds what is kept
+                        events = events[i:] + list(self._events)
+                        self._stats['dropped'] += max(
+                            0, len(events) - self.capacity)
+                        self._events = collections.deque(
+                            events, maxlen=self.capacity)
+                        self._stats['failures'] += 1
+                    return False
+                with self._cond:
+                    self._stats['flushed'] += len(batch)
+            if (self._prune_fn is not None and
+                    time.monotonic() - self._pruned >= self.prune_interval):
+                self._pruned = time.monotonic()
+                try:
+                    self._prune_fn()
+                except Exception:
+                    log.exception('Failed to prune boot events')
+        return True
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._events)
+        return stats
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self._thread = None
+        self.flush()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name='sbm-boot-events')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopping or
+                    len(self._events) >= self.batch_size,
+                    self.interval)
+                if self._stopping:
+                    return
+            self.flush()
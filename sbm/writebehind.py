@@ -0,0 +1,127 @@
+import atexit
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindQueue(object):
+    def __init__(self, flush_fn, interval=0.25, max_pending=256):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._flush_fn = flush_fn
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._flushing = {}
+        self._batch = 0
+        self._flushed = -1
+        self._failed = -1
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._stats = {'records': 0, 'flushes': 0, 'rows': 0, 'failures': 0}
+        atexit.register(self.stop)
+
+    def pending(self, key):
+        with self._cond:
+            state = self._flushing.get(key)
+            if key in self._pending:
+                state = dict(state or {}, **self._pending[key])
+        return state
+
+    def snapshot(self):
+        with self._cond:
+            states = dict((key, dict(state))
+                          for key, state in self._flushing.items())
+            for key, state in self._pending.items():
+                states.setdefault(key, {}).update(state)
+        return states
+
+    def record(self, key, **state):
+        with self._cond:
+            self._ensure_started()
+            self._pending.setdefault(key, {}).update(state)
+            self._stats['records'] += 1
+            if len(self._pending) >= self.max_pending:
+                self._cond.notify_all()
+            return self._batch
+
+    def wait(self, batch, timeout=None):
+        # False if the batch timed out or its flush failed, its updates
+        # are then still queued for the next flush
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._flushed >= batch or self._failed >= batch,
+                timeout)
+            return self._flushed >= batch
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                batch = self._batch
+                self._flushing = self._pending
+                self._pending = {}
+                self._batch += 1
+                items = self._flushing
+            if items:
+                try:
+                    self._flush_fn(items)
+                except Exception:
+                    log.exception('Failed to flush %d pending updates',
+                                  len(items))
+                    with self._cond:
+                        # Newer updates recorded during the flush win
+                        for key, state in self._flushing.items():
+                            state.update(self._pending.get(key, {}))
+                            self._pending[key] = state
+                        self._flushing = {}
+                        self._failed = batch
+                        self._stats['failures'] += 1
+                        self._cond.notify_all()
+                    return False
+            with self._cond:
+                self._flushing = {}
+                self._flushed = batch
+                self._stats['flushes'] += 1
+                self._stats['rows'] += len(items)
+                self._cond.notify_all()
+        return True
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending) + len(self._flushing)
+        return stats
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+        self._thread = None
+        self.flush()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name='sbm-write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._stopping or
+                    len(self._pending) >= self.max_pending,
+                    self.interval)
+                if self._stopping:
+                    return
+            self.flush()
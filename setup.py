@@ -8,4 +8,7 @@ setup(
         'flask',
         'flask-sqlalchemy'
     ],
+    extras_require={
+        'asgi': ['uvicorn']
+    },
 )
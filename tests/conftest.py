@@ -0,0 +1,137 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from sbm import create_app
+
+
+@pytest.fixture
+def config():
+    # Parametrize config to run a test with other settings
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, config):
+    app = create_app(dict({
+        'SBM_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'sbm.db')
+    }, **config))
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    for title, text in [('a', 'A {x}'), ('b', 'B {x}')]:
+        client.put('/api/v1/boot_config/', json={
+            'title': title, 'config': '#!ipxe\n{}\n'.format(text)})
+    client.put('/api/v1/variable/', json={'key': 'x', 'value': '1'})
+    return client
+
+
+@pytest.fixture
+def boot(client):
+    # The script a host would get, without recording a boot
+    def boot(hostname):
+        response = client.get('/api/v1/boot/test/{}/'.format(hostname))
+        return response.data.decode('utf8').strip()
+    return boot
+
+
+# What a worker process runs: one app on the given port, its database
+# comes from SBM_DATABASE_URI in the environment
+SERVE = """
+import sys
+from werkzeug.serving import make_server
+from sbm import create_app
+port, engine, write_mode = sys.argv[1:]
+app = create_app({'SBM_BOOT_ENGINE': engine,
+                  'SBM_STATE_WRITE_MODE': write_mode})
+make_server('127.0.0.1', int(port), app, threaded=True).serve_forever()
+"""
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def call(port, path, method='GET', data=None):
+    body = None
+    headers = {}
+    if data is not None:
+        body = json.dumps(data).encode('utf8')
+        headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(
+        'http://127.0.0.1:{}{}'.format(port, path), data=body,
+        headers=headers, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return response.status, response.read().decode('utf8')
+    except urllib.error.HTTPError as ex:
+        return ex.code, ex.read().decode('utf8')
+
+
+def wait_ready(port, deadline):
+    while time.time() < deadline:
+        try:
+            call(port, '/api/v1/variable/')
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    raise RuntimeError('Worker on port {} did not start'.format(port))
+
+
+def seed(port):
+    for title, text in [('a', 'A {x}'), ('b', 'B {x}')]:
+        call(port, '/api/v1/boot_config/', 'PUT',
+             {'title': title, 'config': '#!ipxe\n{}\n'.format(text)})
+    call(port, '/api/v1/variable/', 'PUT', {'key': 'x', 'value': '0'})
+    for i, switch_type in enumerate(['switched', 'alternating']):
+        call(port, '/api/v1/machine/', 'PUT', {
+            'hostname': switch_type,
+            'default_boot': 'a',
+            'alternate_boot': 'b',
+            'switch_type': switch_type,
+            'time_between': 600,
+            'mac': '52:54:00:00:00:{:02x}'.format(i)
+        })
+
+
+@pytest.fixture
+def start_worker(tmp_path):
+    # Runs sbm in its own process and returns its port. Workers started
+    # with the same database name share it
+    workers = []
+
+    def start(database, engine='orm', write_mode='immediate', primary=None):
+        port = free_port()
+        env = dict(os.environ, PYTHONPATH=ROOT,
+                   SBM_DATABASE_URI='sqlite:///{}'.format(tmp_path / database))
+        if primary is not None:
+            env['SBM_REPLICA_OF'] = 'http://127.0.0.1:{}'.format(primary)
+        workers.append(subprocess.Popen(
+            [sys.executable, '-c', SERVE, str(port), engine, write_mode],
+            env=env, cwd=str(tmp_path), stderr=subprocess.DEVNULL))
+        wait_ready(port, time.time() + 30)
+        return port
+
+    yield start
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.wait()
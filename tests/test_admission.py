@@ -0,0 +1,67 @@
+import threading
+import time
+
+import pytest
+
+from sbm.admission import AdmissionGate
+from sbm.sbm import get_components
+
+GATES = {
+    'SBM_ADMISSION_CONTROL': True,
+    'SBM_ADMISSION_BOOT_LIMIT': 1,
+    'SBM_ADMISSION_BOOT_QUEUE': 0,
+    'SBM_ADMISSION_BOOT_TIMEOUT': 0.05,
+    'SBM_ADMISSION_RETRY_AFTER': 2
+}
+
+
+def fill(gate):
+    while gate.stats()['active'] < gate.limit:
+        assert gate.acquire() is None
+
+
+def test_gates_are_off_by_default(app, client):
+    fill(get_components(app).admission_gates['boot'])
+    assert client.get('/api/v1/boot/test/node1/').status_code == 200
+
+
+@pytest.mark.parametrize('config', [GATES])
+def test_full_queue_answers_503_with_retry_after(app, client, config):
+    fill(get_components(app).admission_gates['boot'])
+    response = client.get('/api/v1/boot/test/node1/')
+    assert response.status_code == 503
+    assert 'queue_full' in response.json['err']
+    assert 2 <= int(response.headers['Retry-After']) <= 4
+
+
+@pytest.mark.parametrize('config', [dict(GATES, SBM_ADMISSION_BOOT_QUEUE=1)])
+def test_queued_request_times_out(app, client, config):
+    gate = get_components(app).admission_gates['boot']
+    fill(gate)
+    response = client.get('/api/v1/boot/test/node1/')
+    assert response.status_code == 503
+    assert 'timeout' in response.json['err']
+    assert gate.stats()['timeout'] == 1
+
+
+@pytest.mark.parametrize('config', [GATES])
+def test_management_gets_through_a_boot_storm(app, client, config):
+    fill(get_components(app).admission_gates['boot'])
+    assert client.get('/api/v1/boot/test/node1/').status_code == 503
+    assert client.get('/api/v1/boot_config/a/').status_code == 200
+    assert client.get('/api/v1/admission/').status_code == 200
+
+
+def test_queued_request_is_admitted_on_release():
+    gate = AdmissionGate(1, queue_size=1, timeout=5.0)
+    assert gate.acquire() is None
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(gate.acquire()))
+    waiter.start()
+    while gate.stats()['queued'] == 0:
+        time.sleep(0.001)
+    assert gate.acquire() == 'queue_full'
+    gate.release()
+    waiter.join()
+    assert results == [None]
+    assert gate.stats()['active'] == 1
@@ -0,0 +1,50 @@
+import os
+
+from sbm import create_app
+from sbm.sbm import db, get_components
+
+
+def test_apps_are_independent(app, client, tmp_path):
+    other = create_app({
+        'SBM_DATABASE_URI': 'sqlite:///{}'.format(tmp_path / 'other.db'),
+        'SBM_BOOT_ENGINE': 'memory'
+    })
+    other_client = other.test_client()
+    other_client.put('/api/v1/boot_config/', json={
+        'title': 'c', 'config': '#!ipxe\nC\n'})
+    assert client.get('/api/v1/boot_config/c/').status_code == 404
+    assert other_client.get('/api/v1/boot_config/c/').status_code == 200
+    assert other_client.get('/api/v1/boot_config/a/').status_code == 404
+    assert get_components(other) is not get_components(app)
+    assert app.config['SBM_BOOT_ENGINE'] == 'orm'
+    assert other.config['SBM_BOOT_ENGINE'] == 'memory'
+
+
+def test_forked_child_keeps_parent_connections(app, client):
+    engine = db.get_engine()
+    with engine.connect() as conn:
+        conn.execute('SELECT 1')
+    pool = engine.pool
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ok = (engine.pool is not pool and
+                  client.get('/api/v1/boot_config/a/').status_code == 200)
+        finally:
+            os._exit(0 if ok else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert engine.pool is pool
+    with engine.connect() as conn:
+        assert conn.execute('SELECT 1').scalar() == 1
+
+
+def test_default_app_is_shared(monkeypatch, tmp_path):
+    import sbm
+    import sbm.sbm
+    monkeypatch.setenv('SBM_DATABASE_URI', 'sqlite:///{}'.format(
+        tmp_path / 'default.db'))
+    monkeypatch.setattr(sbm.sbm, 'default_app', None)
+    from sbm.sbm import app
+    assert sbm.app is app
+    assert sbm.sbm.app is app
+    assert app.config['SQLALCHEMY_DATABASE_URI'].endswith('default.db')
@@ -0,0 +1,137 @@
+import pytest
+
+
+def machine(hostname, **fields):
+    return dict({'hostname': hostname, 'default_boot': 'a',
+                 'alternate_boot': 'b', 'switch_type': 'switched',
+                 'time_between': 600}, **fields)
+
+
+def statuses(response):
+    return dict((result['hostname'], result['status'])
+                for result in response.json['results'])
+
+
+def stored(client, *hostnames):
+    return [hostname for hostname in hostnames if client.get(
+        '/api/v1/machine/{}/'.format(hostname)).status_code == 200]
+
+
+@pytest.mark.parametrize('engine', ['orm', 'memory'])
+def test_failed_items_stay_out_of_the_batch(app, client, boot, engine):
+    app.config['SBM_BOOT_ENGINE'] = engine
+    response = client.put('/api/v1/bulk/machine/', json=[
+        machine('n1', mac='badmac'),
+        machine('n2', mac='52:54:00:00:00:02'),
+        machine('n3', default_boot='missing')
+    ])
+    assert response.status_code == 200
+    assert response.json['committed']
+    assert statuses(response) == {'n1': 'error', 'n2': 'created',
+                                  'n3': 'error'}
+    assert stored(client, 'n1', 'n2', 'n3') == ['n2']
+    assert boot('n2') == '#!ipxe\nA 1'
+    assert not boot('n1').startswith('#!ipxe')
+
+
+def test_atomic_batch_commits_nothing_on_error(client):
+    response = client.put('/api/v1/bulk/machine/?atomic=1', json=[
+        machine('n1'), machine('n2', mac='badmac')])
+    assert response.status_code == 406
+    assert not response.json['committed']
+    assert statuses(response)['n2'] == 'error'
+    assert stored(client, 'n1', 'n2') == []
+
+
+def test_failed_commit_reports_every_item(client):
+    client.put('/api/v1/machine/', json=machine(
+        'n1', mac='52:54:00:00:00:01'))
+    response = client.put('/api/v1/bulk/machine/', json=[
+        machine('n2'), machine('n3', mac='52:54:00:00:00:01')])
+    assert response.status_code == 406
+    assert not response.json['committed']
+    for result in response.json['results']:
+        assert result['status'] == 'error'
+        assert result['err'].startswith('Batch not committed: ')
+        assert 'Traceback' not in result['err']
+    assert stored(client, 'n1', 'n2', 'n3') == ['n1']
+
+
+def setup_states(client):
+    from sbm.sbm import resolver
+    client.put('/api/v1/bulk/machine/', json=[
+        machine('n1'), machine('n2', default_boot='b', alternate_boot='a')])
+    client.put('/api/v1/machine_group/', json={
+        'name': 'rack', 'pattern': 'r[1-4]', 'default_boot': 'a',
+        'alternate_boot': 'b', 'switch_type': 'switched',
+        'time_between': 600})
+    resolver.load_static_hosts({'10.0.0.2': 'r2'})
+    client.get('/api/v1/boot/', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    response = client.post('/api/v1/bulk/state/', json={
+        'hostnames': ['r2'], 'use_alternate': False})
+    assert response.json['members'] == 1
+    return client.get('/api/v1/changes/').json['head']
+
+
+def changed(client, since):
+    return sorted((change['kind'], change['key']) for change in client.get(
+        '/api/v1/changes/?since={}'.format(since)).json['changes'])
+
+
+@pytest.mark.parametrize('config', [
+    {'SBM_BOOT_ENGINE': engine} for engine in ['orm', 'memory', 'sql']])
+def test_bulk_state_selects_by_boot_config(client, boot, config):
+    head = setup_states(client)
+    response = client.post('/api/v1/bulk/state/', json={
+        'boot_config': 'a', 'use_alternate': 'toggle'})
+    assert response.status_code == 200
+    assert (response.json['machines'], response.json['members']) == (1, 1)
+    assert client.get('/api/v1/machine/n1/').json['use_alternate']
+    assert not client.get('/api/v1/machine/n2/').json['use_alternate']
+    assert changed(client, head) == [('state', 'n1'), ('state', 'r2')]
+    assert boot('n1') == '#!ipxe\nB 1'
+    assert boot('n2') == '#!ipxe\nB 1'
+    assert boot('r2') == '#!ipxe\nB 1'
+
+
+def test_bulk_state_boot_config_skips_shadowed_members(client, boot):
+    setup_states(client)
+    # r2 keeps its group state, but an explicit machine now wins
+    client.put('/api/v1/machine/', json=machine(
+        'r2', default_boot='b', alternate_boot='b'))
+    response = client.post('/api/v1/bulk/state/', json={
+        'boot_config': 'a', 'use_alternate': True})
+    assert (response.json['machines'], response.json['members']) == (1, 0)
+
+
+def test_bulk_state_pattern_changes_machine_settings(client):
+    head = setup_states(client)
+    response = client.post('/api/v1/bulk/state/', json={
+        'pattern': 'n[1-2]', 'switch_type': 'timed', 'time_between': 900})
+    assert (response.json['machines'], response.json['members']) == (2, 0)
+    for hostname in ['n1', 'n2']:
+        definition = client.get('/api/v1/machine/{}/'.format(hostname)).json
+        assert (definition['switch_type'], definition['time_between']) == \
+            ('timed', 900)
+    assert changed(client, head) == [('machine', 'n1'), ('machine', 'n2')]
+
+
+def test_bulk_state_hostnames_skip_unknown_hosts(client):
+    head = setup_states(client)
+    response = client.post('/api/v1/bulk/state/', json={
+        'hostnames': ['n1', 'missing'], 'reset_last_boot': True})
+    assert (response.json['machines'], response.json['members']) == (1, 0)
+    assert changed(client, head) == [('state', 'n1')]
+
+
+@pytest.mark.parametrize('selection', [
+    {'use_alternate': True},
+    {'hostnames': ['n1'], 'pattern': 'n*', 'use_alternate': True},
+    {'boot_config': 'missing', 'use_alternate': True},
+    {'hostnames': ['n1']},
+    {'hostnames': ['n1'], 'use_alternate': 'yes'},
+])
+def test_bulk_state_rejects_bad_requests(client, selection):
+    setup_states(client)
+    response = client.post('/api/v1/bulk/state/', json=selection)
+    assert response.status_code == 406
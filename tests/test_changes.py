@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+
+
+def feed(client, query='since=0'):
+    return client.get('/api/v1/changes/?' + query).json
+
+
+def summary(changes):
+    return [(change['kind'], change['key'], change['op'])
+            for change in changes]
+
+
+def test_definitions_are_logged_in_order(client):
+    start = feed(client)['head']
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600})
+    client.post('/api/v1/variable/x/', json={'key': 'x', 'value': '2'})
+    client.delete('/api/v1/machine/node1/')
+    result = feed(client, 'since={}'.format(start))
+    assert summary(result['changes']) == [
+        ('machine', 'node1', 'set'),
+        ('variable', 'x', 'set'),
+        ('machine', 'node1', 'remove')]
+    assert result['changes'][0]['data']['default_boot'] == 'a'
+    assert result['changes'][1]['data'] == {'key': 'x', 'value': '2'}
+    assert result['changes'][2]['data'] is None
+    revisions = [change['revision'] for change in result['changes']]
+    assert revisions == sorted(revisions)
+    assert result['revision'] == result['head'] == revisions[-1]
+    assert result['more'] is False
+
+
+def test_boots_are_logged_as_state(client):
+    from sbm.sbm import resolver
+    resolver.load_static_hosts({'10.0.0.2': 'node1'})
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'alternating', 'time_between': 600})
+    head = feed(client)['head']
+    client.get('/api/v1/boot/', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    changes = feed(client, 'since={}'.format(head))['changes']
+    assert summary(changes) == [('state', 'node1', 'set')]
+    assert changes[0]['data']['use_alternate'] is True
+
+
+def test_pages_and_head(client):
+    head = feed(client)['head']
+    first = feed(client, 'since=0&limit=2')
+    assert len(first['changes']) == 2 and first['more'] is True
+    assert first['head'] == head
+    second = feed(client, 'since={}&limit=500'.format(first['revision']))
+    assert second['more'] is False
+    assert [change['revision'] for change in
+            first['changes'] + second['changes']] == list(range(1, head + 1))
+    assert feed(client, 'since=0&limit=0') == {
+        'revision': 0, 'head': head, 'changes': [], 'more': False}
+
+
+@pytest.mark.parametrize('query', ['since=x', 'limit=ten', 'wait=soon'])
+def test_bad_arguments(client, query):
+    assert client.get('/api/v1/changes/?' + query).status_code == 406
+
+
+def test_long_poll_wakes_on_a_write(app, client):
+    head = feed(client)['head']
+    writer = threading.Timer(0.2, lambda: app.test_client().put(
+        '/api/v1/variable/', json={'key': 'y', 'value': '1'}))
+    writer.start()
+    start = time.monotonic()
+    result = feed(client, 'since={}&wait=10'.format(head))
+    writer.join()
+    assert summary(result['changes']) == [('variable', 'y', 'set')]
+    assert time.monotonic() - start < 5
+
+
+def test_long_poll_times_out_empty(client):
+    head = feed(client)['head']
+    start = time.monotonic()
+    result = feed(client, 'since={}&wait=0.3'.format(head))
+    assert result['changes'] == [] and result['revision'] == head
+    assert time.monotonic() - start >= 0.3
+
+
+@pytest.mark.parametrize('config', [{'SBM_CHANGES_RETENTION': 2}])
+def test_pruned_revisions_are_gone(client):
+    from sbm.sbm import prune_changes
+    head = feed(client)['head']
+    prune_changes()
+    response = client.get('/api/v1/changes/?since=0')
+    assert response.status_code == 410
+    assert response.json['head'] == head
+    assert len(feed(client, 'since={}'.format(head - 2))['changes']) == 2
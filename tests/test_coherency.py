@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from conftest import call, seed
+
+
+def everywhere(ports, path):
+    # The write went to one worker, every worker has to see it straight away
+    return [call(port, path)[1].strip() for port in ports]
+
+
+@pytest.mark.parametrize('engine, write_mode', [
+    ('orm', 'immediate'),
+    ('sql', 'immediate'),
+    ('memory', 'immediate'),
+    ('memory', 'group'),
+    ('orm', 'deferred'),
+])
+def test_workers_see_each_others_writes(start_worker, engine, write_mode):
+    ports = [start_worker('sbm.db', engine, write_mode) for i in range(3)]
+    seed(ports[0])
+    for i in range(1, 4):
+        call(ports[i % 3], '/api/v1/variable/x/', 'POST',
+             {'key': 'x', 'value': str(i)})
+        assert everywhere(ports, '/api/v1/boot/test/switched/') == \
+            ['#!ipxe\nA {}'.format(i)] * 3
+
+    call(ports[0], '/api/v1/boot_config/a/', 'POST',
+         {'title': 'a', 'config': '#!ipxe\nA2 {x}\n'})
+    assert everywhere(ports, '/api/v1/boot/test/switched/') == \
+        ['#!ipxe\nA2 3'] * 3
+
+    call(ports[0], '/api/v1/machine/switched/', 'POST', {
+        'hostname': 'switched', 'default_boot': 'b', 'alternate_boot': 'a',
+        'switch_type': 'switched', 'time_between': 600,
+        'mac': '52:54:00:00:00:00'})
+    assert everywhere(ports, '/api/v1/boot/test/switched/') == \
+        ['#!ipxe\nB 3'] * 3
+
+    status, body = call(ports[0], '/api/v1/machine_group/', 'PUT', {
+        'name': 'rack', 'pattern': 'r[1-4]', 'default_boot': 'b',
+        'alternate_boot': 'a', 'switch_type': 'switched',
+        'time_between': 600})
+    assert status == 200
+    assert everywhere(ports, '/api/v1/boot/test/r2/') == ['#!ipxe\nB 3'] * 3
+
+    # An alternating machine booted round robin across the workers has to
+    # keep alternating, which needs every worker to see the last boot.
+    # Deferred writes only leave the worker when they are flushed
+    served = []
+    for i in range(6):
+        served.append(call(
+            ports[i % 3],
+            '/api/v1/boot/?mac=52:54:00:00:00:01')[1].split('\n')[1][0])
+        if write_mode == 'deferred':
+            time.sleep(0.5)
+    assert served == ['A', 'B'] * 3
@@ -0,0 +1,97 @@
+import datetime
+
+import pytest
+
+
+def put_machine(client, hostname, switch_type, **fields):
+    client.put('/api/v1/machine/', json=dict({
+        'hostname': hostname, 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': switch_type, 'time_between': 600}, **fields))
+
+
+def real_boot(client, address):
+    client.get('/api/v1/boot/', environ_base={'REMOTE_ADDR': address})
+
+
+@pytest.fixture
+def fleet(client):
+    # Three machines, a rack group with one booted member, and node2
+    # booted into its alternate
+    from sbm.sbm import resolver
+    resolver.load_static_hosts({'10.0.0.2': 'node2', '10.0.0.3': 'timed1',
+                                '10.0.1.2': 'r2'})
+    put_machine(client, 'node1', 'switched')
+    put_machine(client, 'node2', 'alternating')
+    put_machine(client, 'timed1', 'timed')
+    client.put('/api/v1/machine_group/', json={
+        'name': 'rack', 'pattern': 'r[1-4]', 'pattern_type': 'range',
+        'default_boot': 'b', 'alternate_boot': 'a',
+        'switch_type': 'switched', 'time_between': 600})
+    for address in ['10.0.0.2', '10.0.0.3', '10.0.1.2']:
+        real_boot(client, address)
+    return client
+
+
+def rows(dashboard):
+    return {row[0]: dict(zip(dashboard['columns'], row))
+            for row in dashboard['machines']}
+
+
+def test_rows_cover_machines_and_booted_members(fleet):
+    dashboard = fleet.get('/api/v1/dashboard/').json
+    machines = rows(dashboard)
+    assert sorted(machines) == ['node1', 'node2', 'r2', 'timed1']
+    assert machines['r2']['group'] == 'rack'
+    assert machines['node1']['group'] is None
+    assert machines['node2']['use_alternate'] is True
+    assert machines['node2']['selected'] == 'b'
+    # Booted just now, so still inside its time_between
+    assert machines['timed1']['selected'] == 'b'
+    assert machines['r2']['selected'] == 'b'
+    assert machines['node1']['selected'] == 'a'
+
+
+def test_counts(fleet):
+    dashboard = fleet.get('/api/v1/dashboard/').json
+    assert dashboard['switch_types'] == {
+        'switched': {'machines': 2, 'use_alternate': 0},
+        'alternating': {'machines': 1, 'use_alternate': 1},
+        'timed': {'machines': 1, 'use_alternate': 0}}
+    assert dashboard['boot_configs'] == {
+        'a': {'default': 3, 'alternate': 1, 'selected': 1},
+        'b': {'default': 1, 'alternate': 3, 'selected': 3}}
+    assert dashboard['revision'] == \
+        fleet.get('/api/v1/changes/?limit=0').json['head']
+
+
+def test_defined_machine_hides_its_group_state(fleet):
+    put_machine(fleet, 'r2', 'switched')
+    machines = rows(fleet.get('/api/v1/dashboard/').json)
+    assert machines['r2']['group'] is None
+    assert len(fleet.get('/api/v1/dashboard/').json['machines']) == 4
+
+
+def test_timed_machine_switches_back(fleet):
+    from sbm.sbm import Machine, db
+    machine = Machine.query.filter_by(hostname='timed1').one()
+    machine.last_boot = datetime.datetime.now() - \
+        datetime.timedelta(seconds=601)
+    db.session.commit()
+    machines = rows(fleet.get('/api/v1/dashboard/').json)
+    assert machines['timed1']['selected'] == 'a'
+
+
+@pytest.mark.parametrize('config', [
+    {'SBM_STATE_WRITE_MODE': 'deferred', 'SBM_STATE_FLUSH_INTERVAL': 60},
+])
+def test_queued_boots_are_shown(fleet):
+    real_boot(fleet, '10.0.0.2')
+    machines = rows(fleet.get('/api/v1/dashboard/').json)
+    assert machines['node2']['use_alternate'] is False
+    assert machines['node2']['selected'] == 'a'
+
+
+def test_dashboard_page(client):
+    response = client.get('/dashboard')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/html')
@@ -0,0 +1,75 @@
+import pytest
+
+GROUP = {
+    'name': 'gpu',
+    'pattern_type': 'regex',
+    'default_boot': 'b',
+    'alternate_boot': 'a',
+    'switch_type': 'switched',
+    'time_between': 600
+}
+
+
+def put_machine(client, hostname):
+    return client.put('/api/v1/machine/', json={
+        'hostname': hostname, 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600})
+
+
+@pytest.mark.parametrize('pattern', [
+    '(?i)gpu.*',
+    'gpu(?s).*',
+    r'(gpu)\1',
+    r'(gpu)?(?(1)x|y)',
+    r'(?P<rack>gpu)\d+',
+    '[0-9',
+])
+def test_rejects_regex_that_breaks_the_matcher(client, boot, pattern):
+    put_machine(client, 'node1')
+    response = client.put('/api/v1/machine_group/',
+                          json=dict(GROUP, pattern=pattern))
+    assert response.status_code == 406
+    assert client.get('/api/v1/machine_group/gpu/').status_code == 404
+    assert boot('node1') == '#!ipxe\nA 1'
+
+
+@pytest.mark.parametrize('pattern, hostname', [
+    ('(?i:gpu).*', 'GPU7'),
+    (r'(gpu|cpu)-(\d+)', 'gpu-3'),
+    (r'gpu[\1]\d', 'gpu\x011'),
+])
+def test_accepts_scoped_regex(client, boot, pattern, hostname):
+    response = client.put('/api/v1/machine_group/',
+                          json=dict(GROUP, pattern=pattern))
+    assert response.status_code == 200
+    assert boot(hostname) == '#!ipxe\nB 1'
+
+
+def test_regex_groups_combine(client, boot):
+    for name, pattern, config in [('gpu', '(?i:gpu)[0-9]+', 'b'),
+                                  ('cpu', '(c)(p)u[0-9]+', 'a')]:
+        response = client.put('/api/v1/machine_group/', json=dict(
+            GROUP, name=name, pattern=pattern, default_boot=config))
+        assert response.status_code == 200
+    assert boot('Gpu1') == '#!ipxe\nB 1'
+    assert boot('cpu2') == '#!ipxe\nA 1'
+
+
+@pytest.mark.parametrize('config', [
+    {'SBM_BOOT_ENGINE': engine} for engine in ['orm', 'memory', 'sql']])
+def test_match_after_member_booted(client, boot, config):
+    from sbm.sbm import resolver
+    response = client.put('/api/v1/machine_group/',
+                          json=dict(GROUP, name='rack', pattern='r[0-9]'))
+    assert response.status_code == 200
+    resolver.load_static_hosts({'10.0.0.5': 'r5'})
+    response = client.get('/api/v1/boot/',
+                          environ_base={'REMOTE_ADDR': '10.0.0.5'})
+    assert response.data.decode('utf8').strip() == '#!ipxe\nB 1'
+    assert client.get('/api/v1/machine_group/match/r5/').json == {
+        'hostname': 'r5', 'match': 'group', 'group': 'rack'}
+    # An explicit machine wins over the state left by its group
+    put_machine(client, 'r5')
+    assert client.get('/api/v1/machine_group/match/r5/').json == {
+        'hostname': 'r5', 'match': 'machine'}
+    assert boot('r5') == '#!ipxe\nA 1'
@@ -0,0 +1,126 @@
+import pytest
+
+from sbm.sbm import normalize_identifier
+
+ENGINES = [{'SBM_BOOT_ENGINE': engine} for engine in ['orm', 'sql', 'memory']]
+MAC = '52:54:00:ab:cd:01'
+UUID = '6b1c3a0e-1f2d-4c5b-9a8e-7d6c5b4a3f21'
+
+
+@pytest.mark.parametrize('kind, value, expected', [
+    ('mac', '52-54-00-AB-CD-01', MAC),
+    ('mac', '5254.00ab.cd01', MAC),
+    ('ip', '2001:db8:0:0::1', '2001:db8::1'),
+    ('uuid', UUID.upper(), UUID),
+    ('uuid', '', None),
+])
+def test_identifiers_are_normalized(kind, value, expected):
+    assert normalize_identifier(kind, value) == expected
+
+
+@pytest.mark.parametrize('kind, value', [
+    ('mac', '52:54:00:ab:cd'),
+    ('mac', '52:54:00:ab:cd:zz'),
+    ('ip', '10.0.0.256'),
+    ('uuid', 'not-a-uuid'),
+    ('serial', '1234'),
+])
+def test_bad_identifiers_are_rejected(kind, value):
+    with pytest.raises(ValueError):
+        normalize_identifier(kind, value)
+
+
+@pytest.fixture
+def hosts(client):
+    # node1 has identifiers, reverse DNS of 10.0.0.9 says node2
+    from sbm.sbm import resolver
+    resolver.load_static_hosts({'10.0.0.9': 'node2'})
+    for hostname, default_boot, identifiers in [
+            ('node1', 'a', {'mac': MAC, 'ip': '10.1.0.1', 'uuid': UUID}),
+            ('node2', 'b', {})]:
+        client.put('/api/v1/machine/', json=dict({
+            'hostname': hostname, 'default_boot': default_boot,
+            'alternate_boot': 'a', 'switch_type': 'switched',
+            'time_between': 600}, **identifiers))
+
+    def boot(query):
+        response = client.get('/api/v1/boot/?' + query,
+                              environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        return response.data.decode('utf8').split('\n')[1]
+    return boot
+
+
+@pytest.mark.parametrize('config', ENGINES)
+@pytest.mark.parametrize('query', [
+    'mac=52-54-00-AB-CD-01',
+    'ip=10.1.0.1',
+    'uuid=' + UUID.upper(),
+    'mac=52:54:00:00:00:99&ip=10.1.0.1',
+    'mac=bad&uuid=' + UUID,
+])
+def test_boot_by_identifier(hosts, config, query):
+    assert hosts(query) == 'A 1'
+
+
+@pytest.mark.parametrize('config', ENGINES)
+@pytest.mark.parametrize('query', [
+    '',
+    'mac=52:54:00:00:00:99',
+    'ip=10.1.0.2&uuid=',
+    'mac=bad',
+])
+def test_unmatched_identifiers_fall_back_to_dns(hosts, config, query):
+    assert hosts(query) == 'B 1'
+
+
+@pytest.mark.parametrize('config', ENGINES)
+def test_mac_wins_over_ip(client, hosts, config):
+    client.post('/api/v1/machine/node2/', json={
+        'hostname': 'node2', 'default_boot': 'b', 'alternate_boot': 'a',
+        'switch_type': 'switched', 'time_between': 600,
+        'mac': '52:54:00:ab:cd:02'})
+    assert hosts('ip=10.1.0.1&mac=52:54:00:ab:cd:02') == 'B 1'
+
+
+@pytest.mark.parametrize('config', ENGINES)
+def test_identifier_changes_are_seen(client, hosts, config):
+    assert hosts('ip=10.1.0.1') == 'A 1'
+    # Keys left out keep their value, null clears one
+    client.post('/api/v1/machine/node1/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600,
+        'mac': '52:54:00:ab:cd:03', 'ip': None})
+    machine = client.get('/api/v1/machine/node1/').json
+    assert (machine['mac'], machine['ip'], machine['uuid']) == \
+        ('52:54:00:ab:cd:03', None, UUID)
+    assert hosts('mac=' + MAC) == 'B 1'
+    assert hosts('ip=10.1.0.1') == 'B 1'
+    assert hosts('mac=52:54:00:ab:cd:03') == 'A 1'
+    client.delete('/api/v1/machine/node1/')
+    assert hosts('uuid=' + UUID) == 'B 1'
+
+
+def test_identifiers_are_unique(client, hosts):
+    from sbm.sbm import db
+    response = client.post('/api/v1/machine/node2/', json={
+        'hostname': 'node2', 'default_boot': 'b', 'alternate_boot': 'a',
+        'switch_type': 'switched', 'time_between': 600,
+        'uuid': UUID.upper()})
+    assert response.status_code == 406
+    # Requests share the test's app context, a server would start afresh
+    db.session.rollback()
+    assert client.get('/api/v1/machine/node2/').json['uuid'] is None
+
+
+def test_bad_identifier_in_a_machine_is_rejected(client):
+    response = client.put('/api/v1/machine/', json={
+        'hostname': 'node3', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600, 'mac': 'nope'})
+    assert response.status_code == 406
+
+
+@pytest.mark.parametrize('config', ENGINES)
+def test_finished_by_identifier(client, hosts, config):
+    response = client.get('/api/v1/boot/finished/?mac=' + MAC,
+                          environ_base={'REMOTE_ADDR': '10.0.0.9'})
+    assert response.json == {'status': 'ok'}
@@ -0,0 +1,96 @@
+import json
+
+
+def setup_rack(app, client):
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600})
+    response = client.put('/api/v1/machine_group/', json={
+        'name': 'rack', 'pattern': 'r[1-4]', 'default_boot': 'b',
+        'alternate_boot': 'a', 'switch_type': 'alternating',
+        'time_between': 600, 'priority': 3})
+    assert response.status_code == 200
+    from sbm.sbm import resolver
+    resolver.load_static_hosts({'10.0.0.2': 'r2'})
+    # The first boot of a member stores its state
+    response = client.get('/api/v1/boot/',
+                          environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert response.data.decode('utf8').strip() == '#!ipxe\nB 1'
+
+
+def test_export_includes_groups_and_members(app, client):
+    setup_rack(app, client)
+    snapshot = client.get('/api/v1/export/').json
+    assert [group['name'] for group in snapshot['machine_groups']] == \
+        ['rack']
+    group = snapshot['machine_groups'][0]
+    assert (group['default_boot'], group['alternate_boot'],
+            group['priority']) == ('b', 'a', 3)
+    assert [(state['hostname'], state['group'], state['use_alternate'])
+            for state in snapshot['host_states']] == [('r2', 'rack', True)]
+
+
+def test_replace_import_remaps_group_boot_configs(app, client, boot):
+    setup_rack(app, client)
+    snapshot = client.get('/api/v1/export/').json
+    # Boot configs come back under new ids
+    snapshot['boot_configs'].insert(
+        0, {'title': 'rescue', 'config': '#!ipxe\nRESCUE\n'})
+    response = client.post('/api/v1/import/?replace=1',
+                           data=json.dumps(snapshot),
+                           content_type='application/json')
+    assert response.status_code == 200
+    assert response.json['machine_groups'] == 1
+    assert response.json['host_states'] == 1
+    assert boot('node1') == '#!ipxe\nA 1'
+    assert boot('r3') == '#!ipxe\nB 1'
+    # r2 alternated on its first boot, the imported state keeps that
+    assert boot('r2') == '#!ipxe\nA 1'
+
+
+def test_replace_import_without_groups_clears_them(app, client, boot):
+    setup_rack(app, client)
+    snapshot = client.get('/api/v1/export/').json
+    snapshot['machine_groups'] = []
+    snapshot['host_states'] = []
+    response = client.post('/api/v1/import/?replace=1',
+                           data=json.dumps(snapshot),
+                           content_type='application/json')
+    assert response.status_code == 200
+    assert client.get('/api/v1/machine_group/rack/').status_code == 404
+    assert not boot('r3').startswith('#!ipxe')
+    assert boot('node1') == '#!ipxe\nA 1'
+
+
+def test_ndjson_round_trip_keeps_groups(app, client, boot):
+    setup_rack(app, client)
+    snapshot = client.get('/api/v1/export/?format=ndjson').data
+    response = client.post('/api/v1/import/?replace=1', data=snapshot,
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert boot('r3') == '#!ipxe\nB 1'
+    assert boot('r2') == '#!ipxe\nA 1'
+
+
+def test_failed_replace_import_keeps_the_inventory(app, client, boot):
+    setup_rack(app, client)
+    snapshot = client.get('/api/v1/export/').json
+    snapshot['machines'].append({
+        'hostname': 'node2', 'default_boot': 'missing',
+        'alternate_boot': 'a', 'switch_type': 'switched'})
+    # The bad machine lands in a later batch than the clearing
+    response = client.post('/api/v1/import/?replace=1&batch_size=1',
+                           data=json.dumps(snapshot),
+                           content_type='application/json')
+    assert response.status_code == 406
+    assert client.get('/api/v1/machine_group/rack/').status_code == 200
+    assert boot('node1') == '#!ipxe\nA 1'
+    assert boot('r3') == '#!ipxe\nB 1'
+
+
+def test_import_rejects_empty_batches(app, client):
+    response = client.post('/api/v1/import/?batch_size=0',
+                           data=json.dumps({'version': 2}),
+                           content_type='application/json')
+    assert response.status_code == 406
+    assert 'batch_size must be positive' in response.json['err']
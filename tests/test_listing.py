@@ -0,0 +1,111 @@
+import pytest
+
+
+def put_machines(client, count=5):
+    for i in range(count):
+        client.put('/api/v1/machine/', json={
+            'hostname': 'node{}'.format(i),
+            'default_boot': 'a' if i % 2 else 'b',
+            'alternate_boot': 'b' if i % 2 else 'a',
+            'switch_type': 'alternating' if i < 2 else 'switched',
+            'time_between': 600,
+            'mac': '52:54:00:00:00:{:02x}'.format(i)})
+
+
+def test_bare_list_of_names(client):
+    put_machines(client, 3)
+    assert client.get('/api/v1/machine/').json == ['node0', 'node1', 'node2']
+    assert client.get('/api/v1/boot_config/').json == ['a', 'b']
+
+
+def test_pages_follow_the_cursor(client):
+    put_machines(client)
+    seen = []
+    url = '/api/v1/machine/?limit=2'
+    while url is not None:
+        page = client.get(url).json
+        assert len(page['items']) <= 2
+        seen.extend(page['items'])
+        url = None
+        if page['next'] is not None:
+            url = '/api/v1/machine/?limit=2&after={}'.format(page['next'])
+    assert seen == ['node{}'.format(i) for i in range(5)]
+
+
+def test_expand_returns_records(client):
+    put_machines(client, 2)
+    items = client.get('/api/v1/machine/?expand=1').json['items']
+    assert [item['hostname'] for item in items] == ['node0', 'node1']
+    assert items[1]['default_boot'] == 'a'
+    assert items[1]['switch_type'] == 'alternating'
+    variables = client.get('/api/v1/variable/?expand=1').json
+    assert variables == {'items': [{'key': 'x', 'value': '1'}],
+                         'next': None}
+
+
+def test_filters(client):
+    put_machines(client)
+    assert client.get('/api/v1/machine/?switch_type=alternating') \
+        .json['items'] == ['node0', 'node1']
+    assert client.get('/api/v1/machine/?boot_config=a').json['items'] == \
+        ['node{}'.format(i) for i in range(5)]
+    client.put('/api/v1/boot_config/', json={'title': 'c', 'config': 'c'})
+    assert client.get('/api/v1/machine/?boot_config=c').json['items'] == []
+    assert client.get('/api/v1/machine/?boot_config=missing') \
+        .json['items'] == []
+
+
+def test_unknown_switch_type_is_a_bad_request(client):
+    response = client.get('/api/v1/machine/?switch_type=sometimes')
+    assert response.status_code == 400
+    assert 'sometimes' in response.json['err']
+
+
+@pytest.mark.parametrize('url', [
+    '/api/v1/machine/',
+    '/api/v1/machine/?expand=1&limit=2',
+    '/api/v1/boot_config/',
+    '/api/v1/variable/?expand=1',
+    '/api/v1/machine_group/',
+])
+def test_unchanged_list_is_not_read_again(client, monkeypatch, url):
+    from sbm import sbm
+    put_machines(client, 3)
+    etag = client.get(url).headers['ETag']
+
+    def fail():
+        raise AssertionError('the list was read')
+    for name in ['get_list_of_machines', 'get_list_of_boot_configs',
+                 'get_list_of_variables', 'get_list_of_machine_groups',
+                 'get_page_of_machines', 'get_page_of_variables']:
+        monkeypatch.setattr(sbm, name, fail)
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+
+def test_writes_change_the_etag(client):
+    put_machines(client, 3)
+    etag = client.get('/api/v1/machine/').headers['ETag']
+    assert client.get('/api/v1/machine/?expand=1').headers['ETag'] != etag
+    client.put('/api/v1/variable/', json={'key': 'y', 'value': '2'})
+    response = client.get('/api/v1/machine/', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+@pytest.mark.parametrize('config', [
+    {'SBM_STATE_WRITE_MODE': 'deferred', 'SBM_STATE_FLUSH_INTERVAL': 60},
+])
+def test_queued_boots_change_the_etag(client):
+    from sbm.sbm import state_writer
+    put_machines(client, 3)
+    url = '/api/v1/machine/?expand=1'
+    first = client.get(url).headers['ETag']
+    client.get('/api/v1/boot/?mac=52:54:00:00:00:00')
+    queued = client.get(url, headers={'If-None-Match': first})
+    assert queued.status_code == 200
+    assert queued.json['items'][0]['use_alternate'] is True
+    state_writer.flush()
+    flushed = client.get(url).headers['ETag']
+    assert len(set([first, queued.headers['ETag'], flushed])) == 3
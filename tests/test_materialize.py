@@ -0,0 +1,25 @@
+import os
+
+import pytest
+
+from sbm.sbm import get_components
+
+
+@pytest.fixture
+def config(tmp_path):
+    return {'SBM_MATERIALIZE_DIR': str(tmp_path / 'tree')}
+
+
+def test_tree_builds_on_a_fresh_database(app, tmp_path):
+    script_tree = get_components(app).script_tree
+    script_tree.sync()
+    assert script_tree.stats()['failures'] == 0
+
+
+def test_machine_change_rewrites_its_script(app, client, tmp_path):
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600})
+    get_components(app).script_tree.sync()
+    with open(os.path.join(str(tmp_path), 'tree', 'host', 'node1')) as f:
+        assert f.read().strip() == '#!ipxe\nA 1'
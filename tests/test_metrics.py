@@ -0,0 +1,88 @@
+from sbm.metrics import Registry
+
+
+def test_counter_and_gauge_text_format():
+    registry = Registry()
+    counter = registry.counter('jobs_total', 'Jobs', ['name'])
+    counter.inc('a"b\\c\nd')
+    counter.inc('plain')
+    counter.inc('plain')
+    registry.gauge('size', 'Size', lambda: 2.5)
+    assert registry.render() == (
+        '# HELP jobs_total Jobs\n'
+        '# TYPE jobs_total counter\n'
+        'jobs_total{name="a\\"b\\\\c\\nd"} 1\n'
+        'jobs_total{name="plain"} 2\n'
+        '# HELP size Size\n'
+        '# TYPE size gauge\n'
+        'size 2.5\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram('wait_seconds', 'Wait', ['stage'],
+                                   buckets=(0.1, 1.0))
+    for value in [0.05, 0.1, 0.5, 2.0]:
+        histogram.observe(value, 'x')
+    lines = registry.render().splitlines()[2:]
+    assert lines == [
+        'wait_seconds_bucket{stage="x",le="0.1"} 2',
+        'wait_seconds_bucket{stage="x",le="1.0"} 3',
+        'wait_seconds_bucket{stage="x",le="+Inf"} 4',
+        'wait_seconds_sum{stage="x"} 2.65',
+        'wait_seconds_count{stage="x"} 4',
+    ]
+
+
+def test_histogram_times_a_block():
+    registry = Registry()
+    histogram = registry.histogram('block_seconds', 'Block')
+    with histogram.time():
+        pass
+    assert 'block_seconds_count 1' in registry.render()
+
+
+def samples(client):
+    response = client.get('/metrics')
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    values = {}
+    for line in response.data.decode('utf8').splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    return values
+
+
+def test_boots_are_counted_by_stage(client):
+    from sbm.sbm import resolver
+    resolver.load_static_hosts({'10.0.0.2': 'node1'})
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600})
+    for path in ['/api/v1/boot/', '/api/v1/boot/finished/']:
+        client.get(path, environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    values = samples(client)
+    assert values['sbm_boots_total{boot_config="a",'
+                  'switch_type="switched"}'] == 1
+    assert values['sbm_boot_finished_total'] == 1
+    # Both calls resolve the host, only the boot renders
+    for stage, count in [('dns', 2), ('machine_lookup', 1), ('commit', 1),
+                         ('variable_load', 1), ('render', 1)]:
+        assert values['sbm_boot_stage_duration_seconds_count'
+                      '{{stage="{}"}}'.format(stage)] == count
+    assert values['sbm_http_requests_total{route="/api/v1/boot/",'
+                  'method="GET",status="200"}'] == 1
+    assert values['sbm_http_request_duration_seconds_count'
+                  '{route="/api/v1/boot/"}'] == 1
+    assert values['sbm_resolver_static_hits_total'] == 2
+
+
+def test_test_renders_are_not_counted_as_boots(client, boot):
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600})
+    boot('node1')
+    values = samples(client)
+    assert not any(name.startswith('sbm_boots_total') for name in values)
+    assert values['sbm_http_requests_total{route="/api/v1/boot/test/'
+                  '<hostname>/",method="GET",status="200"}'] == 1
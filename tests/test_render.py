@@ -0,0 +1,58 @@
+import pytest
+
+from sbm.cache import RenderCache
+from sbm.render import compile_template
+
+VARIABLES = {'server': 'http://boot', 'disks': ['sda', 'sdb'], 'size': 7}
+
+
+@pytest.mark.parametrize('source', [
+    '#!ipxe\nchain {server}/menu\n',
+    'no placeholders',
+    '{{literal}} {server}',
+    'root=/dev/{disks[1]} size={size:03d} {server!r}',
+    'pad={size:{size}}',
+])
+def test_plan_matches_str_format(source):
+    plan = compile_template(source)
+    assert plan.render(VARIABLES) == source.format(**VARIABLES)
+
+
+def test_plan_names_its_variables():
+    plan = compile_template('{server} {disks[0]} {size:{width}}')
+    assert plan.names == {'server', 'disks', 'size', 'width'}
+
+
+@pytest.mark.parametrize('source', ['{}', '{0}', '{server!x}', '{server'])
+def test_rejects_bad_placeholders(source):
+    with pytest.raises(ValueError):
+        compile_template(source)
+
+
+def test_cache_hit_needs_same_generation_and_config():
+    cache = RenderCache()
+    assert cache.render('t', '{size}', {'size': 1}, 1) == '1'
+    # A hit does not look at the variables again
+    assert cache.render('t', '{size}', {'size': 2}, 1) == '1'
+    assert cache.render('t', '{size}', {'size': 2}, 2) == '2'
+    assert cache.render('t', '<{size}>', {'size': 2}, 2) == '<2>'
+    cache.invalidate('t')
+    assert cache.render('t', '{size}', {'size': 3}, 2) == '3'
+
+
+def test_boot_sees_variable_and_config_changes(client, boot):
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600})
+    assert boot('node1') == '#!ipxe\nA 1'
+    client.post('/api/v1/variable/x/', json={'key': 'x', 'value': '2'})
+    assert boot('node1') == '#!ipxe\nA 2'
+    client.post('/api/v1/boot_config/a/', json={
+        'title': 'a', 'config': '#!ipxe\nC {x}'})
+    assert boot('node1') == '#!ipxe\nC 2'
+
+
+def test_boot_config_with_positional_placeholder_is_rejected(client):
+    response = client.put('/api/v1/boot_config/', json={
+        'title': 'c', 'config': '#!ipxe\n{}'})
+    assert response.status_code == 406
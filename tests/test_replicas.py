@@ -0,0 +1,53 @@
+import json
+import time
+
+import pytest
+
+from conftest import call, seed
+
+
+def converge(ports, path, expected, timeout=10.0):
+    # Replicas apply the primary's changes asynchronously
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if all(call(port, path)[1].strip() == expected for port in ports):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.mark.parametrize('engine', ['orm', 'memory'])
+def test_replicas_follow_the_primary(start_worker, engine):
+    primary = start_worker('primary.db', engine)
+    replicas = [start_worker('replica{}.db'.format(i), engine,
+                             primary=primary) for i in range(2)]
+    seed(primary)
+    assert converge(replicas, '/api/v1/boot/test/switched/', '#!ipxe\nA 0')
+
+    for i in range(1, 4):
+        call(primary, '/api/v1/variable/x/', 'POST',
+             {'key': 'x', 'value': str(i)})
+        assert converge(replicas, '/api/v1/boot/test/switched/',
+                        '#!ipxe\nA {}'.format(i))
+
+    call(primary, '/api/v1/machine_group/', 'PUT', {
+        'name': 'rack', 'pattern': 'r[1-4]', 'default_boot': 'b',
+        'alternate_boot': 'a', 'switch_type': 'switched',
+        'time_between': 600})
+    assert converge(replicas, '/api/v1/boot/test/r2/', '#!ipxe\nB 3')
+
+    status, body = call(replicas[0], '/api/v1/variable/x/', 'POST',
+                        {'key': 'x', 'value': 'local'})
+    assert status == 403
+
+    # Boots land on the replicas round robin, their state goes back to
+    # the primary and from there to the other replicas
+    served = []
+    for i in range(4):
+        served.append(call(
+            replicas[i % 2],
+            '/api/v1/boot/?mac=52:54:00:00:00:01')[1].split('\n')[1][0])
+        time.sleep(1.0)
+    assert served == ['A', 'B'] * 2
+    machine = json.loads(call(primary, '/api/v1/machine/alternating/')[1])
+    assert machine['use_alternate'] is False
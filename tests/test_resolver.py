@@ -0,0 +1,108 @@
+import socket
+import threading
+
+import pytest
+
+from sbm.resolver import HostResolver
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    # Every address the fake DNS was asked for. 10.0.0.x resolves,
+    # anything else does not
+    lookups = []
+
+    def gethostbyaddr(address):
+        lookups.append(address)
+        if not address.startswith('10.0.0.'):
+            raise socket.herror('unknown host')
+        return ('node{}.example.com'.format(address.split('.')[-1]), [],
+                [address])
+    monkeypatch.setattr(socket, 'gethostbyaddr', gethostbyaddr)
+    return lookups
+
+
+def test_caches_successful_lookups(lookups):
+    resolver = HostResolver()
+    assert resolver.resolve('10.0.0.1') == 'node1.example.com'
+    assert resolver.resolve('10.0.0.1') == 'node1.example.com'
+    assert lookups == ['10.0.0.1']
+    stats = resolver.stats()
+    assert (stats['misses'], stats['hits'], stats['size']) == (1, 1, 1)
+
+
+def test_caches_failed_lookups(lookups):
+    resolver = HostResolver()
+    for i in range(2):
+        with pytest.raises(socket.herror):
+            resolver.resolve('192.168.0.1')
+    assert lookups == ['192.168.0.1']
+    assert resolver.stats()['negative_hits'] == 1
+
+
+def test_expired_entries_are_looked_up_again(lookups):
+    resolver = HostResolver(positive_ttl=0, negative_ttl=0)
+    resolver.resolve('10.0.0.1')
+    resolver.resolve('10.0.0.1')
+    for i in range(2):
+        with pytest.raises(socket.herror):
+            resolver.resolve('192.168.0.1')
+    assert lookups == ['10.0.0.1'] * 2 + ['192.168.0.1'] * 2
+
+
+def test_clear_forgets_lookups(lookups):
+    resolver = HostResolver()
+    resolver.resolve('10.0.0.1')
+    resolver.clear()
+    resolver.resolve('10.0.0.1')
+    assert lookups == ['10.0.0.1'] * 2
+
+
+def test_evicts_least_recently_used(lookups):
+    resolver = HostResolver(max_entries=2)
+    for address in ['10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.0.3']:
+        resolver.resolve(address)
+    resolver.resolve('10.0.0.1')
+    resolver.resolve('10.0.0.2')
+    assert lookups == ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.2']
+    assert resolver.stats()['evictions'] == 2
+
+
+def test_static_hosts_skip_dns(lookups, tmp_path):
+    hosts_file = tmp_path / 'hosts'
+    hosts_file.write_text('# comment\n10.0.0.5 five five.example.com\n'
+                          '10.0.0.5 other\n10.0.0.6 six # spare\n')
+    resolver = HostResolver(static_hosts={'10.0.0.7': 'seven'})
+    resolver.load_hosts_file(str(hosts_file))
+    assert [resolver.resolve('10.0.0.{}'.format(i)) for i in [5, 6, 7]] == \
+        ['five', 'six', 'seven']
+    assert lookups == []
+    assert resolver.stats()['static_hits'] == 3
+
+
+def test_slow_lookup_times_out_and_is_shared(monkeypatch):
+    release = threading.Event()
+    lookups = []
+
+    def gethostbyaddr(address):
+        lookups.append(address)
+        release.wait(5)
+        return ('slow.example.com', [], [address])
+    monkeypatch.setattr(socket, 'gethostbyaddr', gethostbyaddr)
+    resolver = HostResolver(timeout=0.05)
+    for i in range(2):
+        with pytest.raises(socket.herror):
+            resolver.resolve('10.0.0.9')
+    assert resolver.stats()['timeouts'] == 2
+    release.set()
+    resolver._pool.shutdown(wait=True)
+    # The lookup finished after the callers gave up, and was kept
+    assert resolver.resolve('10.0.0.9') == 'slow.example.com'
+    assert lookups == ['10.0.0.9']
+
+
+def test_resolver_endpoint_reports_and_clears(client, lookups):
+    from sbm.sbm import resolver
+    resolver.resolve('10.0.0.1')
+    assert client.get('/api/v1/resolver/').json['size'] == 1
+    assert client.delete('/api/v1/resolver/').json['size'] == 0
@@ -0,0 +1,103 @@
+import pytest
+
+from sbm.telemetry import EventRing
+
+
+def test_full_ring_drops_the_oldest():
+    flushed = []
+    ring = EventRing(flushed.extend, capacity=3, interval=60)
+    for i in range(5):
+        ring.record(i)
+    assert ring.stats()['dropped'] == 2
+    ring.stop()
+    assert flushed == [2, 3, 4]
+
+
+def test_events_are_written_in_batches():
+    batches = []
+    ring = EventRing(batches.append, interval=60, batch_size=2)
+    for i in range(5):
+        ring.record(i)
+    ring.stop()
+    assert [event for batch in batches for event in batch] == \
+        list(range(5))
+    assert max(len(batch) for batch in batches) <= 2
+    assert ring.stats()['flushed'] == 5
+
+
+def test_failed_write_keeps_the_events():
+    written = []
+
+    def flush(batch):
+        if not written:
+            written.append(None)
+            raise RuntimeError('database is locked')
+        written.extend(batch)
+    ring = EventRing(flush, interval=60)
+    ring.record('a')
+    assert not ring.flush()
+    ring.record('b')
+    assert ring.stats()['pending'] == 2
+    assert ring.flush()
+    ring.stop()
+    assert written == [None, 'a', 'b']
+    assert ring.stats()['failures'] == 1
+
+
+@pytest.fixture
+def booted(client):
+    # node1 booted and finished, node2 booted twice and never finished
+    from sbm.sbm import resolver
+    resolver.load_static_hosts({'10.0.0.1': 'node1', '10.0.0.2': 'node2'})
+    for hostname, default_boot in [('node1', 'a'), ('node2', 'b')]:
+        client.put('/api/v1/machine/', json={
+            'hostname': hostname, 'default_boot': default_boot,
+            'alternate_boot': 'a', 'switch_type': 'switched',
+            'time_between': 600})
+    for path, address in [('/api/v1/boot/', '10.0.0.1'),
+                          ('/api/v1/boot/', '10.0.0.2'),
+                          ('/api/v1/boot/', '10.0.0.2'),
+                          ('/api/v1/boot/finished/', '10.0.0.1')]:
+        client.get(path, environ_base={'REMOTE_ADDR': address})
+    return client
+
+
+def test_host_events_newest_first(booted):
+    events = booted.get('/api/v1/boot_events/host/node1/').json['events']
+    assert [(event['kind'], event['boot_config']) for event in events] == \
+        [('finished', None), ('boot', 'a')]
+    assert all(event['latency'] >= 0 for event in events)
+    events = booted.get(
+        '/api/v1/boot_events/host/node2/?limit=1').json['events']
+    assert len(events) == 1
+
+
+def test_rate(booted):
+    rate = booted.get('/api/v1/boot_events/rate/?window=60&bucket=10').json
+    assert (rate['boots'], rate['finished']) == (3, 1)
+    assert rate['boots_per_second'] == 3 / 60
+    assert sum(bucket['boots'] for bucket in rate['buckets']) == 3
+
+
+def test_unfinished(booted):
+    unfinished = booted.get(
+        '/api/v1/boot_events/unfinished/?grace=0').json['unfinished']
+    assert [(host['hostname'], host['boot_config']) for host in unfinished] \
+        == [('node2', 'b')]
+    assert booted.get('/api/v1/boot_events/unfinished/?grace=0'
+                      '&boot_config=a').json['unfinished'] == []
+    assert booted.get('/api/v1/boot_events/unfinished/?grace=300') \
+        .json['unfinished'] == []
+
+
+def test_test_renders_are_not_recorded(client, boot):
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'switched', 'time_between': 600})
+    boot('node1')
+    assert client.get('/api/v1/boot_events/').json['recorded'] == 0
+
+
+def test_bad_window_is_rejected(client):
+    response = client.get('/api/v1/boot_events/rate/?window=0')
+    assert response.status_code == 406
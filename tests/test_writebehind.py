@@ -0,0 +1,124 @@
+import threading
+
+import pytest
+
+from sbm.writebehind import WriteBehindQueue
+
+
+def test_updates_to_one_key_are_merged():
+    flushed = []
+    queue = WriteBehindQueue(flushed.append, interval=60)
+    queue.record('n1', use_alternate=True)
+    queue.record('n1', last_boot=1)
+    queue.record('n2', use_alternate=False)
+    assert queue.pending('n1') == {'use_alternate': True, 'last_boot': 1}
+    assert queue.flush()
+    assert flushed == [{'n1': {'use_alternate': True, 'last_boot': 1},
+                        'n2': {'use_alternate': False}}]
+    assert queue.pending('n1') is None
+    stats = queue.stats()
+    assert (stats['records'], stats['flushes'], stats['rows'],
+            stats['pending']) == (3, 1, 2, 0)
+    queue.stop()
+
+
+def test_failed_flush_keeps_the_updates():
+    calls = []
+
+    def flush(items):
+        calls.append(dict(items))
+        if len(calls) == 1:
+            # Recorded while this flush runs, so newer than the batch
+            queue.record('n1', last_boot=2)
+            raise RuntimeError('database is locked')
+    queue = WriteBehindQueue(flush, interval=60)
+    batch = queue.record('n1', use_alternate=True, last_boot=1)
+    assert not queue.flush()
+    assert not queue.wait(batch, 0)
+    assert queue.pending('n1') == {'use_alternate': True, 'last_boot': 2}
+    assert queue.stats()['failures'] == 1
+    assert queue.flush()
+    assert calls[1] == {'n1': {'use_alternate': True, 'last_boot': 2}}
+    queue.stop()
+
+
+def test_waiters_share_a_background_flush():
+    flushed = []
+    queue = WriteBehindQueue(flushed.append, interval=0.01)
+    batches = []
+    threads = [threading.Thread(target=lambda i=i: batches.append(
+        queue.wait(queue.record('n{}'.format(i), last_boot=i), 5)))
+        for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    queue.stop()
+    assert batches == [True] * 8
+    assert sum(len(items) for items in flushed) == 8
+    assert len(flushed) < 8
+
+
+def test_full_queue_flushes_before_the_interval():
+    flushed = threading.Event()
+    queue = WriteBehindQueue(lambda items: flushed.set(), interval=60,
+                             max_pending=2)
+    queue.record('n1', last_boot=1)
+    queue.record('n2', last_boot=1)
+    assert flushed.wait(5)
+    queue.stop()
+
+
+def test_stop_flushes_what_is_left():
+    flushed = []
+    queue = WriteBehindQueue(flushed.append, interval=60)
+    queue.record('n1', last_boot=1)
+    queue.stop()
+    assert flushed == [{'n1': {'last_boot': 1}}]
+
+
+def put_alternating(client):
+    client.put('/api/v1/machine/', json={
+        'hostname': 'node1', 'default_boot': 'a', 'alternate_boot': 'b',
+        'switch_type': 'alternating', 'time_between': 600,
+        'mac': '52:54:00:00:00:01'})
+
+
+def real_boot(client):
+    response = client.get('/api/v1/boot/?mac=52:54:00:00:00:01')
+    return response.data.decode('utf8').split('\n')[1][0]
+
+
+def stored_alternate():
+    # What the database holds, not the queued state
+    from sbm.sbm import Machine, db
+    db.session.rollback()
+    return Machine.query.filter_by(hostname='node1').one().use_alternate
+
+
+@pytest.mark.parametrize('config', [
+    {'SBM_STATE_WRITE_MODE': 'group'},
+    {'SBM_STATE_WRITE_MODE': 'deferred',
+     'SBM_STATE_FLUSH_INTERVAL': 60},
+    {'SBM_STATE_WRITE_MODE': 'deferred', 'SBM_BOOT_ENGINE': 'sql',
+     'SBM_STATE_FLUSH_INTERVAL': 60},
+])
+def test_queued_state_is_seen_by_the_next_boot(client, config):
+    from sbm.sbm import state_writer
+    put_alternating(client)
+    assert [real_boot(client) for i in range(3)] == ['A', 'B', 'A']
+    state_writer.flush()
+    assert stored_alternate() is True
+
+
+@pytest.mark.parametrize('config', [
+    {'SBM_STATE_WRITE_MODE': 'deferred', 'SBM_STATE_FLUSH_INTERVAL': 60},
+])
+def test_deferred_state_waits_for_the_flush(client):
+    from sbm.sbm import state_writer
+    put_alternating(client)
+    real_boot(client)
+    assert stored_alternate() is False
+    assert client.get('/api/v1/machine/node1/').json['use_alternate']
+    state_writer.flush()
+    assert stored_alternate() is True